@@ -0,0 +1,357 @@
+#! /usr/bin/env python3
+
+descriptiontext="""
+benchmark.py
+
+Time each stage of the DYFI Induced Events pipeline on synthetic data
+of any size, without network access: a generated event catalog,
+Moschetti-format collate file and raw entry files, with ComCat
+replaced by a local stand-in server.
+
+For each stage the wall time, throughput and peak memory (Python
+allocations, measured in a separate run with tracemalloc) are written
+to a results file. With --baseline, results are compared with an
+earlier results file and stages that got slower are flagged. The
+startup stage times importing the main scripts, each in a new
+interpreter.
+
+Examples:
+
+  ./benchmark.py --events 100000 --save-baseline baseline.json
+  (change something)
+  ./benchmark.py --events 100000 --baseline baseline.json
+
+"""
+
+import os
+import io
+import sys
+import gc
+import json
+import time
+import shutil
+import subprocess
+import platform
+import tempfile
+import argparse
+import datetime
+import tracemalloc
+import contextlib
+import concurrent.futures
+import numpy as np
+
+from modules import synthetic
+from modules.standin import StandinComcat
+from modules.geojsonstream import iterFeatures,FeatureWriter
+from modules.catalog import Catalog
+from modules.collate import CollateFile,readCollateFile,collateEvents,collateEventsNumpy
+from modules.filter import BatchTimeFilter,BatchSpaceFilter
+from modules.comcat import Events
+from makeEvents import filterCatalog
+from makeAggregated import processEvent,aggregateEvent
+from jsonfiles2xy import CdiBuckets,readEntryFile
+
+DEFAULT_POLY_FILE='../input/polygon_is_14_ok_comb.txt'
+DEFAULT_RESULTS='benchmark.results.json'
+
+# Scripts whose import time (in a new interpreter) is the startup stage
+STARTUP_SCRIPTS=('makeEvents','makeAggregated','queryCells','makeSummary')
+
+def parseArgs():
+  parser=argparse.ArgumentParser(
+    description=descriptiontext,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+  parser.add_argument('--events',type=int,default=10000,
+    help='Number of synthetic catalog events. Default 10000')
+
+  parser.add_argument('--collate_extra',type=float,default=1.0,
+    help='Unmatched collate lines per catalog event. Default 1.0')
+
+  parser.add_argument('--downloads',type=int,default=200,
+    help='Number of felt events to download from the stand-in server. Default 200')
+
+  parser.add_argument('--jobs',type=int,default=4,
+    help='Concurrent requests for the download stages. Default 4')
+
+  parser.add_argument('--delay',type=float,default=0.0,
+    help='Seconds added to each stand-in server response. Default 0')
+
+  parser.add_argument('--seed',type=int,default=0,
+    help='Random seed of the synthetic data. Default 0')
+
+  parser.add_argument('--stages',type=str,
+    help='Comma-separated stages to run. Default all: '+','.join(STAGES))
+
+  parser.add_argument('--no-memory',dest='memory',action='store_false',
+    help='Skip the peak memory runs')
+
+  parser.add_argument('--polyfile',type=str,default=DEFAULT_POLY_FILE,
+    help='Polygon file for the filter stage. Default '+DEFAULT_POLY_FILE)
+
+  parser.add_argument('--workdir',type=str,
+    help='Keep the synthetic data in this directory (reused if already there) instead of a temporary one')
+
+  parser.add_argument('--results',type=str,default=DEFAULT_RESULTS,
+    help='Results file. Default '+DEFAULT_RESULTS)
+
+  parser.add_argument('--baseline',type=str,
+    help='Compare with this earlier results file')
+
+  parser.add_argument('--save-baseline',dest='savebaseline',type=str,
+    help='Also save the results as this baseline file')
+
+  parser.add_argument('--tolerance',type=float,default=0.25,
+    help='Relative slowdown flagged as a regression. Default 0.25')
+
+  args=parser.parse_args()
+  args.stages=args.stages.split(',') if args.stages else list(STAGES)
+  for stage in args.stages:
+    if stage not in STAGES:
+      parser.error('Unknown stage %s' % stage)
+  return args
+
+
+class Workspace:
+  """ Synthetic input files for one configuration, generated once """
+
+  def __init__(self,workdir,args):
+    self.workdir=workdir
+    self.catalogfile=os.path.join(workdir,'catalog.geojson')
+    self.collatefile=os.path.join(workdir,'collate.txt')
+    self.entrydir=os.path.join(workdir,'entries')
+    self.outdir=os.path.join(workdir,'out')
+    self.polyfile=args.polyfile
+    configfile=os.path.join(workdir,'config.json')
+    config={'events':args.events,'seed':args.seed,'collate_extra':args.collate_extra}
+
+    start=time.time()
+    self.features=synthetic.makeCatalog(args.events,args.seed)
+    self.felt=[feature for feature in self.features if feature['properties']['felt']]
+
+    try:
+      with open(configfile,'r') as f:
+        self.counts=json.load(f)
+      if self.counts.pop('config')!=config:
+        raise ValueError('different configuration')
+      print('Reusing synthetic data in',workdir)
+      return
+    except (OSError,ValueError,KeyError):
+      pass
+
+    print('Generating',args.events,'synthetic events in',workdir)
+    if os.path.isdir(self.entrydir):
+      shutil.rmtree(self.entrydir)
+    synthetic.writeCatalog(self.catalogfile,self.features)
+    self.counts={
+      'collatelines':synthetic.writeCollateFile(self.collatefile,self.features,
+        extra=args.collate_extra,seed=args.seed),
+      'entries':synthetic.writeEntryFiles(self.entrydir,self.features,args.seed),
+    }
+    with open(configfile,'w') as f:
+      json.dump(dict(self.counts,config=config),f)
+    print('Generated in %.1f s:' % (time.time()-start),len(self.felt),'felt events,',
+      self.counts['entries'],'entries,',self.counts['collatelines'],'collate lines')
+
+  def outfiles(self,evid):
+    return {name:os.path.join(self.outdir,'%s.%s' % (evid,name))
+      for name in ('dyfi_geo_1km.geojson','dyfi_geo_10km.geojson')}
+
+  def freshOutdir(self):
+    if os.path.isdir(self.outdir):
+      shutil.rmtree(self.outdir)
+    os.makedirs(self.outdir)
+
+
+# Each stage has a setup (not timed) returning the arguments of its
+# run, and the number of items the run processes
+
+def stageStartup(ws,args):
+  bindir=os.path.dirname(os.path.abspath(__file__))
+  def run():
+    for script in STARTUP_SCRIPTS:
+      subprocess.run([sys.executable,'-c','import '+script],cwd=bindir,check=True)
+  return (run,len(STARTUP_SCRIPTS))
+
+def stageReadCatalog(ws,args):
+  return ((lambda:Catalog.fromFeatures(iterFeatures(ws.catalogfile))),
+    len(ws.features))
+
+def stageFilter(ws,args):
+  timeFilter=BatchTimeFilter(synthetic.START,synthetic.END)
+  spaceFilter=BatchSpaceFilter(ws.polyfile)
+  return ((lambda:filterCatalog(iterFeatures(ws.catalogfile),timeFilter,spaceFilter)),
+    len(ws.features))
+
+def stageWriteCatalog(ws,args):
+  catalog=Catalog.fromFeatures(iterFeatures(ws.catalogfile))
+  def run():
+    with FeatureWriter(os.path.join(ws.workdir,'written.geojson')) as writer:
+      for feature in catalog.features():
+        writer.write(feature)
+  return (run,len(catalog))
+
+def stageReadCollate(ws,args):
+  def run():
+    with open(ws.collatefile,'r') as f:
+      return CollateFile.parse(f.read())
+  return (run,ws.counts['collatelines'])
+
+def stageReadCollateCached(ws,args):
+  readCollateFile(ws.collatefile)
+  return ((lambda:readCollateFile(ws.collatefile)),ws.counts['collatelines'])
+
+def collateStage(engine):
+  def stage(ws,args):
+    catalog=Catalog.fromFeatures(iterFeatures(ws.catalogfile))
+    tocollate=readCollateFile(ws.collatefile)
+    return ((lambda:engine(catalog,tocollate)),len(tocollate))
+  return stage
+
+def stageComcatEvents(ws,args):
+  return ((lambda:Events(synthetic.START,synthetic.END,workers=args.jobs)),
+    len(ws.features))
+
+def stageComcatDownload(ws,args):
+  felt=ws.felt[:args.downloads]
+  ws.freshOutdir()
+  def run():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+      list(pool.map(lambda feature:processEvent(feature['id'],ws.outfiles(feature['id']),
+        updated=feature['properties']['updated']),felt))
+  return (run,len(felt))
+
+def stageAggregate(ws,args):
+  ws.freshOutdir()
+  def run():
+    for feature in ws.felt:
+      (lon,lat)=feature['geometry']['coordinates'][0:2]
+      aggregateEvent(feature['id'],os.path.join(ws.entrydir,'raw.%s.json' % feature['id']),
+        lat,lon,ws.outfiles(feature['id']))
+  return (run,ws.counts['entries'])
+
+def stageJsonfiles2xy(ws,args):
+  def run():
+    with tempfile.TemporaryDirectory() as tmpdir:
+      buckets=CdiBuckets(tmpdir)
+      for filename in os.listdir(ws.entrydir):
+        for (cdi,line) in readEntryFile(os.path.join(ws.entrydir,filename))[0]:
+          buckets.add(cdi,line)
+      with open(os.path.join(ws.workdir,'entries.xy'),'w') as o:
+        buckets.write(o)
+  return (run,ws.counts['entries'])
+
+STAGES={
+  'startup':stageStartup,
+  'read_catalog':stageReadCatalog,
+  'filter':stageFilter,
+  'write_catalog':stageWriteCatalog,
+  'read_collate':stageReadCollate,
+  'read_collate_cached':stageReadCollateCached,
+  'collate_index':collateStage(collateEvents),
+  'collate_numpy':collateStage(collateEventsNumpy),
+  'comcat_events':stageComcatEvents,
+  'comcat_download':stageComcatDownload,
+  'aggregate':stageAggregate,
+  'jsonfiles2xy':stageJsonfiles2xy,
+}
+
+
+def measure(stage,ws,args):
+  """ Run one stage: wall time, then peak memory in a second run """
+
+  (run,nitems)=stage(ws,args)
+  result={'items':nitems}
+
+  gc.collect()
+  with contextlib.redirect_stdout(io.StringIO()):
+    start=time.perf_counter()
+    run()
+    result['seconds']=time.perf_counter()-start
+  result['rate']=nitems/result['seconds'] if result['seconds']>0 else None
+
+  if args.memory:
+    (run,nitems)=stage(ws,args)
+    gc.collect()
+    tracemalloc.start()
+    try:
+      with contextlib.redirect_stdout(io.StringIO()):
+        run()
+      result['peak_mb']=tracemalloc.get_traced_memory()[1]/1e6
+    finally:
+      tracemalloc.stop()
+
+  return result
+
+
+def compare(results,baseline,tolerance):
+  """ Print each stage against the baseline. Returns the regressed stages """
+
+  regressed=[]
+  print()
+  print('%-20s %10s %10s %8s %10s %10s' % ('stage','seconds','baseline','ratio','peak MB','baseline'))
+  for name,result in results['stages'].items():
+    base=baseline.get('stages',{}).get(name)
+    if not base:
+      print('%-20s %10.3f %10s' % (name,result['seconds'],'-'))
+      continue
+
+    ratio=result['seconds']/base['seconds'] if base['seconds'] else float('inf')
+    flag=''
+    if ratio>1+tolerance:
+      flag='SLOWER'
+      regressed.append(name)
+    elif ratio<1-tolerance:
+      flag='faster'
+    print('%-20s %10.3f %10.3f %8.2f %10s %10s %s' % (name,result['seconds'],base['seconds'],ratio,
+      '%.1f' % result['peak_mb'] if 'peak_mb' in result else '-',
+      '%.1f' % base['peak_mb'] if 'peak_mb' in base else '-',flag))
+
+  if baseline.get('config')!=results['config']:
+    print('WARNING: baseline was made with a different configuration',baseline.get('config'))
+  return regressed
+
+
+if __name__=='__main__':
+
+  args=parseArgs()
+
+  if args.workdir:
+    os.makedirs(args.workdir,exist_ok=True)
+    workdir=args.workdir
+  else:
+    tmpdir=tempfile.TemporaryDirectory()
+    workdir=tmpdir.name
+
+  ws=Workspace(workdir,args)
+  server=StandinComcat(ws.features,delay=args.delay,seed=args.seed).start()
+
+  results={
+    'created':datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'python':platform.python_version(),
+    'numpy':np.__version__,
+    'config':{'events':args.events,'seed':args.seed,'collate_extra':args.collate_extra,
+      'downloads':args.downloads,'jobs':args.jobs,'delay':args.delay},
+    'stages':{}
+  }
+
+  try:
+    for name in args.stages:
+      result=measure(STAGES[name],ws,args)
+      results['stages'][name]=result
+      print('%-20s %9.3f s %12.0f items/s %s' % (name,result['seconds'],result['rate'] or 0,
+        ' peak %.1f MB' % result['peak_mb'] if 'peak_mb' in result else ''))
+  finally:
+    server.stop()
+
+  for filename in [args.results,args.savebaseline]:
+    if filename:
+      with open(filename,'w') as f:
+        json.dump(results,f,indent=2)
+      print('Wrote',filename)
+
+  if args.baseline:
+    with open(args.baseline,'r') as f:
+      baseline=json.load(f)
+    if compare(results,baseline,args.tolerance):
+      sys.exit(1)
@@ -1,13 +1,27 @@
 #! /bin/env python3
-# Simple script to count nresponses from geojson file
+# Simple script to count nresponses from the summary table
+# (made by makeSummary.py), and the responses near large events
 
-import json
+import sys
+import numpy as np
 
-f=open('collated.geojson','r') 
+from modules.summary import readSummary,column
 
-data=json.load(f)
-counter=0
-for event in data.values():
-    counter+=event['nresponses']
-    print('Counter is now',counter)
+targetMag=4.0
+targetDist=20
 
+summaryfile=sys.argv[1] if len(sys.argv)>1 else '../output/dyfi.summary.csv'
+
+rows=list(readSummary(summaryfile).values())
+if not rows:
+    print('Could not read summary table',summaryfile,'(run makeSummary.py)')
+    exit()
+
+felt=np.nan_to_num(column(rows,'felt'))
+mags=column(rows,'mag')
+near=np.nan_to_num(column(rows,'within_%ikm' % targetDist))
+big=mags>=targetMag
+
+print('Counter is now',int(felt.sum()))
+print('n(M>=%i)=%i, n(r<%i)=%i, n(both)=%i' % (
+    targetMag,felt[big].sum(),targetDist,near.sum(),near[big].sum()))
@@ -3,9 +3,22 @@
 # json2xy.py
 # Convert a JSON file of events into an xy file of epicenters for plotting
 # Output is events.xy
+#
+# Input files can be a flat JSON list of events (with eventid, lat, lon
+# and mag) or a GeoJSON event catalog as written by makeEvents.py.
+# Several files, or directories of them, can be given; with --workers
+# they are converted in parallel into shards that are joined in the
+# order the files were given.
 
-import sys
+import os
+import os.path
 import json
+import shutil
+import tempfile
+import argparse
+import concurrent.futures
+
+from modules.geojsonstream import iterFeatures
 
 def getsize(mag):
   mag=float(mag)
@@ -19,27 +32,94 @@ def getsize(mag):
       return 8
   return 10
 
-try:
-  inputfile=sys.argv[1]
-except:
-  print('Usage: json2xy.py [inputfile]')
-  exit()
+def iterEvents(inputfile):
+  """ Iterate over (evid,lat,lon,mag) of each event in a JSON list or GeoJSON file """
+
+  with open(inputfile,'r') as f:
+    first=f.read(1)
+    while first.isspace():
+      first=f.read(1)
+    f.seek(0)
 
-print(inputfile)
+    if first=='[':
+      for event in json.load(f):
+        yield (event['eventid'],event['lat'],event['lon'],event['mag'])
+    else:
+      for feature in iterFeatures(f):
+        coords=feature['geometry']['coordinates']
+        yield (feature.get('id'),coords[1],coords[0],feature['properties'].get('mag'))
 
-o=open('events.xy','w')
-with open(inputfile,'r') as f:
-  events=json.load(f)
-  print('Got events:',len(events))
+def convertFile(inputfile,outputfile):
+  """ Write the xy lines of one input file. Returns (nevents,nskipped) """
 
-  for event in events:
-      evid=event['eventid']
-      lat=event['lat']
-      lon=event['lon']
-      mag=event['mag']
-      size=getsize(mag)
+  nevents=0
+  nskip=0
+  with open(outputfile,'w') as o:
+    for (evid,lat,lon,mag) in iterEvents(inputfile):
+      nevents+=1
+      try:
+        size=getsize(mag)
+      except (TypeError,ValueError):
+        nskip+=1
+        continue
 
       line='%s %s %s' % (lon,lat,size)
       o.write(line+'\n')
 
-    
+  return (nevents,nskip)
+
+def listInputs(inputs):
+  """ Input files in order; directories are expanded to their JSON files """
+
+  files=[]
+  for name in inputs:
+    if os.path.isdir(name):
+      files.extend(os.path.join(name,filename) for filename in sorted(os.listdir(name))
+        if filename.endswith('.json') or filename.endswith('.geojson'))
+    else:
+      files.append(name)
+  return files
+
+def parseArgs():
+  parser=argparse.ArgumentParser(
+    description='Convert JSON or GeoJSON event files into an xy file of epicenters')
+
+  parser.add_argument('inputfile',type=str,nargs='+',
+    help='Event file (JSON list or GeoJSON catalog), or a directory of them')
+
+  parser.add_argument('--output',type=str,default='events.xy',
+    help='Output file. Default events.xy')
+
+  parser.add_argument('--workers',type=int,default=1,
+    help='Number of processes converting files at the same time. Default 1')
+
+  return parser.parse_args()
+
+
+if __name__=='__main__':
+
+  args=parseArgs()
+  inputfiles=listInputs(args.inputfile)
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    shards=[os.path.join(tmpdir,'shard.%i.xy' % n) for n in range(len(inputfiles))]
+
+    if args.workers>1:
+      pool=concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+    else:
+      pool=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    with pool:
+      results=pool.map(convertFile,inputfiles,shards)
+
+      for (inputfile,(nevents,nskip)) in zip(inputfiles,results):
+        print(inputfile)
+        print('Got events:',nevents)
+        if nskip:
+          print('Skipped',nskip,'events without a magnitude')
+
+    with open(args.output,'w') as o:
+      for shard in shards:
+        with open(shard,'r') as f:
+          shutil.copyfileobj(f,o)
+
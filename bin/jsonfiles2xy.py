@@ -2,53 +2,171 @@
 
 # jsonfiles2xy.py
 # Read all JSON individual entry files and convert into an xy file
-# Output is entries.xy
+# Output is entries.xy, sorted by user CDI
+#
+# The input can be a directory of entry files or a .tgz of them
+# (like raw.json.tgz), read without extracting it. Entries are read
+# one file at a time and kept in a bucket per CDI value; buckets are
+# spilled to temporary files when too many lines are held, so memory
+# stays bounded however many entries there are. With --workers, files
+# are parsed by a pool of processes and their lines added in the same
+# order as a serial run, so the output does not change.
 
 import os
 import os.path
-import sys
 import json
+import shutil
+import tempfile
+import argparse
+import concurrent.futures
 
-try:
-  inputdir=sys.argv[1]
-except:
-  print('Usage: jsonfiles2xy.py [inputdir]')
-  exit()
-
-if not os.path.isdir(inputdir):
-  print('inputdir must be a directory')
-  exit()
-
-print('Checking directory',inputdir)
-nread=0
-ngood=0
-nskip=0
-unsorted=[]
-for filename in os.listdir(inputdir):
-    fullname=inputdir+'/'+filename
-    with open(fullname,'r') as f:
+from modules.archive import ArchiveStore
+from modules.geojsonstream import iterChunks
+
+BUFFERLINES=100000  # lines held in memory before spilling to disk
+
+class CdiBuckets:
+  """
+
+    Lines grouped by CDI value, in the order they were added. Write
+    them out sorted by CDI; lines with the same CDI keep their order.
+
+  """
+
+  def __init__(self,tmpdir,bufferlines=BUFFERLINES):
+    self.tmpdir=tmpdir
+    self.bufferlines=bufferlines
+    self.buffers={}
+    self.files={}
+    self.nbuffered=0
+
+  def add(self,cdi,line):
+    self.buffers.setdefault(cdi,[]).append(line)
+    self.nbuffered+=1
+    if self.nbuffered>=self.bufferlines:
+      self.spill()
+
+  def spill(self):
+    """ Append all buffered lines to their bucket files """
+
+    for cdi,lines in self.buffers.items():
+      if cdi not in self.files:
+        self.files[cdi]=os.path.join(self.tmpdir,'cdi.%i.xy' % len(self.files))
+      with open(self.files[cdi],'a') as f:
+        f.write(''.join(line+'\n' for line in lines))
+    self.buffers={}
+    self.nbuffered=0
+
+  def write(self,o):
+    for cdi in sorted(set(self.files) | set(self.buffers)):
+      if cdi in self.files:
+        with open(self.files[cdi],'r') as f:
+          shutil.copyfileobj(f,o)
+      for line in self.buffers.get(cdi,[]):
+        o.write(line+'\n')
+
+
+def iterSources(inputpath):
+  """
+
+    Iterate over the entry files of a directory (as paths) or of a
+    .tgz (as the contents of each member)
+
+  """
+
+  if os.path.isdir(inputpath):
+    for filename in os.listdir(inputpath):
+      yield inputpath+'/'+filename
+  else:
+    for (name,data) in ArchiveStore(inputpath).iterMembers():
+      yield data
+
+
+def readEntryFile(source):
+  """
+
+    Parse one entry file (a path or its contents) into a list of
+    (cdi,line), and the number of entries read. Entries without a
+    location or CDI are left out.
+
+  """
+
+  if isinstance(source,str):
+    with open(source,'r') as f:
       entries=json.load(f)
+  else:
+    entries=json.loads(source)
+
+  lines=[]
+  for entry in entries:
+    try:
+      lat=entry['latitude']
+      lon=entry['longitude']
+      cdi=entry['user_cdi']
+      line='%s %s %s' % (lon,lat,cdi)
+      if float(cdi)!=float(cdi):
+        raise ValueError('CDI is NaN')
+      lines.append((float(cdi),line))
+    except:
+      pass
+
+  return (lines,len(entries))
+
+
+def parseArgs():
+  parser=argparse.ArgumentParser(
+    description='Convert a directory (or .tgz) of JSON entry files into an xy file sorted by CDI')
+
+  parser.add_argument('inputdir',type=str,
+    help='Directory of raw entry files, or a .tgz of them such as raw.json.tgz')
+
+  parser.add_argument('--output',type=str,default='entries.xy',
+    help='Output file. Default entries.xy')
+
+  parser.add_argument('--workers',type=int,default=1,
+    help='Number of processes parsing entry files at the same time. Default 1')
+
+  args=parser.parse_args()
+  if not os.path.isdir(args.inputdir) and not os.path.isfile(args.inputdir):
+    print('inputdir must be a directory or .tgz file')
+    exit()
+  return args
+
+
+if __name__=='__main__':
+
+  args=parseArgs()
+
+  print('Checking',args.inputdir)
+  nread=0
+  ngood=0
+  nskip=0
+  nextreport=10000
+
+  # Files are handed to the workers a batch at a time, so that only a
+  # few files' lines are waiting to be added at once
+
+  if args.workers>1:
+    pool=concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+    batchsize=args.workers*8
+  else:
+    pool=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    batchsize=1
+
+  with tempfile.TemporaryDirectory() as tmpdir, pool:
+    buckets=CdiBuckets(tmpdir)
+    for batch in iterChunks(iterSources(args.inputdir),batchsize):
+      for (lines,nentries) in pool.map(readEntryFile,batch):
+        for (cdi,line) in lines:
+          buckets.add(cdi,line)
+        nread+=nentries
+        ngood+=len(lines)
+        nskip+=nentries-len(lines)
+        if nread>=nextreport:
+          print('Got',ngood,'lines so far, skipped',nskip)
+          nextreport=(nread//10000+1)*10000
+
+    print('Got',ngood,'lines.')
 
-      for entry in entries:
-          nread+=1
-          try:
-            evid=entry['eventid']
-            lat=entry['latitude']
-            lon=entry['longitude']
-            cdi=entry['user_cdi']
-            line='%s %s %s' % (lon,lat,cdi)
-            unsorted.append([cdi,line])
-            ngood+=1
-          except:
-            nskip+=1
-          if not (nread % 10000):
-              print('Got',ngood,'lines so far, skipped',nskip)
-
-print('Got',len(unsorted),'lines.')
-
-sortedentries=sorted(unsorted,key=lambda entry: float(entry[0]))
-with open('entries.xy','w') as o:
-  for entry in sortedentries:
-    o.write(entry[1]+'\n')
-
-    
+    with open(args.output,'w') as o:
+      buckets.write(o)
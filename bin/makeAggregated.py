@@ -14,126 +14,584 @@ to produce its output.
 
 import os.path
 import json
-import shutil
-import re
-import copy
-import datetime
+import time
+import tarfile
 import argparse
+import concurrent.futures
+import numpy as np
+
+from modules.comcat import Event,setupCache,initCache
+from modules.fileio import writeAtomic
+from modules.geojsonstream import iterFeatures
+from modules.catalog import Catalog
+from modules.aggregate import aggregateEntries,compareProducts
+from modules.archive import ArchiveStore
+from modules.cellstore import CellStoreBuilder
+from modules.manifest import Manifest,checksum
+from modules.products import (DEFAULT_DIR_TEMPLATE,productName,productCellsize,
+  productFile,archiveFile,entryFile)
+from modules import instrument
 
-from modules.comcat import Event,Product
+DEFAULT_CATALOG='../output/dyfi.inducedevents.geojson'
+DEFAULT_CELLSIZES='1,10'
+MANIFEST_NAME='aggregated.manifest.jsonl'
 
-entryfiletemplate='entries/raw.%s.json'
+# Cell sizes (in km) published as ComCat products, and their shipped
+# archives. Other sizes can only be made locally with --entries.
 
-DEFAULT_1KM_DIR='../aggregated_1km'
-DEFAULT_10KM_DIR='../aggregated_10km'
-DEFAULT_CATALOG='../output/dyfi.inducedevents.geojson'
+COMCAT_CELLSIZES=(1,10)
+PRODUCT_ARCHIVES={productName(size):archiveFile(DEFAULT_DIR_TEMPLATE % size,size)
+  for size in COMCAT_CELLSIZES}
 
 def parseArgs():
   parser=argparse.ArgumentParser(
     description=descriptiontext,
     formatter_class=argparse.RawDescriptionHelpFormatter)
 
+  parser.add_argument('--cellsizes', type=str,
+    default=DEFAULT_CELLSIZES,
+    help='Comma-separated UTM cell sizes in km, e.g. 1,2,5,10,20. Coarser grids are rolled up from the finest one; sizes other than 1 and 10 need --entries. Default '+DEFAULT_CELLSIZES)
+
+  parser.add_argument('--outputdir', type=str,
+    default=DEFAULT_DIR_TEMPLATE,
+    help='Output directory for each cell size, with %%i for the size in km. Default '+DEFAULT_DIR_TEMPLATE.replace('%','%%'))
+
   parser.add_argument('--output_1km', type=str,
-    default=DEFAULT_1KM_DIR,
-    help='Output directory. Default '+DEFAULT_1KM_DIR)
+    help='Output directory for 1 km cells, instead of --outputdir')
 
   parser.add_argument('--output_10km', type=str,
-    default=DEFAULT_10KM_DIR,
-    help='Output directory. Default '+DEFAULT_10KM_DIR)
+    help='Output directory for 10 km cells, instead of --outputdir')
 
   parser.add_argument('--input',type=argparse.FileType('r'),
     default=DEFAULT_CATALOG,
     help='Specify GeoJSON event catalog. Default '+DEFAULT_CATALOG)
 
   parser.add_argument('--entries',type=str,
-    help='Specify directory of raw entry files. If not specified, download aggregated data from ComCat instead.')
+    help='Specify directory of raw entry files (raw.<evid>.json) to aggregate locally. If not specified, download aggregated data from ComCat instead.')
+
+  parser.add_argument('--archive',action='store_true',
+    help='Read and update the aggregated_<size>km.geojson.tgz archive in each output directory instead of writing one file per event. New events are held in memory and the archive is rewritten after every 64 MB of them and at the end')
+
+  parser.add_argument('--cellstore',type=str,
+    help='Also write the cells of all events into this one columnar .npz file, with an index of each event\'s cells')
+
+  parser.add_argument('--compare',action='store_true',
+    help='Compare the output files with the shipped aggregated .tgz archives')
 
   parser.add_argument('--redo',action='store_true',
     help='Overwrite preexisting data')
 
-  return parser.parse_args()
+  parser.add_argument('--resume',action='store_true',
+    help='Only redo the products that the manifest does not record as done from the current source, or whose output is missing or changed. Without this, events with existing output files are skipped')
 
+  parser.add_argument('--manifest',type=str,
+    help='Journal of the products written, for --resume. Default '+MANIFEST_NAME+' next to the output directories')
 
-if __name__=='__main__':
+  parser.add_argument('--jobs',type=int,default=1,
+    help='Number of events to download from ComCat at the same time. Default 1')
 
-  args=parseArgs()
-  redo=args.redo
+  parser.add_argument('--workers',type=int,default=1,
+    help='Number of processes to spread the per-event work over; overrides --jobs. Default 1 (no extra processes)')
 
-  if args.entries:
-    print('--entries flag not yet implemented.')
-    exit()
+  parser.add_argument('--cache',type=str,
+    help='Keep ComCat responses in this directory and reuse them on later runs')
+
+  parser.add_argument('--cache_ttl',type=float,
+    help='Hours before cached responses are revalidated with ComCat. Default: always revalidate unless the event is unchanged')
+
+  parser.add_argument('--cache_size',type=float,
+    help='Maximum cache size in MB; least recently used responses are removed first')
+
+  parser.add_argument('--report',type=str,
+    help='Write a JSON run report (stage times, ComCat requests, cache hits, per-event times) to this file')
 
-  # First read the catalog to get a list of events to extract
+  parser.add_argument('--profile',type=str,
+    help='Profile each stage with cProfile, saving <stage>.prof files in this directory')
+
+  args=parser.parse_args()
+
+  if args.resume and args.redo:
+    parser.error('--resume and --redo cannot be used together')
 
   try:
-    eventgeojson=json.load(args.input)
-    eventlist=eventgeojson['features']
-  except:
-    print('Could not read event catalog',args.input.name)
-    print('Possible malformed JSON, aborting.')
-    exit()
+    cellsizes=sorted(set(int(size) for size in args.cellsizes.split(',')))
+  except ValueError:
+    parser.error('--cellsizes must be a list of whole kilometers')
+
+  if cellsizes[0]<1 or any(size%cellsizes[0] for size in cellsizes):
+    parser.error('Each cell size must be a multiple of the smallest one')
+
+  if not args.entries and any(size not in COMCAT_CELLSIZES for size in cellsizes):
+    parser.error('ComCat only has 1 and 10 km grids; other sizes need --entries')
+
+  args.outputdirs={size:args.outputdir % size for size in cellsizes}
+  if args.output_1km and 1 in cellsizes:
+    args.outputdirs[1]=args.output_1km
+  if args.output_10km and 10 in cellsizes:
+    args.outputdirs[10]=args.output_10km
+
+  # Only the 1 and 10 km directories are shipped; make any others
+  for size,outdir in args.outputdirs.items():
+    os.makedirs(outdir,exist_ok=True)
+    if args.archive:
+      os.makedirs(os.path.dirname(archiveFile(outdir,size)),exist_ok=True)
+
+  if not args.manifest:
+    finest=os.path.normpath(args.outputdirs[cellsizes[0]])
+    args.manifest=os.path.join(os.path.dirname(finest),MANIFEST_NAME)
+
+  return args
+
+
+def initWorker(profiledir,cachesettings):
+  """ Set up a worker process; its measurements go back with each result """
 
-  print('Got',len(eventlist),'events from',args.input.name)
+  # A forked worker starts with a copy of the main process' report
+  instrument.report.reset()
+  if profiledir:
+    instrument.enableProfile(profiledir)
+  if cachesettings:
+    initCache(*cachesettings)
 
-  # For each event, download the geocoded data (if needed)
 
-  n=0
+def getOutfiles(evid,args):
+  """ Output file for each product of this event """
+
+  return {productName(size):productFile(outdir,evid,size)
+    for size,outdir in args.outputdirs.items()}
+
+
+def openArchives(args):
+  """ Archive store of each product, for --archive """
+
+  return {productName(size):ArchiveStore(archiveFile(outdir,size))
+    for size,outdir in args.outputdirs.items()}
+
+
+def needsDownload(outfiles,redo,stores=None):
+  """ Check if any product of this event is missing """
+
+  if redo:
+    return True
+
+  for whichproduct,outfile in outfiles.items():
+    if stores:
+      if os.path.basename(outfile) not in stores[whichproduct]:
+        return True
+    elif not os.path.isfile(outfile):
+      return True
+
+  # All files already exist, don't download again
+  return False
+
+
+def resumeOutfiles(evid,outfiles,updated,manifest,stores=None):
+  """ The products of this event that the manifest does not record as done """
+
+  return {whichproduct:outfile for whichproduct,outfile in outfiles.items()
+    if not manifest.isDone(evid,whichproduct,updated,stores)}
+
+
+def sourceUpdated(entryfile):
+  """ Modification time of an entry file in epoch milliseconds, or None """
+
+  try:
+    return os.stat(entryfile).st_mtime_ns//1000000
+  except OSError:
+    return None
+
+
+def fetchEvent(evid,outfiles,updated=None,save=writeAtomic,empty=None):
+  """
+
+    Download the event details and each product file of one event
+    from ComCat. Each file is written with save(outfile,bytes), and
+    empty(outfile) is called for products without any cells.
+    Returns the number of product files saved.
+
+  """
+
+  try:
+    event=Event(evid,updated=updated)
+  except:
+    print('Could not get event information from',evid)
+    return 0
+
+  products=event.getProducts('dyfi')
+  if not products:
+    print('No product found (bad JSON?) for',evid)
+    return 0
+
   nloaded=0
-  for event in eventlist:
-    n+=1
-    evid=event['id'] 
-    if event['properties']['felt']<1:
-      continue
+  for whichproduct,outfile in outfiles.items():
+    if whichproduct in products:
+      status=event.saveFile(whichproduct,outfile,save)
+      if status:
+        nloaded+=1
+        continue
+      if status is False:
+        print('No cells in',whichproduct,'for',evid)
+        if empty:
+          empty(outfile)
+        continue
+
+    # If we reach this point then something is wrong
+
+    dyficode=event.code
+    print('WARNING: Event',evid,'has no product',whichproduct)
+    print('Operator needs to rerun DYFI for event',dyficode)
+    print('DEBUG:')
+    print('./ciim.pl event=%s -fast' % dyficode)
+    break
+
+  return nloaded
+
+
+def aggregateEvent(evid,entryfile,lat,lon,outfiles,save=writeAtomic,empty=None):
+  """
+
+    Aggregate the raw entries of one event into each product's UTM
+    grid. Each file is written with save(outfile,bytes); if there
+    are no located entries, empty(outfile) is called for each product
+    instead. Returns the number of product files saved.
 
-    outfiles={
-      'dyfi_geo_1km.geojson':'%s/%s.%s.geojson' % (args.output_1km,evid,'dyfi_geo_1km'),
-      'dyfi_geo_10km.geojson':'%s/%s.%s.geojson' % (args.output_10km,evid,'dyfi_geo_10km')
-    }
+  """
 
-    redo=False
-    for whichproduct in outfiles.keys():
-      outfile=outfiles[whichproduct] 
-      if (not redo) and os.path.isfile(outfile):
-        # File already exists, don't download again
+  try:
+    with open(entryfile,'r') as f:
+      entries=json.load(f)
+  except:
+    print('Could not read entry file',entryfile,'(skipping)')
+    return 0
+
+  instrument.count('entries',len(entries))
+
+  # The finest grid is binned from the entries and the others are
+  # rolled up from it
+
+  cellsizes=[productCellsize(whichproduct)*1000 for whichproduct in outfiles]
+  results=aggregateEntries(entries,lat,lon,cellsizes)
+  if not results:
+    print('No located entries for',evid,'(skipping)')
+    for outfile in outfiles.values():
+      if empty:
+        empty(outfile)
+    return 0
+
+  nloaded=0
+  for whichproduct,outfile in outfiles.items():
+    print('Writing to',outfile)
+    data=results[productCellsize(whichproduct)*1000]
+    save(outfile,json.dumps(data,indent=2).encode('utf8'))
+    nloaded+=1
+
+  return nloaded
+
+
+def processEvent(evid,outfiles,entryfile=None,lat=None,lon=None,updated=None,
+  collect=False,report=False):
+  """
+
+    All the work for one event, either downloading its products or
+    aggregating its entries. Events are independent, so this runs in
+    a worker thread or process. Returns a small result dict, with the
+    size and checksum of each file saved in result['saved'] and the
+    products with no cells to save in result['empty']. With
+    collect, files are not written but returned in result['files']
+    so the main process can add them to an archive. With report, the
+    measurements made so far (in a worker process) are taken and
+    returned in result['report'].
+
+  """
+
+  start=time.time()
+  files={}
+  saved={}
+  nodata=[]
+  def save(outfile,data):
+    if collect:
+      files[outfile]=data
+    else:
+      writeAtomic(outfile,data)
+    saved[outfile]=(len(data),checksum(data))
+
+  if entryfile:
+    with instrument.stage('aggregate'):
+      nloaded=aggregateEvent(evid,entryfile,lat,lon,outfiles,save,nodata.append)
+  else:
+    with instrument.stage('download'):
+      nloaded=fetchEvent(evid,outfiles,updated,save,nodata.append)
+
+  result={
+    'evid':evid,
+    'nloaded':nloaded,
+    'nproducts':len(outfiles),
+    'seconds':time.time()-start,
+    'files':files,
+    'saved':saved,
+    'empty':nodata
+  }
+  if report:
+    result['report']=instrument.report.take()
+  return result
+
+
+def printSummary(results,nskipped):
+  """ Summary of the whole run, in event ID order """
+
+  results=sorted(results,key=lambda result:result['evid'])
+  incomplete=[result for result in results
+    if result['nloaded']+len(result['empty'])<result['nproducts']]
+
+  print('Summary: processed',len(results),'events, skipped',nskipped,
+    'already done, wrote',sum(result['nloaded'] for result in results),'files.')
+  if results:
+    print('Total event time %.1f s' % sum(result['seconds'] for result in results))
+  for result in incomplete:
+    print('Incomplete:',result['evid'],'got',result['nloaded'],'of',result['nproducts'],'products')
+
+
+def writeCellStore(filename,catalog,rows,args,stores=None):
+  """
+
+    Collect the output of the given catalog rows, from files or
+    archives, into one columnar cell store
+
+  """
+
+  outfiles={i:getOutfiles(catalog['id'][i],args) for i in rows}
+
+  # Archives are read in one pass rather than one member at a time
+  contents={}
+  if stores:
+    for whichproduct,store in stores.items():
+      wanted=set(os.path.basename(files[whichproduct]) for files in outfiles.values())
+      contents[whichproduct]={name:data for (name,data) in store.iterMembers()
+        if name in wanted}
+
+  builder=CellStoreBuilder()
+  nevents=0
+  for i in sorted(rows):
+    event=None
+    for whichproduct,outfile in outfiles[i].items():
+      try:
+        if stores:
+          data=json.loads(contents[whichproduct][os.path.basename(outfile)])
+        else:
+          with open(outfile,'r') as f:
+            data=json.load(f)
+      except (KeyError,OSError,ValueError):
         continue
 
-      else:
-        redo=True
-        break
+      if event is None:
+        event=builder.addEvent(catalog,i)
+        nevents+=1
+      builder.add(event,data)
 
-    if not redo:
-      continue
+  cellstore=builder.build()
+  cellstore.save(filename)
+  print('Wrote',len(cellstore),'cells of',nevents,'events to',filename)
 
-    # From this point, we know we need to download this event from ComCat
 
-    try:
-      event=Event(evid)
-    except:
-      print('Could not get event information from',evid)
-      exit()
-
-    products=event.getProducts('dyfi')
-    if not products:
-      print('No product found (bad JSON?) for',evid)
+def compareArchives(evids,args,stores=None):
+  """
+
+    Compare output files (or archive members, with stores) with the
+    shipped archive of each product. Both archives are read in one
+    pass without extracting them.
+
+  """
+
+  for whichproduct,archive in PRODUCT_ARCHIVES.items():
+    names={}
+    for evid in evids:
+      outfiles=getOutfiles(evid,args)
+      if whichproduct not in outfiles:
+        break
+      names[os.path.basename(outfiles[whichproduct])]=outfiles[whichproduct]
+    if not names:
       continue
 
-    for whichproduct in outfiles.keys():
-      if whichproduct in products:
-        if event.saveFile(whichproduct,outfile):
-          nloaded+=1
+    totals={}
+    nevents=0
+    try:
+      # Our own archive is read in one pass as well, not member by member
+
+      if stores:
+        members={name:data for (name,data) in stores[whichproduct].iterMembers()
+          if name in names}
+
+      for (name,data) in ArchiveStore(archive).iterMembers():
+        if name not in names:
           continue
- 
-      # If we reach this point then something is wrong
- 
-      dyficode=event.code
-      print('WARNING: Event',evid,'has no product',whichproduct)
-      print('Operator needs to rerun DYFI for event',dyficode)
-      print('DEBUG:')
-      print('./ciim.pl event=%s -fast' % dyficode)
-      break
 
-    print('n:',n,'event:',evid,'loaded:',nloaded)
+        if stores:
+          if name not in members:
+            continue
+          mine=json.loads(members.pop(name))
+        elif os.path.isfile(names[name]):
+          with open(names[name],'r') as f:
+            mine=json.load(f)
+        else:
+          continue
+
+        reference=json.loads(data)
+        for key,val in compareProducts(mine,reference).items():
+          if key=='maxcdidiff':
+            totals[key]=max(totals.get(key,0),val)
+          else:
+            totals[key]=totals.get(key,0)+val
+        nevents+=1
 
-        
+    except (OSError,tarfile.TarError):
+      print('Could not read',archive,'to compare')
+      continue
 
+    print('Compared',nevents,'events with',archive,':',totals)
 
+
+if __name__=='__main__':
+
+  args=parseArgs()
+  redo=args.redo
+  if args.profile:
+    instrument.enableProfile(args.profile)
+
+  # Read the catalog one event at a time into a compact Catalog
+
+  try:
+    with instrument.stage('read'):
+      catalog=Catalog.fromFeatures(iterFeatures(args.input))
+  except (ValueError,KeyError,TypeError):
+    print('Could not read event catalog',args.input.name)
+    print('Possible malformed JSON, aborting.')
+    exit()
+
+  print('Got',len(catalog),'events from',args.input.name)
+  cachesettings=setupCache(args)
+  stores=openArchives(args) if args.archive else None
+
+  # Every product written (or failed) is journaled as soon as its
+  # event finishes, so --resume can pick up after an interruption
+
+  manifest=Manifest(args.manifest)
+  if args.resume:
+    print('Resuming with',len(manifest),'products in',args.manifest,manifest.counts())
+
+  # For each felt event, download the geocoded data (if needed), or
+  # aggregate it from raw entry files. Events with the most responses
+  # take longest, so they are started first. Up to args.workers
+  # processes (or args.jobs threads) work at the same time.
+
+  felt=np.flatnonzero(catalog['felt']>=1)
+  felt=felt[np.argsort(-catalog['felt'][felt],kind='stable')]
+
+  if args.workers>1:
+    pool=concurrent.futures.ProcessPoolExecutor(max_workers=args.workers,
+      initializer=initWorker,initargs=(args.profile,cachesettings))
+  else:
+    pool=concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs,1))
+
+  nloaded=0
+  nskipped=0
+  results=[]
+  inworkers=args.workers>1
+  with instrument.stage('events'),pool:
+    futures={}
+    for i in felt:
+      n=i+1
+      evid=catalog['id'][i]
+
+      outfiles=getOutfiles(evid,args)
+      if args.entries:
+        entryfile=entryFile(args.entries,evid)
+        updated=sourceUpdated(entryfile)
+      else:
+        updated=catalog.getProperty(i,'updated')
+
+      # With --resume, only the products not done yet are made again
+
+      if args.resume:
+        outfiles=resumeOutfiles(evid,outfiles,updated,manifest,stores)
+        skip=not outfiles
+      else:
+        skip=not needsDownload(outfiles,redo,stores)
+      if skip:
+        nskipped+=1
+        continue
+
+      if args.entries:
+        future=pool.submit(processEvent,evid,outfiles,entryfile,
+          float(catalog['lat'][i]),float(catalog['lon'][i]),collect=bool(stores),
+          report=inworkers)
+
+      else:
+        # From this point, we know we need to download this event from ComCat
+
+        future=pool.submit(processEvent,evid,outfiles,updated=updated,
+          collect=bool(stores),report=inworkers)
+
+      futures[future]=(n,evid,outfiles,updated)
+
+    for future in concurrent.futures.as_completed(futures):
+      (n,evid,outfiles,updated)=futures[future]
+
+      # One failing event must not end the run; its products are
+      # journaled as failed like any incomplete event
+      try:
+        result=future.result()
+      except Exception as err:
+        print('ERROR: Event',evid,'failed:',repr(err))
+        instrument.count('events.errors')
+        result={'evid':evid,'nloaded':0,'nproducts':len(outfiles),
+          'seconds':0.0,'files':{},'saved':{},'empty':[]}
+
+      for whichproduct,outfile in outfiles.items():
+        if stores and outfile in result['files']:
+          stores[whichproduct].put(os.path.basename(outfile),result['files'].pop(outfile))
+        if outfile in result['saved']:
+          (size,sha256)=result['saved'][outfile]
+          manifest.record(evid,whichproduct,'done',outfile,size,sha256,updated)
+        elif outfile in result['empty']:
+          manifest.record(evid,whichproduct,'empty',outfile,updated=updated)
+        else:
+          manifest.record(evid,whichproduct,'failed',outfile,updated=updated)
+      if 'report' in result:
+        instrument.report.merge(result.pop('report'))
+      instrument.event(evid,result['seconds'])
+      results.append(result)
+      nloaded+=result['nloaded']
+      print('n:',n,'event:',evid,'loaded:',nloaded)
+
+  instrument.count('events.processed',len(results))
+  instrument.count('events.skipped',nskipped)
+  instrument.count('files.written',nloaded)
+
+  # Each archive is rewritten with the new and replaced events not
+  # written in a batch yet
+
+  if stores:
+    with instrument.stage('archive'):
+      for store in stores.values():
+        if store.pending:
+          print('Writing',len(store.pending),'events to',store.filename)
+        store.close()
+
+  # The journal is rewritten with one line per product
+
+  manifest.close()
+
+  printSummary(results,nskipped)
+
+  if args.cellstore:
+    with instrument.stage('cellstore'):
+      writeCellStore(args.cellstore,catalog,felt,args,stores)
+
+  if args.compare:
+    with instrument.stage('compare'):
+      compareArchives(catalog['id'],args,stores)
+
+  if args.profile:
+    instrument.writeProfiles()
+  if args.report:
+    instrument.writeReport(args.report,args)
@@ -20,8 +20,11 @@ import shutil
 import re
 import copy
 import datetime
+import numpy as np
 from geopy.distance import great_circle
 
+from modules.geo import greatCircle
+
 from DyfiMysql import Db
 
 targetMag=4.0
@@ -33,6 +36,14 @@ entryfiletemplate='entries/raw.%s.json'
 
 PRECISION=2
 
+PIILIST=('comments','name','email','phone','street','response','situation','building','zip_latitude','zip_longitude')
+DEGRADELIST=('latitude','longitude')
+
+# Batched rounding is only trusted this far from a rounding boundary;
+# closer values are rounded one by one the scalar way
+
+ROUNDING_MARGIN=1e-6
+
 db=None
 
 def getEventList(outfile):
@@ -75,25 +86,27 @@ def readExtendedTable(event):
         print('ERROR: No results found for',evid)
         exit()
 
-    entries=[]
-    for entry in results:
-        dist=getDistance(event,entry)
+    located=[]
+    dists=[]
+    for entry,dist in zip(results,getDistances(event,results)):
         if not dist:
             continue
+        located.append(entry)
+        dists.append(dist)
 
-        newentry=sanitize(entry)
+    entries=sanitizeAll(located)
+    for newentry,dist in zip(entries,dists):
         newentry['dist']=dist
-        entries.append(newentry)
 
     print('Geocoded',evid,'had',len(entries),'results.')
     return entries
 
 
 def sanitize(entry):
-    piilist=('comments','name','email','phone','street','response','situation','building','zip_latitude','zip_longitude')
+    piilist=PIILIST
     sanitized={}
 
-    degradelist=('latitude','longitude')
+    degradelist=DEGRADELIST
 
     for key,val in entry.items():
         if val is None:
@@ -112,6 +125,100 @@ def degradeVal(val):
     val=round(val,PRECISION)
     return val
 
+def sanitizeAll(entries):
+    """
+
+    Same as sanitize for a list of entries, done column by column:
+    the kept keys are worked out once for each set of columns, and
+    coordinates are degraded with one NumPy rounding per column
+
+    """
+
+    degraded={key:degradeColumn([entry.get(key) for entry in entries])
+        for key in DEGRADELIST}
+
+    keeps={}
+    sanitized=[]
+    for i,entry in enumerate(entries):
+        keys=tuple(entry.keys())
+        if keys not in keeps:
+            keeps[keys]=[key for key in keys if key not in PIILIST]
+
+        newentry={}
+        for key in keeps[keys]:
+            val=entry[key]
+            if val is None:
+                continue
+            if key in degraded:
+                val=degraded[key][i]
+            newentry[key]=val
+        sanitized.append(newentry)
+
+    return sanitized
+
+def degradeColumn(vals):
+    """ degradeVal of each value; None stays None """
+
+    out=[val if val is None or isinstance(val,(float,str)) else degradeVal(val)
+        for val in vals]
+    rows=[i for i,val in enumerate(vals) if isinstance(val,(float,str))]
+    if not rows:
+        return out
+
+    try:
+        x=np.array([float(vals[i]) for i in rows],dtype=float)
+    except ValueError:
+        return [None if val is None else degradeVal(val) for val in vals]
+
+    scaled=x*10**PRECISION
+    rounded=np.round(x,PRECISION)
+    close=np.abs(scaled-np.floor(scaled)-0.5)<ROUNDING_MARGIN
+    for k,i in enumerate(rows):
+        out[i]=degradeVal(vals[i]) if close[k] else float(rounded[k])
+    return out
+
+def getDistances(event,entries):
+    """
+
+    Same as getDistance for a list of entries. Plain coordinates are
+    done in one NumPy call; entries that need the zip code fallback
+    or have odd values, and distances too close to a rounding
+    boundary, go through getDistance.
+
+    """
+
+    dists=[None]*len(entries)
+    rows=[]
+    lats=[]
+    lons=[]
+    for i,entry in enumerate(entries):
+        lat=entry.get('latitude')
+        lon=entry.get('longitude')
+        try:
+            if lat is None or lon is None or not (lat or lon):
+                raise ValueError('needs zip fallback')
+            (lat,lon)=(float(lat),float(lon))
+            if not (abs(lat)<=90 and abs(lon)<=180):
+                raise ValueError('left to geopy to normalize')
+        except (TypeError,ValueError):
+            dists[i]=getDistance(event,entry)
+            continue
+        rows.append(i)
+        lats.append(lat)
+        lons.append(lon)
+
+    if not rows:
+        return dists
+
+    d=greatCircle(np.array(lats),np.array(lons),float(event['lat']),float(event['lon']))
+    scaled=d*10
+    rounded=np.rint(scaled)/10
+    close=np.abs(scaled-np.floor(scaled)-0.5)<ROUNDING_MARGIN
+    for k,i in enumerate(rows):
+        dists[i]=getDistance(event,entries[i]) if close[k] else float(rounded[k])
+
+    return dists
+
 def getDistance(event,entry):
 
     if 'latitude' in entry and 'longitude' in entry:
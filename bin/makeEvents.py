@@ -14,31 +14,40 @@ catalog as a base; for example, see the file 'input/catalog.json'.
 
 import os.path
 import json
-import geojson
 import shutil
 import re
 import copy
 import datetime
 import argparse
+import numpy as np
 
-from modules.comcat import Events,Event,Product
-from modules.filter import TimeFilter,SpaceFilter
-from modules.collate import readCollateFile,collateEvents
+from modules.comcat import Events,Event,Product,setupCache
+from modules.filter import BatchTimeFilter,BatchSpaceFilter
+from modules.collate import readCollateFile,collateEvents,collateEventsNumpy
+from modules.geojsonstream import iterFeatures,iterChunks,FeatureWriter
+from modules.catalog import Catalog
+from modules import instrument
 
 DEFAULT_CATALOG_FILE='../input/catalog.geojson'
 DEFAULT_COLLATE_FILE='../input/emm_c2_OK_KS.txt'
 DEFAULT_POLY_FILE='../input/polygon_is_14_ok_comb.txt'
 DEFAULT_OUT_FILE='../output/dyfi.inducedevents.geojson'
 
+FILTER_CHUNKSIZE=10000  # events read and filtered at a time
+COLLATE_PROPS=('collated','line_collated')  # set by collateEvents
+
 def parseArgs():
   parser=argparse.ArgumentParser(
     description=descriptiontext,
     formatter_class=argparse.RawDescriptionHelpFormatter)
 
-  parser.add_argument('--output', type=argparse.FileType('w'),
+  parser.add_argument('--output', type=str,
     default=DEFAULT_OUT_FILE,
     help='Output file, default is '+DEFAULT_OUT_FILE)
 
+  parser.add_argument('--update',action='store_true',
+    help='Update the existing output file with only the events added, changed or deleted in ComCat since it was made')
+
   parser.add_argument('--polyfile', type=argparse.FileType('r'),
     default=DEFAULT_POLY_FILE,
     help='Polygon spatial boundary file, default is '+DEFAULT_POLY_FILE)
@@ -51,11 +60,31 @@ def parseArgs():
     default='2003-01-01',
     help='End date, default 2017-01-01')
 
+  parser.add_argument('--jobs',type=int,default=4,
+    help='Number of ComCat time windows to query at the same time. Default 4')
+
+  parser.add_argument('--interval',type=str,
+    choices=('year','month'),default='year',
+    help='Split the ComCat query into yearly or monthly windows. Default year')
+
+  parser.add_argument('--cache',type=str,
+    help='Keep ComCat responses in this directory and reuse them on later runs')
+
+  parser.add_argument('--cache_ttl',type=float,
+    help='Hours before cached responses are revalidated with ComCat. Default: always revalidate unless the event is unchanged')
+
+  parser.add_argument('--cache_size',type=float,
+    help='Maximum cache size in MB; least recently used responses are removed first')
+
   parser.add_argument('--collate',type=argparse.FileType('r'),
     nargs='?',
     const=DEFAULT_COLLATE_FILE,
     help='collate the results with another induced events file, default is '+DEFAULT_COLLATE_FILE)
 
+  parser.add_argument('--collate_engine',type=str,
+    choices=('index','numpy'),default='index',
+    help='collation method: search a time index event by event, or evaluate blocks of candidates with NumPy. Default is index')
+
   parser.add_argument('--catalog',type=argparse.FileType('r'),
     nargs='?',
     const=DEFAULT_CATALOG_FILE,
@@ -66,27 +95,154 @@ def parseArgs():
     const=DEFAULT_CATALOG_FILE,
     help='save a custom GeoJSON catalog file from ComCat data, using the provided dates. Default is '+DEFAULT_CATALOG_FILE+'. Implies --catalog')
 
+  parser.add_argument('--report',type=str,
+    help='Write a JSON run report (stage times, ComCat requests, cache hits, counts) to this file')
+
+  parser.add_argument('--profile',type=str,
+    help='Profile each stage with cProfile, saving <stage>.prof files in this directory')
+
   print(parser.parse_args())
   return parser.parse_args()
 
 
-def loadComCat(startdate,enddate):
+def loadComCat(startdate,enddate,jobs=4,interval='year',updatedafter=None):
   '''
 
     Read the online ComCat catalog for events in the selected timespan
-    then process it into a GeoJSON file.
+    then process it into a GeoJSON file. With updatedafter, get only
+    events updated since that time (epoch milliseconds).
 
   '''
 
-  raw=Events(startdate,enddate).events
+  import geojson
+
+  catalog=Events(startdate,enddate,workers=jobs,interval=interval,
+    updatedafter=updatedafter)
+  if catalog.failed:
+    print('Could not download the full catalog, aborting.')
+    exit()
+
+  raw=catalog.events
 
   print('Loaded catalog with',len(raw),'results.')
   return geojson.FeatureCollection(raw)
 
 
+def getEventTime(event):
+  '''
+
+    Get the origin time of a catalog event in epoch milliseconds,
+    filling in the 'time' property from 'eventdatetime' if needed.
+
+  '''
+
+  p=event['properties']
+
+  if 'time' in p:
+    return p['time']
+
+  if 'eventdatetime' in p:
+    eventTime=datetime.datetime.strptime(p['eventdatetime'],'%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+    eventTime=int(eventTime)*1000
+    p['time']=eventTime
+    return eventTime
+
+  print('ERROR: Could not find event time:')
+  print(event)
+  print('Possible malformed input catalog, aborting.')
+  exit()
+
+
+def filterCatalog(features,timeFilter,spaceFilter):
+  '''
+
+    Return a Catalog of the events that pass both filters, checked
+    all at once. Deleted events (from --update) never pass.
+
+  '''
+
+  for event in features:
+    getEventTime(event)
+
+  catalog=Catalog.fromFeatures(features)
+  isIn=spaceFilter(catalog.lonlat()) & timeFilter(catalog['time'])
+  for i in np.flatnonzero(isIn):
+    if catalog.getProperty(i,'status')=='deleted':
+      isIn[i]=False
+
+  return catalog.subset(isIn)
+
+
+def loadExisting(outfile):
+  '''
+
+    Read a previous output catalog for --update and find the newest
+    'updated' time in it
+
+  '''
+
+  try:
+    with open(outfile,'r') as f:
+      existing=list(iterFeatures(f))
+  except:
+    print('Could not read existing output file',outfile)
+    print('Run without --update to create it.')
+    exit()
+
+  updates=[event['properties'].get('updated') for event in existing]
+  updates=[updated for updated in updates if updated]
+  if not updates:
+    print('No updated times in',outfile,'- run without --update.')
+    exit()
+
+  return (existing,max(updates))
+
+
+def mergeUpdate(existing,changed,filtered,collated=True):
+  '''
+
+    Merge the events changed in ComCat into the existing catalog.
+    Changed events that pass the filters replace the old ones;
+    deleted events, and changed events that no longer pass the
+    filters, are removed. Unless the changed events were collated
+    again, they keep the collate properties of the old ones. The
+    result is in time order, like the output of a full run.
+
+  '''
+
+  changedids=set(event['id'] for event in changed)
+  passed={event['id']:event for event in filtered}
+  existingids=set(event['id'] for event in existing)
+
+  merged=[]
+  nreplaced=0
+  for event in existing:
+    evid=event['id']
+    if evid not in changedids:
+      merged.append(event)
+    elif evid in passed:
+      replacement=passed[evid]
+      if not collated:
+        for prop in COLLATE_PROPS:
+          if prop in event['properties']:
+            replacement['properties'][prop]=event['properties'][prop]
+      merged.append(replacement)
+      nreplaced+=1
+
+  added=[event for event in filtered if event['id'] not in existingids]
+  merged.extend(added)
+  merged.sort(key=lambda event:event['properties'].get('time') or 0)
+
+  nremoved=len(existing)-len(merged)+len(added)
+  print('Update: added',len(added),'changed',nreplaced,'removed',nremoved)
+  return merged
+
+
 if __name__=='__main__':
 
   args=parseArgs()
+  if args.profile:
+    instrument.enableProfile(args.profile)
   startdate=args.start
   enddate=args.end
   input={}
@@ -94,74 +250,94 @@ if __name__=='__main__':
   # First, get the input list, either from ComCat or from provided
   # catalog
 
-  if args.catalog:
+  if args.update:
+    if args.catalog:
+      print('--update only works with ComCat, not with --catalog.')
+      exit()
+
+    (existing,lastupdate)=loadExisting(args.output)
+    print('Loaded',len(existing),'events from',args.output)
+    print('Reading ComCat events updated since',lastupdate)
+    setupCache(args)
+    with instrument.stage('load'):
+      input=loadComCat(startdate,enddate,args.jobs,args.interval,lastupdate)
+    features=input['features']
+
+  elif args.catalog:
     print('Loading catalog file',args.catalog.name)
-    input=json.load(args.catalog)
+    features=iterFeatures(args.catalog)
 
   else:
     print('Reading ComCat catalog.')
-    input=loadComCat(startdate,enddate)
+    setupCache(args)
+    with instrument.stage('load'):
+      features=loadComCat(startdate,enddate,args.jobs,args.interval)['features']
 
+  savewriter=None
   if args.savecatalog:
-    print('Saving ComCat catalog to',args.savecatalog.name)
-    json.dump(input,args.savecatalog,indent=2)
-
-  print('Got',len(input['features']),'events.')
+    print('Saving catalog to',args.savecatalog.name)
+    savewriter=FeatureWriter(args.savecatalog)
 
   # Then, set up the two filters: spatial (from the polygon file), and time
 
-  timeFilter=TimeFilter(startdate,enddate)
-  spaceFilter=SpaceFilter(args.polyfile)
+  timeFilter=BatchTimeFilter(startdate,enddate)
+  spaceFilter=BatchSpaceFilter(args.polyfile)
 
-  # Loop through each event and check the filters
+  # Check the filters a chunk of events at a time, so a large catalog
+  # file is never loaded all at once. Events that pass are kept in a
+  # compact Catalog.
 
-  filteredresults=[]
-  for event in input['features']:
-    if not spaceFilter(event['geometry']['coordinates']):
-      continue
+  # Reading a catalog file happens lazily in this stage too
 
-    p=event['properties']
+  nevents=0
+  passed=[]
+  with instrument.stage('filter'):
+    for chunk in iterChunks(features,FILTER_CHUNKSIZE):
+      nevents+=len(chunk)
+      if savewriter:
+        for event in chunk:
+          savewriter.write(event)
 
-    if 'time' in p:
-      eventTime=p['time']
-    elif 'eventdatetime' in p:
-      eventTime=datetime.datetime.strptime(p['eventdatetime'],'%Y-%m-%dT%H:%M:%S').replace(tzinfo=tz).timestamp()
-      eventTime=int(eventTime)*1000
-      p['time']=eventTime
-    else:
-      print('ERROR: Could not find event time:')
-      print(event)
-      print('Possible malformed input catalog, aborting.')
-      exit()
+      passed.append(filterCatalog(chunk,timeFilter,spaceFilter))
 
-    if not timeFilter(eventTime):
-      continue
+    if savewriter:
+      savewriter.close()
 
-    # At this point, this event passed both filters
-    filteredresults.append(event)
+    catalog=Catalog.concatenate(passed)
 
-  print('Got',len(filteredresults),'events passed filters.') 
+  instrument.count('events.read',nevents)
+  instrument.count('events.passed',len(catalog))
+  print('Got',nevents,'events.')
+  print('Got',len(catalog),'events passed filters.') 
 
   # Then, collate with induced file
 
   collatefile=args.collate
   if collatefile:
     print('Collating with',collatefile.name)
-    collatedata=readCollateFile(collatefile)
-    collateEvents(filteredresults,collatedata)
-
-  # Turn into proper geojson
-
-  geojsonresults={
-    'type':'FeatureCollection',
-    'features':filteredresults
-  }
-
-  # Then, print output
-
-  print('Output file',args.output.name)
-  json.dump(geojsonresults,args.output,indent=2)  
+    with instrument.stage('collate'):
+      collatedata=readCollateFile(collatefile)
+      if args.collate_engine=='numpy':
+        collateEventsNumpy(catalog,collatedata)
+      else:
+        collateEvents(catalog,collatedata)
+
+  filteredresults=catalog.features()
+  if args.update:
+    filteredresults=mergeUpdate(existing,input['features'],list(filteredresults),
+      collated=bool(collatefile))
+
+  # Then, print output as GeoJSON
+
+  print('Output file',args.output)
+  with instrument.stage('write'):
+    with FeatureWriter(args.output) as writer:
+      for event in filteredresults:
+        writer.write(event)
+
+  if args.profile:
+    instrument.writeProfiles()
+  if args.report:
+    instrument.writeReport(args.report,args)
 
   exit()
-
-
@@ -0,0 +1,181 @@
+#! /usr/bin/env python3
+
+descriptiontext="""
+makeSummary.py
+
+Write a summary table of the DYFI Induced Events Database with one
+row per event: origin, number of responses, entries within distance
+bands of the epicenter, largest and median user CDI, number of 1 km
+and 10 km aggregated cells, and whether the event was collated.
+
+Run it after makeEvents.py and makeAggregated.py (and with --entries
+if raw entry files are available). Rows are only computed again for
+events whose catalog entry, entry file or aggregated files changed
+since the last run, so rerunning after an update is quick.
+
+"""
+
+import json
+import argparse
+
+from modules.geojsonstream import iterFeatures
+from modules.catalog import Catalog
+from modules.archive import ArchiveStore
+from modules.summary import (COLUMNS,CELLSIZES,textStamp,entryStats,
+  readSummary,writeSummary)
+from modules.products import (DEFAULT_DIR_TEMPLATE,productName,productFile,
+  archiveFile,entryFile)
+
+DEFAULT_CATALOG='../output/dyfi.inducedevents.geojson'
+DEFAULT_OUTPUT='../output/dyfi.summary.csv'
+
+def parseArgs():
+  parser=argparse.ArgumentParser(
+    description=descriptiontext,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+  parser.add_argument('--input',type=str,
+    default=DEFAULT_CATALOG,
+    help='GeoJSON event catalog. Default '+DEFAULT_CATALOG)
+
+  parser.add_argument('--output',type=str,
+    default=DEFAULT_OUTPUT,
+    help='Summary table (CSV). Default '+DEFAULT_OUTPUT)
+
+  parser.add_argument('--entries',type=str,
+    help='Directory of raw entry files (raw.<evid>.json) for the entry counts and CDI statistics')
+
+  parser.add_argument('--outputdir',type=str,
+    default=DEFAULT_DIR_TEMPLATE,
+    help='Directory of the aggregated files of each cell size, with %%i for the size in km. Default '+DEFAULT_DIR_TEMPLATE.replace('%','%%'))
+
+  parser.add_argument('--archive',action='store_true',
+    help='Count cells in the aggregated_<size>km.geojson.tgz archives, as written by makeAggregated.py --archive')
+
+  parser.add_argument('--redo',action='store_true',
+    help='Summarize every event again, even if unchanged')
+
+  return parser.parse_args()
+
+
+class CellCounts:
+  """
+
+    Number of aggregated cells of each event and cell size, from
+    per-event files or archives. Archive members are read in one
+    pass, and only when a count is needed.
+
+  """
+
+  def __init__(self,args):
+    self.outputdir=args.outputdir
+    self.stores=None
+    if args.archive:
+      self.stores={size:ArchiveStore(archiveFile(args.outputdir % size,size))
+        for size in CELLSIZES}
+    self.counts=None
+
+  def stamp(self,evid,size):
+    if not self.stores:
+      return textStamp(productFile(self.outputdir % size,evid,size))
+
+    # The archive changes whenever any member does, so use the
+    # member's own size (and compressed length, if it has a gzip
+    # member of its own) instead of the archive's stamp
+
+    member=self.stores[size].index().get('%s.%s' % (evid,productName(size)))
+    if not member:
+      return '-'
+    (offset,length,coffset,clength)=member
+    return '.'.join(str(val) for val in (length,clength) if val is not None)
+
+  def count(self,evid,size):
+    """ Number of cells, or '' if the event has no file """
+
+    if not self.stores:
+      try:
+        with open(productFile(self.outputdir % size,evid,size),'r') as f:
+          return len(json.load(f)['features'])
+      except (OSError,ValueError,KeyError):
+        return ''
+
+    if self.counts is None:
+      self.counts={}
+      for storesize,store in self.stores.items():
+        for (name,data) in store.iterMembers():
+          try:
+            self.counts[(name,storesize)]=len(json.loads(data)['features'])
+          except (ValueError,KeyError):
+            pass
+
+    return self.counts.get(('%s.%s' % (evid,productName(size)),size),'')
+
+
+def summarizeEvent(catalog,i,args,cells):
+  """ Summary row of catalog event i """
+
+  evid=catalog['id'][i]
+  row={
+    'evid':evid,
+    'time':catalog.getProperty(i,'time'),
+    'mag':catalog.getProperty(i,'mag'),
+    'lat':catalog.value(i,'lat'),
+    'lon':catalog.value(i,'lon'),
+    'felt':catalog.getProperty(i,'felt'),
+    'cdi':catalog.getProperty(i,'cdi'),
+    'collated':int(catalog.getProperty(i,'collated') is not None),
+  }
+
+  if args.entries:
+    try:
+      with open(entryFile(args.entries,evid),'r') as f:
+        entries=json.load(f)
+      row.update(entryStats(entries,float(catalog['lat'][i]),float(catalog['lon'][i])))
+    except (OSError,ValueError):
+      pass
+
+  for size in CELLSIZES:
+    row['ncells_%ikm' % size]=cells.count(evid,size)
+
+  return {key:('' if row.get(key) is None else row.get(key)) for key in COLUMNS}
+
+
+if __name__=='__main__':
+
+  args=parseArgs()
+
+  try:
+    catalog=Catalog.fromFeatures(iterFeatures(args.input))
+  except (OSError,ValueError,KeyError,TypeError):
+    print('Could not read event catalog',args.input)
+    exit()
+
+  print('Got',len(catalog),'events from',args.input)
+  old={} if args.redo else readSummary(args.output)
+  cells=CellCounts(args)
+
+  # The stamp of a row records the inputs it was made from; rows of
+  # unchanged events are kept as they are
+
+  rows=[]
+  nupdated=0
+  for i in range(len(catalog)):
+    evid=catalog['id'][i]
+    stamps=[str(catalog.getProperty(i,'updated')),
+      str(catalog.getProperty(i,'line_collated'))]
+    if args.entries:
+      stamps.append(textStamp(entryFile(args.entries,evid)))
+    stamps.extend(cells.stamp(evid,size) for size in CELLSIZES)
+    stamp=':'.join(stamps)
+
+    if evid in old and old[evid]['stamp']==stamp:
+      rows.append(old[evid])
+      continue
+
+    row=summarizeEvent(catalog,i,args,cells)
+    row['stamp']=stamp
+    rows.append(row)
+    nupdated+=1
+
+  writeSummary(args.output,rows)
+  print('Wrote',len(rows),'events to',args.output,'(%i updated)' % nupdated)
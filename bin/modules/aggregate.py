@@ -0,0 +1,311 @@
+"""
+  Aggregate raw DYFI entries (as written by makeEntries.py) into UTM
+  grid cells and compute the intensity of each cell, producing the
+  same GeoJSON as the ComCat dyfi_geo_1km/dyfi_geo_10km products.
+
+  Each cell's intensity is computed the DYFI way: the questionnaire
+  indices of all responses in the cell are averaged, weighted and
+  summed into a Community Weighted Sum (CWS), and converted to CDI.
+  All entries of an event are processed at once with NumPy.
+
+"""
+
+import math
+import numpy as np
+
+from modules import utm
+from modules.geo import haversine
+
+# CWS weight of each questionnaire index. Entry fields for an index
+# are listed in ALIASES if they differ from the index name.
+
+CDI_WEIGHTS={
+  'felt':5,
+  'motion':1,
+  'reaction':1,
+  'stand':2,
+  'shelf':5,
+  'picture':2,
+  'furniture':3,
+  'damage':5,
+}
+INDICES=tuple(CDI_WEIGHTS)
+WEIGHTS=np.array([CDI_WEIGHTS[index] for index in INDICES],dtype=float)
+
+ALIASES={'furniture':('furniture','furnitude')}
+
+# Felt index from the 'other_felt' answer (did others nearby feel it)
+
+OTHER_FELT={2:0.36,3:0.72,4:1.0,5:1.0}
+
+# Damage index from the damage codes in 'd_text'; the highest wins
+
+DAMAGE_LEVELS={
+  '_none':0,
+  '_crackmin':0.5,'_crackwallfew':0.5,
+  '_crackwallmany':0.75,'_crackwall':0.75,'_crackfloor':0.75,
+  '_crackchim':0.75,'_tilesfell':0.75,
+  '_wall':1,'_pipe':1,'_foundation':1,'_chim':1,'_porch':1,
+  '_majormodernchim':1,'_tilt':1,
+  '_move':2,'_majoroldchim':2,
+  '_collapse':3,
+}
+
+def toNumber(val):
+  """ Float value of an entry field, or NaN if unanswered """
+
+  if val is None or val=='':
+    return np.nan
+  try:
+    return float(val)
+  except (TypeError,ValueError):
+    return np.nan
+
+def damageIndex(dtext):
+  if not dtext:
+    return np.nan
+
+  levels=[DAMAGE_LEVELS[code] for code in str(dtext).split() if code in DAMAGE_LEVELS]
+  if not levels:
+    return np.nan
+  return max(levels)
+
+def entryArrays(entries):
+  """
+
+    Turn a list of raw entries into arrays (lat,lon,values), where
+    values has one column per CWS index and NaN for unanswered
+    questions. Suspect entries and entries without a location are
+    left out.
+
+  """
+
+  rows=[]
+  lats=[]
+  lons=[]
+  for entry in entries:
+    if toNumber(entry.get('suspect'))>0:
+      continue
+
+    lat=toNumber(entry.get('latitude'))
+    lon=toNumber(entry.get('longitude'))
+    if np.isnan(lat) or np.isnan(lon):
+      continue
+
+    row=[]
+    for index in INDICES:
+      if index=='damage':
+        row.append(damageIndex(entry.get('d_text')))
+        continue
+
+      val=np.nan
+      for field in ALIASES.get(index,(index,)):
+        val=toNumber(entry.get(field))
+        if not np.isnan(val):
+          break
+
+      if index=='felt' and val==1:
+        otherfelt=toNumber(entry.get('other_felt'))
+        if otherfelt in OTHER_FELT:
+          val=OTHER_FELT[otherfelt]
+      row.append(val)
+
+    rows.append(row)
+    lats.append(lat)
+    lons.append(lon)
+
+  values=np.array(rows,dtype=float).reshape(-1,len(INDICES))
+  return (np.array(lats,dtype=float),np.array(lons,dtype=float),values)
+
+
+class CellSums:
+  """
+
+    Per-cell response sums on a UTM grid: the number of responses,
+    and the sum and count of answers for each CWS index. Sums of a
+    grid can be rolled up into any coarser grid whose cell size is a
+    multiple of this one, giving the same cells and intensities as
+    binning the entries again.
+
+    Northings of the southern hemisphere have a false northing added,
+    so they overlap those of the north; 'south' tells each cell's
+    hemisphere and is part of its key.
+
+  """
+
+  def __init__(self,cellsize,zone,south,east,north,nresp,sums,counts):
+    self.cellsize=cellsize
+    self.zone=zone
+    self.south=south
+    self.east=east
+    self.north=north
+    self.nresp=nresp
+    self.sums=sums
+    self.counts=counts
+
+  @classmethod
+  def fromEntries(cls,lat,lon,values,cellsize):
+    """ Bin entry locations into cells of cellsize meters """
+
+    (easting,northing,zone)=utm.fromLatLon(lat,lon)
+    east=np.floor(easting/cellsize).astype(np.int64)
+    north=np.floor(northing/cellsize).astype(np.int64)
+    answered=~np.isnan(values)
+
+    return cls.group(cellsize,zone,np.asarray(lat)<0,east,north,
+      np.ones(len(lat),dtype=np.int64),
+      np.where(answered,values,0.0),answered.astype(np.int64))
+
+  @classmethod
+  def group(cls,cellsize,zone,south,east,north,nresp,sums,counts):
+    """ Add up rows that fall in the same cell """
+
+    keys=np.column_stack((zone,south,east,north)).astype(np.int64).reshape(-1,4)
+    (cells,inverse)=np.unique(keys,axis=0,return_inverse=True)
+    inverse=inverse.reshape(-1)
+
+    ncells=len(cells)
+    cellnresp=np.zeros(ncells,dtype=np.int64)
+    cellsums=np.zeros((ncells,sums.shape[1]))
+    cellcounts=np.zeros((ncells,counts.shape[1]),dtype=np.int64)
+    np.add.at(cellnresp,inverse,nresp)
+    np.add.at(cellsums,inverse,sums)
+    np.add.at(cellcounts,inverse,counts)
+
+    return cls(cellsize,cells[:,0],cells[:,1].astype(bool),cells[:,2],cells[:,3],
+      cellnresp,cellsums,cellcounts)
+
+  def rollup(self,cellsize):
+    """ Sums on a coarser grid, from this grid's sums """
+
+    if cellsize==self.cellsize:
+      return self
+    if cellsize%self.cellsize:
+      raise ValueError('Cell size %i is not a multiple of %i' % (cellsize,self.cellsize))
+
+    factor=cellsize//self.cellsize
+    return CellSums.group(cellsize,self.zone,self.south,self.east//factor,self.north//factor,
+      self.nresp,self.sums,self.counts)
+
+  def __len__(self):
+    return len(self.nresp)
+
+  def cdi(self):
+    """ CDI of each cell from the mean answer of each index """
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+      means=np.where(self.counts>0,self.sums/np.maximum(self.counts,1),0.0)
+      cws=means@WEIGHTS
+      cdi=np.where(cws>0,3.40*np.log(np.maximum(cws,1e-12))-4.38,1.0)
+
+    cdi=np.maximum(cdi,1.0)
+    felt=means[:,INDICES.index('felt')]>0
+    cdi=np.where(felt & (cdi<2),2.0,cdi)
+    return np.round(cdi,1)
+
+  def centers(self):
+    """ (lat,lon) of each cell center """
+
+    size=self.cellsize
+    return utm.toLatLon((self.east+0.5)*size,(self.north+0.5)*size,
+      self.zone,self.south)
+
+  def corners(self):
+    """ (lat,lon) arrays of shape (ncells,4): SW, SE, NE, NW corners """
+
+    size=self.cellsize
+    e0=self.east*size
+    n0=self.north*size
+    eastings=np.column_stack((e0,e0+size,e0+size,e0))
+    northings=np.column_stack((n0,n0,n0+size,n0+size))
+    return utm.toLatLon(eastings,northings,self.zone[:,None],self.south[:,None])
+
+  def names(self,clat):
+    """ DYFI cell names, e.g. 'UTM:(14S 0645 3955 1000)' """
+
+    size=self.cellsize
+    width=len(str(int(9999999//size)))
+    bands=utm.bandOf(clat)
+    return ['UTM:(%i%s %0*i %0*i %i)' % (zone,band,width,east,width,north,size)
+      for zone,band,east,north in zip(self.zone,bands,self.east,self.north)]
+
+  def toGeoJSON(self,epilat,epilon):
+    """ FeatureCollection in the format of the ComCat dyfi_geo products """
+
+    (clat,clon)=self.centers()
+    (lats,lons)=self.corners()
+    cdis=self.cdi()
+    dists=haversine(clat,clon,epilat,epilon)
+    names=self.names(clat)
+
+    features=[]
+    for i in np.argsort(names,kind='stable'):
+      cdi=float(cdis[i])
+      if cdi==math.floor(cdi):
+        cdi=int(cdi)
+
+      features.append({
+        'geometry':{
+          'coordinates':[[[round(float(lon),5),round(float(lat),5)]
+            for lat,lon in zip(lats[i],lons[i])]],
+          'type':'Polygon'
+        },
+        'type':'Feature',
+        'properties':{
+          'nresp':int(self.nresp[i]),
+          'name':'%s<br>%s' % (names[i],names[i]),
+          'cdi':cdi,
+          'dist':int(round(float(dists[i])))
+        }
+      })
+
+    return {'features':features,'type':'FeatureCollection'}
+
+
+def aggregateEntries(entries,epilat,epilon,cellsizes):
+  """
+
+    Aggregate a list of raw entries for one event into each of the
+    given cell sizes (in meters). Entries are binned once into the
+    finest grid, and coarser grids are rolled up from its sums.
+    Returns a dict of FeatureCollections keyed by cell size, or None
+    if no entry could be located.
+
+  """
+
+  (lat,lon,values)=entryArrays(entries)
+  if not len(lat):
+    return None
+
+  finest=CellSums.fromEntries(lat,lon,values,min(cellsizes))
+  return {cellsize:finest.rollup(cellsize).toGeoJSON(epilat,epilon)
+    for cellsize in cellsizes}
+
+
+def compareProducts(mine,reference):
+  """
+
+    Compare two FeatureCollections of aggregated cells, matched by
+    UTM cell name. Returns a dict of counts and the largest CDI
+    difference.
+
+  """
+
+  def cells(data):
+    return {feature['properties']['name'].split('<br>')[0]:feature['properties']
+      for feature in data['features']}
+
+  mycells=cells(mine)
+  refcells=cells(reference)
+  common=set(mycells) & set(refcells)
+
+  return {
+    'matched':len(common),
+    'onlymine':len(mycells)-len(common),
+    'onlyreference':len(refcells)-len(common),
+    'nrespdiff':sum(1 for name in common
+      if mycells[name]['nresp']!=refcells[name]['nresp']),
+    'maxcdidiff':max([abs(mycells[name]['cdi']-refcells[name]['cdi'])
+      for name in common] or [0]),
+  }
+
@@ -0,0 +1,255 @@
+"""
+  Use a .tgz archive of per-event files (like the shipped
+  aggregated_1km.geojson.tgz) directly as a file store, without
+  extracting it.
+
+  Archives written here compress each tar member in a gzip member of
+  its own. The file is still an ordinary .tgz (gzip streams can be
+  concatenated), but one member can be read by seeking to its gzip
+  member and decompressing just that. Archives written by other tools
+  are one gzip stream, so a member can only be reached by
+  decompressing from the start; they are converted the first time
+  they are rewritten.
+
+  Members are found through an index of their offsets, built once and
+  kept next to the archive, keyed on the archive's size and
+  modification time. New or replaced members are held in memory and
+  written in batches: each batch rewrites the archive in one pass,
+  copying unchanged members without recompressing them, and renames
+  it into place.
+
+"""
+
+import os
+import json
+import gzip
+import time
+import zlib
+import tarfile
+
+from modules.fileio import writeAtomic
+
+INDEXSUFFIX='.index.json'
+MAXPENDING=64*1024*1024     # bytes of new members held before a rewrite
+
+class ArchiveStore:
+  """
+
+    A .tgz archive of files, read and updated by member name. The
+    archive does not need to exist yet. Use as a context manager, or
+    call close() to write pending changes. Pending members are also
+    written whenever they add up to more than maxpending bytes.
+
+  """
+
+  def __init__(self,filename,maxpending=MAXPENDING):
+    self.filename=filename
+    self.indexfile=filename+INDEXSUFFIX
+    self.maxpending=maxpending
+    self.pending={}
+    self.pendingsize=0
+    self.members=None
+
+  def stamp(self):
+    """ Size and modification time of the archive, or None if missing """
+
+    try:
+      stat=os.stat(self.filename)
+    except OSError:
+      return None
+    return [stat.st_size,stat.st_mtime_ns]
+
+  def index(self):
+    """
+
+      Dict of member name to (data offset, size, gzip member offset,
+      gzip member length), built once. Members with a gzip member of
+      their own have their data offset counted from its start;
+      members of a single-stream archive have no gzip member (None)
+      and the offset in the whole uncompressed stream.
+
+    """
+
+    if self.members is not None:
+      return self.members
+
+    stamp=self.stamp()
+    if stamp is None:
+      self.members={}
+      return self.members
+
+    try:
+      with open(self.indexfile,'r') as f:
+        saved=json.load(f)
+      if saved['stamp']==stamp:
+        # Indexes saved before gzip members were used have no block
+        self.members={name:tuple(val)+(None,None)*(len(val)==2)
+          for name,val in saved['members'].items()}
+        return self.members
+    except (OSError,ValueError,KeyError):
+      pass
+
+    # Only the tar headers are parsed; member data is skipped over.
+    # Without the saved index the gzip members are not known, so
+    # offsets are taken in the whole stream.
+
+    members={}
+    with tarfile.open(self.filename,'r:gz') as tar:
+      for member in tar:
+        if member.isfile():
+          members[member.name]=(member.offset_data,member.size,None,None)
+
+    self.members=members
+    self.saveIndex()
+    return members
+
+  def saveIndex(self):
+    data={'stamp':self.stamp(),'members':self.members}
+    try:
+      writeAtomic(self.indexfile,json.dumps(data).encode('utf8'))
+    except OSError:
+      print('Could not save archive index',self.indexfile)
+
+  def names(self):
+    """ Sorted names of all members, including pending ones """
+
+    return sorted(set(self.index()) | set(self.pending))
+
+  def __contains__(self,name):
+    return name in self.pending or name in self.index()
+
+  def __len__(self):
+    return len(self.names())
+
+  def read(self,name):
+    """
+
+      Contents of one member as bytes. Raises KeyError if missing.
+      Only the member's own gzip member is decompressed; in a
+      single-stream archive, everything before the member is too, so
+      use iterMembers() to read many members of such an archive.
+
+    """
+
+    if name in self.pending:
+      return self.pending[name]
+
+    (offset,size,coffset,clength)=self.index()[name]
+    if coffset is None:
+      with gzip.open(self.filename,'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+    with open(self.filename,'rb') as f:
+      f.seek(coffset)
+      block=zlib.decompress(f.read(clength),wbits=31)
+    return block[offset:offset+size]
+
+  def iterMembers(self):
+    """ Iterate over (name,bytes) of all members in one pass """
+
+    # Stream mode ('r|gz') stops after the first gzip member, so the
+    # archive is read as a file, in order
+
+    seen=set()
+    if self.stamp() is not None:
+      with tarfile.open(self.filename,'r:gz') as tar:
+        for member in tar:
+          if not member.isfile():
+            continue
+          seen.add(member.name)
+          if member.name in self.pending:
+            yield (member.name,self.pending[member.name])
+          else:
+            yield (member.name,tar.extractfile(member).read())
+
+    for name in sorted(self.pending):
+      if name not in seen:
+        yield (name,self.pending[name])
+
+  def put(self,name,data):
+    """ Add or replace a member; written by close(), or once enough are pending """
+
+    self.pendingsize+=len(data)-len(self.pending.get(name,b''))
+    self.pending[name]=data
+    if self.pendingsize>self.maxpending:
+      self.flush()
+
+  def flush(self):
+    """ Rewrite the archive with all pending members """
+
+    if not self.pending:
+      return
+
+    tmpfile='%s.tmp.%i' % (self.filename,os.getpid())
+    members={}
+
+    def newInfo(name,data):
+      info=tarfile.TarInfo(name)
+      info.size=len(data)
+      info.mtime=time.time()
+      info.mode=0o644
+      return info
+
+    def add(out,info,data):
+      header=info.tobuf(tarfile.PAX_FORMAT,'utf-8','surrogateescape')
+      padding=b'\0'*(-len(data) % tarfile.BLOCKSIZE)
+      copy(out,info.name,len(header),len(data),
+        gzip.compress(header+data+padding,mtime=0))
+
+    def copy(out,name,offset,size,block):
+      members[name]=(offset,size,out.tell(),len(block))
+      out.write(block)
+
+    # Unchanged members are copied as they are (their gzip member
+    # without recompressing, if they have one of their own), and
+    # replaced members keep their place in the archive
+
+    index=self.index()
+    with open(tmpfile,'wb') as out:
+      if self.stamp() is not None:
+        with open(self.filename,'rb') as f:
+          if all(val[2] is not None for val in index.values()):
+            for name in sorted(index,key=lambda name:index[name][2]):
+              if name in self.pending:
+                add(out,newInfo(name,self.pending[name]),self.pending[name])
+                continue
+              (offset,size,coffset,clength)=index[name]
+              f.seek(coffset)
+              copy(out,name,offset,size,f.read(clength))
+
+          else:
+            with tarfile.open(fileobj=f,mode='r:gz') as tar:
+              for member in tar:
+                if not member.isfile():
+                  continue
+                if member.name in self.pending:
+                  data=self.pending[member.name]
+                  add(out,newInfo(member.name,data),data)
+                else:
+                  add(out,member,tar.extractfile(member).read())
+
+      for name in sorted(self.pending):
+        if name not in members:
+          data=self.pending[name]
+          add(out,newInfo(name,data),data)
+
+      # End of archive: two empty tar blocks
+      out.write(gzip.compress(b'\0'*2*tarfile.BLOCKSIZE,mtime=0))
+
+    os.replace(tmpfile,self.filename)
+    self.pending={}
+    self.pendingsize=0
+    self.members=members
+    self.saveIndex()
+
+  def close(self):
+    """ Write all pending members """
+
+    self.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exctype,exc,tb):
+    self.close()
@@ -0,0 +1,282 @@
+"""
+  A compact in-memory event catalog. The numeric origin and DYFI
+  values of each event are kept in typed columns of a NumPy
+  structured array instead of a GeoJSON dict-of-dicts, so that
+  filters, collation and scheduling can work on whole columns.
+  Events can be converted back to exactly the GeoJSON features
+  they were made from.
+
+"""
+
+import sys
+import math
+import numpy as np
+
+# Typed columns. Each is either a property or a coordinate index.
+
+COLUMNS=(
+  ('time',np.int64,'time'),
+  ('mag',np.float64,'mag'),
+  ('lon',np.float64,0),
+  ('lat',np.float64,1),
+  ('depth',np.float64,2),
+  ('felt',np.int64,'felt'),
+  ('cdi',np.float64,'cdi'),
+  ('updated',np.int64,'updated'),
+)
+
+PROPCOLUMNS={source:name for (name,dtype,source) in COLUMNS if isinstance(source,str)}
+
+DTYPE=np.dtype([('id',object)]
+  +[(name,dtype) for (name,dtype,source) in COLUMNS]
+  +[('flags',np.uint16)])
+
+# Each column has two flag bits: the value was null (None or missing),
+# and the value had the other JSON number type (int in a float column
+# or float in an int column), so it can be written back the same way
+
+NULLBIT={name:1<<(2*k) for k,(name,dtype,source) in enumerate(COLUMNS)}
+TYPEBIT={name:1<<(2*k+1) for k,(name,dtype,source) in enumerate(COLUMNS)}
+ISFLOAT={name:np.dtype(dtype).kind=='f' for (name,dtype,source) in COLUMNS}
+
+INT64_RANGE=(-2**63,2**63)
+
+def encodeValue(name,val):
+  """
+
+    (column value,flags,keep) of a value for a column. Numeric strings
+    are converted the way the scalar code does (int() or float()), so
+    that filters and collation see their value. Values a column cannot
+    give back exactly (strings, booleans, ints out of the int64 range,
+    fractional floats in an int column, ...) have keep set: the caller
+    keeps the raw value in the event's extra properties under
+    ('raw',name). Those that cannot be converted also get the null
+    flag and leave the column empty.
+
+  """
+
+  fill=np.nan if ISFLOAT[name] else 0
+  if val is None:
+    return (fill,NULLBIT[name],False)
+
+  if isinstance(val,str):
+    try:
+      number=float(val) if ISFLOAT[name] else int(val)
+    except ValueError:
+      return (fill,NULLBIT[name],True)
+    (colval,flags,keep)=encodeValue(name,number)
+    return (colval,flags & NULLBIT[name],True)
+
+  if isinstance(val,bool) or not isinstance(val,(int,float)):
+    return (fill,NULLBIT[name],True)
+
+  try:
+    if ISFLOAT[name]:
+      exact=isinstance(val,float) or float(val)==val
+    elif isinstance(val,int):
+      exact=INT64_RANGE[0]<=val<INT64_RANGE[1]
+    else:
+      exact=(val.is_integer() and INT64_RANGE[0]<=val<INT64_RANGE[1]
+        and math.copysign(1,val)>0)
+  except OverflowError:
+    exact=False
+
+  if not exact:
+    return (fill,NULLBIT[name],True)
+  if isinstance(val,float)!=ISFLOAT[name]:
+    return (val,TYPEBIT[name],False)
+  return (val,0,False)
+
+
+class Catalog:
+  """
+
+    Columnar event catalog. self.data is a structured array with
+    the columns above; self.extra holds the remaining (mostly text)
+    properties of each event, and raw values that do not fit their
+    column (see encodeValue), and self.layouts the key order of each
+    feature, shared between events with the same keys.
+
+  """
+
+  def __init__(self,data,extra,layouts):
+    self.data=data
+    self.extra=extra
+    self.layouts=layouts
+
+  @classmethod
+  def fromFeatures(cls,features):
+    """ Build a catalog from an iterable of GeoJSON Point features """
+
+    rows=[]
+    extra=[]
+    layouts=[]
+    shared={}
+
+    for feature in features:
+      p=feature['properties']
+      geometry=feature['geometry']
+      coords=geometry['coordinates']
+
+      row=[feature.get('id')]
+      flags=0
+      raw={}
+      for (name,dtype,source) in COLUMNS:
+        if isinstance(source,str):
+          val=p.get(source)
+        else:
+          val=coords[source] if source<len(coords) else None
+
+        (colval,colflags,keep)=encodeValue(name,val)
+        if keep:
+          raw[('raw',name)]=val
+        row.append(colval)
+        flags|=colflags
+      row.append(flags)
+      rows.append(tuple(row))
+
+      # Short strings like 'earthquake' or 'reviewed' repeat for most
+      # events, so keep only one copy of each
+
+      others={key:(sys.intern(val) if isinstance(val,str) and len(val)<=16 else val)
+        for key,val in p.items() if key not in PROPCOLUMNS}
+      for key,val in feature.items():
+        if key not in ('id','type','properties','geometry'):
+          others[('feature',key)]=val
+      others.update(raw)
+      if feature.get('type')!='Feature':
+        others[('feature','type')]=feature.get('type')
+      for key,val in geometry.items():
+        if key!='coordinates' and not (key=='type' and val=='Point'):
+          others[('geometry',key)]=val
+      extra.append(others)
+
+      layout=(tuple(feature.keys()),tuple(p.keys()),tuple(geometry.keys()))
+      layouts.append(shared.setdefault(layout,layout))
+
+    return cls(np.array(rows,dtype=DTYPE),extra,layouts)
+
+  @classmethod
+  def concatenate(cls,catalogs):
+    """ Join several catalogs into one """
+
+    catalogs=list(catalogs)
+    if not catalogs:
+      return cls.fromFeatures([])
+
+    data=np.concatenate([catalog.data for catalog in catalogs])
+    extra=[]
+    layouts=[]
+    for catalog in catalogs:
+      extra.extend(catalog.extra)
+      layouts.extend(catalog.layouts)
+    return cls(data,extra,layouts)
+
+  def __len__(self):
+    return len(self.data)
+
+  def __getitem__(self,column):
+    """ Return a whole column, e.g. catalog['time'] """
+
+    return self.data[column]
+
+  def subset(self,selection):
+    """ New catalog with the events selected by a boolean mask or index array """
+
+    selection=np.asarray(selection)
+    if selection.dtype==bool:
+      selection=np.flatnonzero(selection)
+
+    return Catalog(self.data[selection],
+      [self.extra[i] for i in selection],
+      [self.layouts[i] for i in selection])
+
+  def lonlat(self):
+    """ Nx2 array of epicenters, as taken by BatchSpaceFilter """
+
+    return np.column_stack((self.data['lon'],self.data['lat']))
+
+  def isnull(self,column):
+    """ Boolean mask of events with no numeric value in this column """
+
+    return (self.data['flags'] & NULLBIT[column])!=0
+
+  def value(self,i,column):
+    """ Value of one column for one event, as it appeared in GeoJSON """
+
+    row=self.data[i]
+    flags=row['flags']
+    raw=self.extra[i].get(('raw',column))
+    if raw is not None or flags & NULLBIT[column]:
+      return raw
+
+    val=row[column]
+    if ISFLOAT[column]!=bool(flags & TYPEBIT[column]):
+      return float(val)
+    return int(val)
+
+  def getProperty(self,i,key):
+    if key in PROPCOLUMNS:
+      return self.value(i,PROPCOLUMNS[key])
+    return self.extra[i].get(key)
+
+  def setProperty(self,i,key,val):
+    """ Set a property of one event, adding it if needed """
+
+    if key in PROPCOLUMNS:
+      column=PROPCOLUMNS[key]
+      (colval,colflags,keep)=encodeValue(column,val)
+      self.extra[i].pop(('raw',column),None)
+      if keep:
+        self.extra[i][('raw',column)]=val
+      flags=int(self.data['flags'][i]) & ~(NULLBIT[column]|TYPEBIT[column])
+      self.data[column][i]=colval
+      self.data['flags'][i]=flags|colflags
+    else:
+      self.extra[i][key]=val
+
+    (featurekeys,propkeys,geomkeys)=self.layouts[i]
+    if key not in propkeys:
+      self.layouts[i]=(featurekeys,propkeys+(key,),geomkeys)
+
+  def feature(self,i):
+    """ Rebuild the GeoJSON feature of one event """
+
+    (featurekeys,propkeys,geomkeys)=self.layouts[i]
+    extra=self.extra[i]
+
+    props={}
+    for key in propkeys:
+      props[key]=self.getProperty(i,key)
+
+    coords=[self.value(i,'lon'),self.value(i,'lat')]
+    depth=self.value(i,'depth')
+    if depth is not None:
+      coords.append(depth)
+
+    geometry={}
+    for key in geomkeys:
+      if key=='coordinates':
+        geometry[key]=coords
+      else:
+        geometry[key]=extra.get(('geometry',key),'Point')
+
+    feature={}
+    for key in featurekeys:
+      if key=='properties':
+        feature[key]=props
+      elif key=='geometry':
+        feature[key]=geometry
+      elif key=='id':
+        feature[key]=self.data['id'][i]
+      else:
+        feature[key]=extra.get(('feature',key),'Feature')
+
+    return feature
+
+  def features(self):
+    """ Iterate over the events as GeoJSON features """
+
+    for i in range(len(self)):
+      yield self.feature(i)
+
@@ -0,0 +1,279 @@
+"""
+  All aggregated cells of all events in one columnar file.
+
+  The per-event dyfi_geo GeoJSON files repeat each cell's rectangle as
+  float text. Here every cell is one row of typed columns (UTM zone,
+  easting and northing in cells, cell size, center, nresp, cdi, dist),
+  sorted by event and cell size, with an index of where each event's
+  cells start and stop. The file is an uncompressed .npz, so each
+  column can be memory-mapped instead of read.
+
+  For example, all 1 km cells within 20 km of events of M3 or more:
+
+    store=CellStore.load('cells.npz')
+    cells=store.cells(store.events['mag']>=3,cellsize=1000)
+    near=cells['dist']<=20
+
+"""
+
+import re
+import zipfile
+import numpy as np
+
+from modules import utm
+
+# Columns of the cell table; 'event' is a row of the event table
+
+CELL_COLUMNS=(
+  ('event',np.int32),
+  ('cellsize',np.int32),
+  ('zone',np.int16),
+  ('band','S1'),
+  ('east',np.int32),
+  ('north',np.int32),
+  ('lat',np.float64),
+  ('lon',np.float64),
+  ('nresp',np.int32),
+  ('cdi',np.float64),
+  ('dist',np.int32),
+)
+
+EVENT_COLUMNS=(
+  ('evid',str),
+  ('time',np.int64),
+  ('mag',np.float64),
+  ('lat',np.float64),
+  ('lon',np.float64),
+  ('depth',np.float64),
+)
+
+# One row per event and cell size: cells[start:stop] are its cells
+
+INDEX_COLUMNS=(
+  ('event',np.int32),
+  ('cellsize',np.int32),
+  ('start',np.int64),
+  ('stop',np.int64),
+)
+
+CELLNAME=re.compile(r'UTM:\((\d+)([A-Z]) (\d+) (\d+) (\d+)\)')
+
+
+def parseCells(data):
+  """
+
+    Columns of the cells in one dyfi_geo FeatureCollection, from the
+    UTM cell names, e.g. 'UTM:(14S 0645 3955 1000)<br>...'. Features
+    without a UTM name are left out.
+
+  """
+
+  rows=[]
+  for feature in data['features']:
+    p=feature['properties']
+    match=CELLNAME.match(p.get('name') or '')
+    if not match:
+      continue
+    (zone,band,east,north,size)=match.groups()
+    rows.append((int(size),int(zone),band,int(east),int(north),
+      p['nresp'],p['cdi'],p['dist']))
+
+  columns={}
+  for k,name in enumerate(('cellsize','zone','band','east','north','nresp','cdi','dist')):
+    columns[name]=np.array([row[k] for row in rows],
+      dtype=dict(CELL_COLUMNS)[name]).reshape(-1)
+
+  south=columns['band']<b'N'
+  (columns['lat'],columns['lon'])=utm.toLatLon(
+    (columns['east']+0.5)*columns['cellsize'],
+    (columns['north']+0.5)*columns['cellsize'],
+    columns['zone'],south)
+  return columns
+
+
+def openNpz(filename,mmap=True):
+  """
+
+    Dict of the arrays in an .npz file. Arrays stored without
+    compression are memory-mapped, the others are read.
+
+  """
+
+  arrays={}
+  loaded=np.load(filename,allow_pickle=False)
+  with zipfile.ZipFile(filename) as z, open(filename,'rb') as f:
+    for info in z.infolist():
+      name=info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+      if not mmap or info.compress_type!=zipfile.ZIP_STORED:
+        arrays[name]=loaded[name]
+        continue
+
+      # Skip the local zip header, then the .npy header
+      f.seek(info.header_offset)
+      header=f.read(30)
+      f.seek(info.header_offset+30
+        +int.from_bytes(header[26:28],'little')
+        +int.from_bytes(header[28:30],'little'))
+      version=np.lib.format.read_magic(f)
+      if version==(1,0):
+        (shape,fortran,dtype)=np.lib.format.read_array_header_1_0(f)
+      else:
+        (shape,fortran,dtype)=np.lib.format.read_array_header_2_0(f)
+      if dtype.hasobject:
+        arrays[name]=loaded[name]
+        continue
+      arrays[name]=np.memmap(filename,dtype=dtype,mode='r',offset=f.tell(),
+        shape=shape,order='F' if fortran else 'C')
+
+  loaded.close()
+  return arrays
+
+
+class CellStore:
+  """
+
+    Columnar store of aggregated cells. self.events, self.index and
+    self.cellcolumns are dicts of column arrays for the event table,
+    the per-event index and the cell table.
+
+  """
+
+  def __init__(self,events,index,cellcolumns):
+    self.events=events
+    self.index=index
+    self.cellcolumns=cellcolumns
+
+  @classmethod
+  def load(cls,filename,mmap=True):
+    arrays=openNpz(filename,mmap)
+    def table(prefix,columns):
+      return {name:arrays[prefix+name] for (name,dtype) in columns}
+
+    return cls(table('event_',EVENT_COLUMNS),table('index_',INDEX_COLUMNS),
+      table('cell_',CELL_COLUMNS))
+
+  def save(self,filename):
+    """ Write the store as one uncompressed .npz file """
+
+    arrays={}
+    for prefix,table in (('event_',self.events),('index_',self.index),
+      ('cell_',self.cellcolumns)):
+      for name,column in table.items():
+        arrays[prefix+name]=np.asarray(column)
+
+    with open(filename,'wb') as f:
+      np.savez(f,**arrays)
+
+  def __len__(self):
+    return len(self.cellcolumns['event'])
+
+  def findEvent(self,evid):
+    """ Row of an event in the event table, or None """
+
+    rows=np.flatnonzero(self.events['evid']==evid)
+    return int(rows[0]) if len(rows) else None
+
+  def slices(self,events=None,cellsize=None):
+    """ (start,stop) of the cells of the selected events """
+
+    keep=np.ones(len(self.index['event']),dtype=bool)
+    if events is not None:
+      events=np.asarray(events)
+      if events.dtype==bool:
+        events=np.flatnonzero(events)
+      keep&=np.isin(self.index['event'],events)
+    if cellsize is not None:
+      keep&=self.index['cellsize']==cellsize
+
+    return list(zip(self.index['start'][keep],self.index['stop'][keep]))
+
+  def cells(self,events=None,cellsize=None,columns=None):
+    """
+
+      Dict of cell columns for the selected events (a boolean mask or
+      rows of the event table) and cell size in meters. A single
+      event comes straight out of the memory-mapped columns.
+
+    """
+
+    slices=self.slices(events,cellsize)
+    columns=columns or [name for (name,dtype) in CELL_COLUMNS]
+
+    out={}
+    for name in columns:
+      column=self.cellcolumns[name]
+      if len(slices)==1:
+        (start,stop)=slices[0]
+        out[name]=column[start:stop]
+      else:
+        out[name]=np.concatenate([column[0:0]]
+          +[column[start:stop] for (start,stop) in slices])
+    return out
+
+  def eventCells(self,evid,cellsize):
+    """ Cell columns of one event and cell size, or None if not found """
+
+    row=self.findEvent(evid)
+    if row is None:
+      return None
+    return self.cells([row],cellsize)
+
+
+class CellStoreBuilder:
+  """
+
+    Collect the aggregated products of each event, then build a
+    CellStore. Events are added from a Catalog row; products with
+    add(). Cells end up sorted by event, then cell size.
+
+  """
+
+  def __init__(self):
+    self.eventrows=[]
+    self.blocks=[]
+
+  def addEvent(self,catalog,i):
+    """ Add event i of a Catalog; returns its row """
+
+    self.eventrows.append((str(catalog['id'][i]),)
+      +tuple(catalog[name][i] for (name,dtype) in EVENT_COLUMNS[1:]))
+    return len(self.eventrows)-1
+
+  def add(self,event,data):
+    """ Add the cells of one dyfi_geo FeatureCollection of an event row """
+
+    columns=parseCells(data)
+    for cellsize in np.unique(columns['cellsize']):
+      mask=columns['cellsize']==cellsize
+      self.blocks.append((event,int(cellsize),
+        {name:column[mask] for name,column in columns.items()}))
+
+  def build(self):
+    events={}
+    for k,(name,dtype) in enumerate(EVENT_COLUMNS):
+      events[name]=np.array([row[k] for row in self.eventrows],
+        dtype=dtype if dtype is not str else None)
+    if not self.eventrows:
+      events['evid']=np.array([],dtype='U1')
+
+    blocks=sorted(self.blocks,key=lambda block:block[0:2])
+    counts=np.array([len(block[2]['zone']) for block in blocks],dtype=np.int64)
+    stops=np.cumsum(counts)
+    index={
+      'event':np.array([block[0] for block in blocks],dtype=np.int32),
+      'cellsize':np.array([block[1] for block in blocks],dtype=np.int32),
+      'start':stops-counts,
+      'stop':stops,
+    }
+
+    cellcolumns={}
+    for (name,dtype) in CELL_COLUMNS:
+      if name=='event':
+        column=np.repeat(index['event'],counts)
+      else:
+        column=np.concatenate([np.zeros(0,dtype=dtype)]
+          +[block[2][name] for block in blocks])
+      cellcolumns[name]=column.astype(dtype)
+
+    return CellStore(events,index,cellcolumns)
+
@@ -8,9 +8,15 @@ in the Moschetti event list (which have instrumental data).
 
 '''
 
-import re
+import io
+import os
+import bisect
 import datetime
-import geopy.distance
+import numpy as np
+
+from modules import instrument
+from modules.geo import haversine
+from modules.catalog import Catalog
 
 # The following values are used to see if two events are identical
 
@@ -18,68 +24,214 @@ ALLOWED_MAGDIFF=0.5   # in magnitude units
 ALLOWED_TIMEDIFF=30   # in seconds
 ALLOWED_DISTDIFF=5.0  # in kilometers
 
+# Time differences below this are reported by checkstamp as possible
+# matches, so the time index must search at least this wide
+
+POSSIBLE_TIMEDIFF=60  # in seconds
+
+# Number of collate lines evaluated at once by collateEventsNumpy
+
+BLOCKSIZE=4096
+
+# Leading fields of each line of the relocated event file provided by
+# Moschetti, and their types. You may have to edit this if the file
+# format changes. Seconds are truncated to whole seconds.
+
+LINEFORMAT=(
+  ('mag',np.float64),
+  ('lon',np.float64),
+  ('lat',np.float64),
+  ('depth',np.float64),
+  ('year',np.int32),
+  ('month',np.int32),
+  ('day',np.int32),
+  ('hour',np.int32),
+  ('minute',np.int32),
+  ('second',np.int32),
+)
+
+# Parsed columns are cached next to the collate file, as
+# <file>.collate.npz. Change CACHE_VERSION if the cached layout changes.
+
+CACHE_SUFFIX='.collate.npz'
+CACHE_VERSION=1
+
+
+class CollateFile:
+    """
+
+    Lines of a collate file in typed columns (see LINEFORMAT), e.g.
+    tocollate['mag'], plus the text of each line. The text is kept
+    as one UTF-8 buffer with line offsets and only decoded for the
+    lines that are asked for.
+
+    """
+
+    def __init__(self,columns,text,offsets):
+        self.columns=columns
+        self.text=text
+        self.offsets=offsets
+
+    @classmethod
+    def parse(cls,text):
+        """ Parse the whole text of a collate file at once """
+
+        data=np.frombuffer(text.encode('utf8'),dtype=np.uint8)
+
+        # Line boundaries, leaving out blank lines as np.loadtxt does
+
+        starts=np.concatenate(([0],np.flatnonzero(data==ord('\n'))+1))
+        if starts[-1]==len(data):
+            starts=starts[:-1]
+        offsets=np.zeros((0,2),dtype=np.int64)
+        if len(starts):
+            stops=np.append(starts[1:],len(data))
+            blank=np.add.reduceat((data>ord(' ')).astype(np.int64),starts)==0
+            offsets=np.column_stack((starts[~blank],stops[~blank]))
+
+        values=np.zeros((0,len(LINEFORMAT)))
+        if len(offsets):
+            values=np.loadtxt(io.StringIO(text),usecols=range(len(LINEFORMAT)),
+                comments=None,ndmin=2)
+
+        # Casting truncates seconds, as int(float(second)) would
+        columns={name:values[:,k].astype(dtype)
+            for k,(name,dtype) in enumerate(LINEFORMAT)}
+        return cls(columns,data,offsets)
+
+    @classmethod
+    def load(cls,filename):
+        """
+
+        Read a collate file, from its cache if that was made from a
+        file of the same size and modification time. Otherwise parse
+        it and save the cache, if the directory is writable.
+
+        """
+
+        stat=os.stat(filename)
+        stamp=np.array([CACHE_VERSION,stat.st_size,stat.st_mtime_ns],dtype=np.int64)
+        cachefile=filename+CACHE_SUFFIX
+
+        try:
+            with np.load(cachefile,allow_pickle=False) as saved:
+                if np.array_equal(saved['stamp'],stamp):
+                    instrument.count('collate.cache.hits')
+                    return cls({name:saved['column_'+name] for (name,dtype) in LINEFORMAT},
+                        saved['text'],saved['offsets'])
+        except (OSError,ValueError,KeyError):
+            pass
+
+        instrument.count('collate.cache.misses')
+        with open(filename,'r') as f:
+            collatefile=cls.parse(f.read())
+
+        arrays={'column_'+name:column for name,column in collatefile.columns.items()}
+        tmpfile='%s.tmp.%i' % (cachefile,os.getpid())
+        try:
+            with open(tmpfile,'wb') as f:
+                np.savez(f,stamp=stamp,text=collatefile.text,
+                    offsets=collatefile.offsets,**arrays)
+            os.replace(tmpfile,cachefile)
+        except OSError:
+            print('Could not save collate cache',cachefile)
+        return collatefile
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self,column):
+        """ Return a whole column, e.g. tocollate['mag'] """
+
+        return self.columns[column]
+
+    def line(self,i):
+        """ Text of line i, with its line end """
+
+        (start,stop)=self.offsets[i]
+        return self.text[start:stop].tobytes().decode('utf8')
+
+    def record(self,i):
+        """ Line i as a dict of its fields and its 'line' text """
+
+        record={'line':self.line(i)}
+        for (name,dtype) in LINEFORMAT:
+            record[name]=self.columns[name][i].item()
+        return record
+
+    def stamps(self):
+        """ Origin times of all lines in integer seconds, as collateStamp """
+
+        c=self.columns
+        months=(c['year']-1970).astype('M8[Y]').astype('M8[M]')+(c['month']-1)
+        days=(months.astype('M8[D]')+(c['day']-1)).astype(np.int64)
+        return (days*86400+c['hour']*3600+c['minute']*60+c['second']).astype(np.int64)
+
+
+@instrument.timed('collate.read')
 def readCollateFile(inducedfile):
     """
 
-    Read the relocated event file provided by Moschetti.
-    You may have to edit this function if the file format changes.
+    Read the relocated event file provided by Moschetti, given as a
+    path or a file object, into a CollateFile. Files on disk are
+    cached (see CollateFile.load), so repeated runs skip parsing.
 
     """
 
-    LINEFORMAT=('mag','lon','lat','depth','year','month','day',
-        'hour','minute','second')
-    collatedata=[]
     if isinstance(inducedfile,str):
-      f=open(inducedfile,'r')
+        collatedata=CollateFile.load(inducedfile)
+    elif os.path.isfile(getattr(inducedfile,'name',None) or ''):
+        collatedata=CollateFile.load(inducedfile.name)
     else:
-      f=inducedfile
-      for line in f:
-        eventData={'line':line}
-        vals=re.split('\s+',line)
-        for key in LINEFORMAT:
-          val=vals.pop(0)
-          if re.match('year|month|day|hour|minute',key):
-            val=int(val)
-          elif key=='second':
-            val=int(float(val))
-          else:
-            val=float(val)
-          eventData[key]=val
-
-        collatedata.append(eventData)
+        collatedata=CollateFile.parse(inducedfile.read())
 
+    instrument.count('collate.lines',len(collatedata))
     return collatedata
 
 
+@instrument.timed('collate.match')
 def collateEvents(events,tocollate):
     """
 
       Attempt to collate events between two datasets. The first dataset
-      should be a GeoJSON dict. The second should be the output of the
-      readCollateFile function. Any events found in the second list 
-      will be added as a 'line' property to the event feature list.
+      should be a list of GeoJSON features or a Catalog. The second should
+      be the output of the readCollateFile function. Any events found in
+      the second list will be added as a 'line' property to the event
+      feature list.
 
     """
 
     print('Attempting to locate',len(tocollate),'events in collate list.')
 
+    index=TimeIndex(events)
+    window=max(ALLOWED_TIMEDIFF,POSSIBLE_TIMEDIFF-1)
+
+    trymags=tocollate['mag'].tolist()
+    trystamps=tocollate.stamps().tolist()
+    trylats=tocollate['lat'].tolist()
+    trylons=tocollate['lon'].tolist()
+
     c=0 
     ncollated=0
-    for tryevent in tocollate:
+    for k in range(len(tocollate)):
 
       c=c+1
       if not c%1000:
         print('Collate event',c,'so far collated:',ncollated)
 
-      trymag=float(tryevent['mag'])
-      trystamp=int(datetime.datetime(tryevent['year'],tryevent['month'],
-        tryevent['day'],tryevent['hour'],tryevent['minute'],
-        int(tryevent['second'])).replace(tzinfo=datetime.timezone.utc).timestamp())
+      trymag=trymags[k]
+      trystamp=trystamps[k]
+
+      trylat=trylats[k]
+      trylon=trylons[k]
 
-      trylat=float(tryevent['lat'])
-      trylon=float(tryevent['lon'])
+      # Only events near this origin time can match. Candidates are
+      # checked in catalog order so the first match still wins.
 
-      for event in events:
+      candidates=index.window(trystamp-window,trystamp+window)
+      instrument.count('collate.candidates',len(candidates))
+      for i in candidates:
+        event=getEvent(events,i)
         if not checkmag(event,trymag):
           continue
 
@@ -89,14 +241,165 @@ def collateEvents(events,tocollate):
         if not checkloc(event,trylat,trylon):
           continue
 
-        event['properties']['line_collated']=c
-        event['properties']['collated']=tryevent['line']
+        setCollated(events,i,c,tocollate.line(k))
         ncollated+=1
         break
 
+    instrument.count('collate.matched',ncollated)
     print('Got',ncollated,'events were collated.')
 
 
+@instrument.timed('collate.match')
+def collateEventsNumpy(events,tocollate):
+    """
+
+      Same as collateEvents, but evaluates the magnitude, time and
+      distance tolerances for whole blocks of collate lines at once
+      using NumPy arrays. Matches are identical to collateEvents.
+
+    """
+
+    print('Attempting to locate',len(tocollate),'events in collate list.')
+
+    ncollated=0
+    if not len(events) or not len(tocollate):
+      print('Got',ncollated,'events were collated.')
+      return
+
+    # Catalog origins, sorted by time
+
+    if not isinstance(events,Catalog):
+      catalog=Catalog.fromFeatures(events)
+    else:
+      catalog=events
+
+    stamps=catalogStamps(catalog)
+    mags=catalog['mag']
+    lons=catalog['lon']
+    lats=catalog['lat']
+
+    order=np.argsort(stamps,kind='stable')
+    sortedstamps=stamps[order]
+
+    # Collate lines
+
+    trymags=tocollate['mag']
+    trystamps=tocollate.stamps()
+    trylats=tocollate['lat']
+    trylons=tocollate['lon']
+
+    lo=np.searchsorted(sortedstamps,trystamps-ALLOWED_TIMEDIFF,side='left')
+    hi=np.searchsorted(sortedstamps,trystamps+ALLOWED_TIMEDIFF,side='right')
+
+    matches=np.full(len(tocollate),-1,dtype=np.int64)
+    for start in range(0,len(tocollate),BLOCKSIZE):
+      end=min(start+BLOCKSIZE,len(tocollate))
+      counts=hi[start:end]-lo[start:end]
+      if not counts.sum():
+        continue
+
+      # Expand into one (collate line, catalog event) pair per candidate
+
+      instrument.count('collate.candidates',int(counts.sum()))
+      rows=np.repeat(np.arange(start,end),counts)
+      offsets=np.arange(len(rows))-np.repeat(np.cumsum(counts)-counts,counts)
+      cands=order[lo[rows]+offsets]
+
+      ok=np.abs(mags[cands]-trymags[rows])<=ALLOWED_MAGDIFF
+      ok&=np.abs(stamps[cands]-trystamps[rows])<=ALLOWED_TIMEDIFF
+      rows=rows[ok]
+      cands=cands[ok]
+      ok=haversine(trylats[rows],trylons[rows],
+        lats[cands],lons[cands])<=ALLOWED_DISTDIFF
+      rows=rows[ok]
+      cands=cands[ok]
+
+      # First match in catalog order wins
+
+      bypair=np.lexsort((cands,rows))
+      rows=rows[bypair]
+      cands=cands[bypair]
+      first=np.ones(len(rows),dtype=bool)
+      first[1:]=rows[1:]!=rows[:-1]
+      matches[rows[first]]=cands[first]
+
+    for c,match in enumerate(matches,1):
+      if match<0:
+        continue
+
+      setCollated(events,match,c,tocollate.line(c-1))
+      ncollated+=1
+
+    instrument.count('collate.matched',ncollated)
+    print('Got',ncollated,'events were collated.')
+
+
+class TimeIndex:
+    """
+
+    Catalog events sorted by origin time (in integer seconds, as
+    compared by checkstamp) so that collateEvents only has to look at
+    events inside the allowed time window.
+
+    """
+
+    def __init__(self,events):
+        if isinstance(events,Catalog):
+            stamps=catalogStamps(events).tolist()
+        else:
+            stamps=[eventStamp(event) for event in events]
+        order=sorted(range(len(stamps)),key=lambda i:stamps[i])
+        self.order=order
+        self.stamps=[stamps[i] for i in order]
+
+    def window(self,start,end):
+        """ Return indices of events with start<=stamp<=end, in catalog order """
+
+        lo=bisect.bisect_left(self.stamps,start)
+        hi=bisect.bisect_right(self.stamps,end)
+        return sorted(self.order[lo:hi])
+
+
+def getEvent(events,i):
+    """ GeoJSON feature of event i of a feature list or Catalog """
+
+    if isinstance(events,Catalog):
+        return events.feature(i)
+    return events[i]
+
+
+def setCollated(events,i,c,line):
+    """ Mark event i as matching line c of the collate file """
+
+    if isinstance(events,Catalog):
+        events.setProperty(i,'line_collated',c)
+        events.setProperty(i,'collated',line)
+    else:
+        p=events[i]['properties']
+        p['line_collated']=c
+        p['collated']=line
+
+
+def eventStamp(event):
+    """ Origin time of a catalog event in integer seconds """
+
+    return int(int(event['properties']['time'])/1000)
+
+
+def catalogStamps(catalog):
+    """ Origin times of all Catalog events in integer seconds, as eventStamp """
+
+    return np.trunc(catalog['time']/1000).astype(np.int64)
+
+
+def collateStamp(tryevent):
+    """ Origin time of a collate line in integer seconds """
+
+    return int(datetime.datetime(tryevent['year'],tryevent['month'],
+      tryevent['day'],tryevent['hour'],tryevent['minute'],
+      int(tryevent['second'])).replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
 def checkmag(event,trymag):
     """ Compare if two magnitudes are within the allowed diff """
 
@@ -112,7 +415,7 @@ def checkmag(event,trymag):
 def checkstamp(event,trystamp):
     """ Compare if two timestamps are within the allowed diff """
 
-    eventstamp=int(int(event['properties']['time'])/1000)
+    eventstamp=eventStamp(event)
     diff=abs(eventstamp-trystamp)
     if diff<=ALLOWED_TIMEDIFF:
         return True
@@ -126,6 +429,9 @@ def checkstamp(event,trystamp):
 def checkloc(event,lat,lon):
   """ Compare if two origins are close enough """
 
+  # Only needed when collating, so geopy is not loaded otherwise
+  import geopy.distance
+
   (elon,elat,depth)=event['geometry']['coordinates']
   dist=geopy.distance.great_circle((lat,lon),(elat,elon)).kilometers
   return dist<=ALLOWED_DISTDIFF
@@ -8,19 +8,386 @@ See https://github.com/usgs/libcomcat for details.
 
 """
 
+import os
 import json
-import urllib.request
+import hashlib
+import email.utils
 import urllib.parse
+import http.client
+import gzip
+import zlib
 import re
+import time
 import datetime 
+import threading
+import concurrent.futures
+
+from modules import instrument
+from modules.fileio import writeAtomic
+
+class HttpError(Exception):
+    """ Raised by HttpClient when a request fails after all retries """
+
+
+class HttpClient:
+    """
+
+    Minimal HTTP client shared by all ComCat queries and downloads.
+    Keeps idle connections open for reuse (keep-alive) per host, asks
+    for gzip/deflate compressed responses, and retries failed requests
+    with exponential backoff. Safe to use from multiple threads.
+
+    """
+
+    RETRY_STATUS = (429,500,502,503,504)
+    # Errors of a pooled connection the server closed while it was idle
+    STALE_ERRORS = (http.client.RemoteDisconnected,BrokenPipeError,ConnectionResetError)
+    MAX_REDIRECTS = 5
+
+    def __init__(self,timeout=60,retries=3,backoff=1.0,maxidle=8,cache=None):
+        self.timeout=timeout
+        self.cache=cache
+        self.retries=retries
+        self.backoff=backoff
+        self.maxidle=maxidle
+        self.idle={}
+        self.lock=threading.Lock()
+
+    def get(self,url,headers=None,updated=None):
+        """
+
+        Return the decoded body of url as bytes, or raise HttpError.
+        If the client has a cache, a fresh cached copy is returned
+        without touching the network, and a stale one is revalidated.
+        'updated' (epoch milliseconds) is when the resource last
+        changed upstream, if known; see ResponseCache.isFresh.
+
+        """
+
+        cache=self.cache
+        cached=None
+        if cache:
+            cached=cache.get(url)
+            if cached and cache.isFresh(cached[0],updated):
+                cache.count('hits')
+                return cached[1]
+
+            if cached:
+                headers=dict(headers or {})
+                headers.update(cache.conditionalHeaders(cached[0]))
+
+        origurl=url
+        for redirect in range(HttpClient.MAX_REDIRECTS+1):
+            (status,respheaders,body)=self.request(url,headers)
+            if status in (301,302,303,307,308) and 'location' in respheaders:
+                url=urllib.parse.urljoin(url,respheaders['location'])
+                continue
+
+            if status==304 and cached:
+                cache.count('revalidated')
+                cache.put(origurl,cached[1],respheaders,cached[0])
+                return cached[1]
+
+            if status!=200:
+                raise HttpError('HTTP %i for %s' % (status,url))
+
+            if cache:
+                cache.count('misses')
+                cache.put(origurl,body,respheaders)
+            return body
+
+        raise HttpError('Too many redirects for %s' % url)
+
+    def request(self,url,headers=None):
+        """ Single GET with retries. Returns (status,headers,body) """
+
+        parts=urllib.parse.urlsplit(url)
+        key=(parts.scheme,parts.netloc)
+        path=parts.path or '/'
+        if parts.query:
+            path+='?'+parts.query
+
+        sendheaders={'Accept-Encoding':'gzip, deflate'}
+        if headers:
+            sendheaders.update(headers)
+
+        wait=self.backoff
+        attempt=0
+        stale=False
+        while True:
+            (conn,reused)=self.getConnection(key)
+            start=time.perf_counter()
+            instrument.count('http.requests')
+            try:
+                conn.request('GET',path,headers=sendheaders)
+                resp=conn.getresponse()
+                body=resp.read()
+
+            except (OSError,http.client.HTTPException) as err:
+                conn.close()
+                instrument.count('http.errors')
+
+                # A pooled connection may have been closed by the
+                # server while idle; try again right away, once, without
+                # counting an attempt
+
+                if reused and not stale and isinstance(err,HttpClient.STALE_ERRORS):
+                    stale=True
+                    continue
+                if attempt>=self.retries:
+                    raise HttpError('%s for %s' % (err,url))
+
+            else:
+                instrument.observe('http.latency_ms',(time.perf_counter()-start)*1000)
+                instrument.count('http.bytes',len(body))
+                instrument.count('http.status.%i' % resp.status)
+                respheaders={k.lower():v for k,v in resp.getheaders()}
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self.putConnection(key,conn)
+
+                if resp.status not in HttpClient.RETRY_STATUS or attempt>=self.retries:
+                    return (resp.status,respheaders,
+                        decodeBody(body,respheaders.get('content-encoding')))
+
+            attempt+=1
+            instrument.count('http.retries')
+            time.sleep(wait)
+            wait*=2
+
+    def getConnection(self,key):
+        """ Get an idle connection for this host or open a new one """
+
+        with self.lock:
+            pool=self.idle.get(key)
+            if pool:
+                return (pool.pop(),True)
+
+        (scheme,netloc)=key
+        if scheme=='https':
+            conn=http.client.HTTPSConnection(netloc,timeout=self.timeout)
+        else:
+            conn=http.client.HTTPConnection(netloc,timeout=self.timeout)
+        return (conn,False)
+
+    def putConnection(self,key,conn):
+        """ Return a connection to the idle pool for reuse """
+
+        with self.lock:
+            pool=self.idle.setdefault(key,[])
+            if len(pool)<self.maxidle:
+                pool.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        """ Close all idle connections """
+
+        with self.lock:
+            for pool in self.idle.values():
+                for conn in pool:
+                    conn.close()
+            self.idle={}
+
+
+def decodeBody(body,encoding):
+    """ Undo gzip or deflate content encoding """
+
+    if encoding=='gzip':
+        return gzip.decompress(body)
+    if encoding=='deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body,-zlib.MAX_WBITS)
+    return body
+
+
+class ResponseCache:
+    """
+
+    On-disk cache of raw HTTP response bodies, keyed by a hash of
+    the request URL. Each entry is a body file plus a small JSON file
+    with the URL, the time it was stored and the ETag/Last-Modified
+    headers used to revalidate it. Entries older than 'ttl' seconds
+    are revalidated with the server; the least recently used entries
+    are removed when the cache grows beyond 'maxsize' bytes.
+
+    """
+
+    def __init__(self,cachedir,ttl=None,maxsize=None):
+        self.cachedir=cachedir
+        self.ttl=ttl
+        self.maxsize=maxsize
+        self.stats={'hits':0,'misses':0,'revalidated':0}
+        self.lock=threading.Lock()
+        self.totalsize=None
+        os.makedirs(cachedir,exist_ok=True)
+
+    def paths(self,url):
+        """ Body and metadata file for this URL """
+
+        key=hashlib.sha256(url.encode('utf8')).hexdigest()
+        base=os.path.join(self.cachedir,key[0:2],key)
+        return (base+'.body',base+'.json')
+
+    def get(self,url):
+        """ Return (metadata,body) for this URL, or None """
+
+        (bodyfile,metafile)=self.paths(url)
+        try:
+            with open(metafile,'r') as f:
+                meta=json.load(f)
+            with open(bodyfile,'rb') as f:
+                body=f.read()
+        except (OSError,ValueError):
+            return None
+
+        if meta.get('url')!=url or meta.get('size')!=len(body):
+            return None
+
+        # Mark as recently used for LRU eviction
+        os.utime(metafile)
+        return (meta,body)
+
+    def isFresh(self,meta,updated=None):
+        """
+
+        A cached entry is fresh if it was stored after the resource
+        was last updated upstream, or (if that is unknown) if it is
+        younger than the TTL.
+
+        """
+
+        if updated is not None:
+            return meta['stored']>=int(updated)/1000
+        if self.ttl is None:
+            return False
+        return time.time()-meta['stored']<self.ttl
+
+    def conditionalHeaders(self,meta):
+        """ Headers for revalidating a cached entry with the server """
+
+        headers={}
+        if meta.get('etag'):
+            headers['If-None-Match']=meta['etag']
+        if meta.get('lastmodified'):
+            headers['If-Modified-Since']=meta['lastmodified']
+        else:
+            headers['If-Modified-Since']=email.utils.formatdate(
+                meta['stored'],usegmt=True)
+        return headers
+
+    def put(self,url,body,headers,oldmeta=None):
+        """ Store a response body. Writes are atomic """
+
+        (bodyfile,metafile)=self.paths(url)
+        meta={
+          'url':url,
+          'stored':time.time(),
+          'size':len(body),
+          'etag':headers.get('etag') or (oldmeta or {}).get('etag'),
+          'lastmodified':headers.get('last-modified') or (oldmeta or {}).get('lastmodified')
+        }
+
+        os.makedirs(os.path.dirname(bodyfile),exist_ok=True)
+        if not oldmeta:
+            writeAtomic(bodyfile,body)
+        writeAtomic(metafile,json.dumps(meta).encode('utf8'))
+
+        if self.maxsize is not None and not oldmeta:
+            with self.lock:
+                if self.totalsize is None:
+                    self.totalsize=sum(size for (size,atime,files) in self.entries())
+                else:
+                    self.totalsize+=len(body)
+                if self.totalsize>self.maxsize:
+                    self.evict()
+
+    def entries(self):
+        """ List (size,lastused,files) for each cached entry """
+
+        results=[]
+        for root,dirs,files in os.walk(self.cachedir):
+            for filename in files:
+                if not filename.endswith('.json'):
+                    continue
+                metafile=os.path.join(root,filename)
+                bodyfile=metafile[:-5]+'.body'
+                try:
+                    size=os.path.getsize(bodyfile)
+                    lastused=os.path.getmtime(metafile)
+                except OSError:
+                    continue
+                results.append((size,lastused,(bodyfile,metafile)))
+        return results
+
+    def evict(self):
+        """ Remove least recently used entries until below maxsize """
+
+        entries=sorted(self.entries(),key=lambda entry:entry[1])
+        total=sum(entry[0] for entry in entries)
+        for (size,lastused,files) in entries:
+            if total<=self.maxsize:
+                break
+            for filename in files:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            total-=size
+        self.totalsize=total
+
+    def count(self,stat):
+        with self.lock:
+            self.stats[stat]+=1
+        instrument.count('cache.'+stat)
+
+
+client=HttpClient()
+
+def configureClient(**kwargs):
+    """ Replace the shared client, e.g. to change timeout, retries or cache """
+
+    global client
+    client.close()
+    client=HttpClient(**kwargs)
+    return client
+
+def initCache(cachedir,ttl=None,maxsize=None):
+    """ Use an on-disk cache for ComCat responses; also run in each worker process """
+
+    configureClient(cache=ResponseCache(cachedir,ttl=ttl,maxsize=maxsize))
+
+def setupCache(args):
+    """
+
+    Use an on-disk cache for ComCat responses if requested with the
+    --cache, --cache_ttl (hours) and --cache_size (MB) arguments.
+    Returns the settings to pass to initCache in worker processes, or
+    None without a cache.
+
+    """
+
+    if not args.cache:
+        return None
+
+    ttl=args.cache_ttl*3600 if args.cache_ttl is not None else None
+    maxsize=int(args.cache_size*1e6) if args.cache_size is not None else None
+    print('Using ComCat cache',args.cache)
+    settings=(args.cache,ttl,maxsize)
+    initCache(*settings)
+    return settings
 
 class Comcat:
     """ Query Comcat online server and turn results into JSON """
 
     SERVER = 'earthquake.usgs.gov' #comcat server name
-    URLBASE = 'http://[SERVER]/fdsnws/event/1/query?'.replace('[SERVER]',SERVER)
+    URLBASE = 'https://[SERVER]/fdsnws/event/1/query?'.replace('[SERVER]',SERVER)
 
-    def __init__(self,query):
+    def __init__(self,query,updated=None):
        
         self.contents=None
         self.events=[]
@@ -29,7 +396,7 @@ class Comcat:
         print('Requesting:',url)
 
         try:
-          contents=urllib.request.urlopen(url).read().decode('utf8')
+          contents=client.get(url,updated=updated).decode('utf8')
         except:
           print('No data found (is ComCat down?)') 
           return
@@ -49,61 +416,123 @@ class Comcat:
 
 
 class Events:
-    """ Query Comcat server for list events with given start/end dates """
+    """
+
+    Query Comcat server for list events with given start/end dates.
+    The date range is split into yearly (or monthly) windows which are
+    queried concurrently by up to 'workers' threads. Failed requests
+    are retried by the HTTP client; windows that still fail are
+    listed in self.failed.
+
+    """
 
     EVENTPROPS = ['net','title','type','status','time','mag','cdi','felt','updated','detail'] 
 
-    def __init__(self,startdate,enddate):
+    def __init__(self,startdate,enddate,workers=4,interval='year',
+      updatedafter=None):
 
-      results=[]
       self.events=None
-      for (startdate,enddate) in splitDates(startdate,enddate):
-        print('Querying from',startdate,'to',enddate)
+      self.failed=[]
 
-        query={
-          'format':'geojson',
-          'producttype':'dyfi',
-          'starttime':startdate,
-          'endtime':enddate
-        }
+      # To get only events changed since a given time (epoch ms),
+      # including deleted ones
 
-        events=Comcat(query).events
-        if not events:
-          return
+      extra={}
+      if updatedafter is not None:
+        extra['updatedafter']=datetime.datetime.fromtimestamp(
+          int(updatedafter)/1000,tz=datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        extra['includedeleted']='true'
+
+      windows=splitDates(startdate,enddate,interval)
+      with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers,1)) as pool:
+        windowresults=list(pool.map(
+          lambda window:Events.queryWindow(window,extra),windows))
+
+      results=[]
+      for window,thisresults in zip(windows,windowresults):
+        if thisresults is None:
+          print('WARNING: Could not get events from',window[0],'to',window[1])
+          self.failed.append(window)
+          continue
 
-        # Copy event data to new container
+        results.extend(thisresults)
 
-        thisresults=[]
-        for event in events:
-          eventdata={}
-          for key,val in event.items():
-            if key!='properties':
-              eventdata[key]=val
+      # FDSN start and end times are inclusive, so an event right on
+      # the boundary of two windows comes back from both; keep the
+      # most recently updated copy
 
-          props={}
-          p=event['properties']
-          for prop in Events.EVENTPROPS:
-            props[prop]=p[prop]
+      byid={}
+      for event in results:
+        old=byid.get(event['id'])
+        if old is None or (event['properties']['updated'] or 0)>(old['properties']['updated'] or 0):
+          byid[event['id']]=event
+      results=list(byid.values())
 
-          eventdata['properties']=props
-          thisresults.append(eventdata)
+      # Merge windows in time order, regardless of which finished first
 
-        if(thisresults):
-          print('Got',len(thisresults),'results.')
-          results.extend(thisresults) 
+      results.sort(key=lambda event:(event['properties']['time'] or 0,event['id']))
 
       print('Got total',len(results),'results.')
+      if self.failed:
+        print('WARNING:',len(self.failed),'of',len(windows),'windows failed.')
       self.events=results
 
+    @staticmethod
+    def queryWindow(window,extra=None):
+      """ Query a single time window. Returns None on failure """
+
+      (startdate,enddate)=window
+      query={
+        'format':'geojson',
+        'producttype':'dyfi',
+        'starttime':startdate,
+        'endtime':enddate
+      }
+      if extra:
+        query.update(extra)
+
+      print('Querying from',startdate,'to',enddate)
+      result=Comcat(query)
+      if result.contents is None:
+        return None
+
+      # Copy event data to new container
+
+      thisresults=[]
+      for event in result.events:
+        eventdata={}
+        for key,val in event.items():
+          if key!='properties':
+            eventdata[key]=val
+
+        props={}
+        p=event['properties']
+        for prop in Events.EVENTPROPS:
+          # Deleted events may be missing some properties
+          props[prop]=p.get(prop)
+
+        eventdata['properties']=props
+        thisresults.append(eventdata)
+
+      print('Got',len(thisresults),'results from',startdate,'to',enddate)
+      return thisresults
+
 
 class Event:
     """ Query ComCat server for a particular event ID """
 
-    def __init__(self,evid,includeSuperseded=False):
-        """ Begins with attributes 'evid','products','contents' """
+    def __init__(self,evid,includeSuperseded=False,updated=None):
+        """
+
+        Begins with attributes 'evid','products','contents'. If the
+        event's 'updated' time (epoch milliseconds) is given, cached
+        copies of its details and products newer than that are used.
+
+        """
 
         self.products=[]
         self.evid=evid
+        self.updated=updated
 
         if includeSuperseded:
             superseded='true'
@@ -116,7 +545,7 @@ class Event:
           'includesuperseded':superseded
         }
 
-        contents=Comcat(query).contents
+        contents=Comcat(query,updated).contents
         if not contents:
           return
 
@@ -141,12 +570,20 @@ class Event:
 
       self.code=products[0]['code']
       self.product=products[0]['contents']
+      self.productUpdated=products[0].get('updateTime',self.updated)
  
       # Now self.product has a dict keyed by product file
       return self.product
 
-    def saveFile(self,productname,outfile):
-      """ Save a product. Requires getProducts to be run"""
+    def saveFile(self,productname,outfile,save=None):
+      """
+
+        Save a product. Requires getProducts to be run. The file is
+        written with save(outfile,bytes), writeAtomic by default.
+        Returns True if saved, False if the product has no features
+        (nothing is written), or None if it could not be downloaded.
+
+      """
 
       if not self.product:
         print('ERROR: Must run getProducts first')
@@ -156,7 +593,7 @@ class Event:
         pdata=self.product[productname]
         url=pdata['url']
         print('Downloading url',url)
-        contents=urllib.request.urlopen(url).read().decode('utf8')
+        contents=client.get(url,updated=self.productUpdated).decode('utf8')
 
       except:
         print('Could not save',productname,'(skipping)')
@@ -165,12 +602,12 @@ class Event:
       print('Writing to',outfile)
       jdata=json.loads(contents)
       if not jdata['features']:
-        return
+        return False
 
-      # Prettyprint the JSON file
+      # Prettyprint the JSON file. Write it atomically, so an
+      # interrupted run never leaves a partial file behind.
  
-      with open(outfile,'w') as f:
-        json.dump(json.loads(contents),f,indent=2)
+      (save or writeAtomic)(outfile,json.dumps(jdata,indent=2).encode('utf8'))
       return True
 
 
@@ -258,50 +695,51 @@ def display(data):
     return
 
 
-def splitDates(start,end):
+def splitDates(start,end,interval='year'):
   """ 
 
     Used by Events class to take a multiyear start date and end date,
-    then split it into multiple years for querying Comcat multiple times.
-    Otherwise, querying Comcat with a large date range can result in
-    network timeouts.
+    then split it into multiple years (or months, if interval is
+    'month') for querying Comcat multiple times. Otherwise, querying
+    Comcat with a large date range can result in network timeouts.
 
   """
 
-  startyear=getYear(start)
-  endyear=getYear(end)
-   
-  if startyear==endyear:
-    return (startyear,endyear)
+  startdt=getDate(start)
+  enddt=getDate(end)
 
   dates=[]
-  for year in range(startyear,endyear+1):
-    if year==startyear:
-      thisStart=start+'T00:00:00'
+  thisStart=startdt
+  while thisStart<enddt:
+    if interval=='month':
+      if thisStart.month==12:
+        thisEnd=datetime.datetime(thisStart.year+1,1,1)
+      else:
+        thisEnd=datetime.datetime(thisStart.year,thisStart.month+1,1)
     else:
-      thisStart=str(year)+'-01-01T00:00:00'
+      thisEnd=datetime.datetime(thisStart.year+1,1,1)
 
-    if year==endyear:
-      thisEnd=end+'T00:00:00'
-    else:
-      thisEnd=str(year+1)+'-01-01T00:00:00'
-
-    if thisStart!=thisEnd:
-      dates.append((thisStart,thisEnd))
+    thisEnd=min(thisEnd,enddt)
+    dates.append((thisStart.strftime('%Y-%m-%dT%H:%M:%S'),
+      thisEnd.strftime('%Y-%m-%dT%H:%M:%S')))
+    thisStart=thisEnd
 
   return dates
 
-def getYear(date):
-  """ Used by splitDates to extract year from date string """
+def getDate(date):
+  """ Used by splitDates to parse a year or date string """
 
-  if re.match('%d%d%d%d',date):
-    return int(date)
+  if re.match(r'^\d{4}$',date):
+    return datetime.datetime(int(date),1,1)
   try:
-    dt=datetime.datetime.strptime(date,'%Y-%m-%d')
-    print('Got',dt)
-    return int(dt.year)
-  
+    return datetime.datetime.strptime(date,'%Y-%m-%d')
+
   except:
-    print('Invalid year',date)
+    print('Invalid date',date)
     exit()
 
+def getYear(date):
+  """ Extract year from date string """
+
+  return getDate(date).year
+
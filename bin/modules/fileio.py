@@ -0,0 +1,33 @@
+"""
+  File helpers shared by the pipeline scripts and modules
+
+"""
+
+import os
+import glob
+import threading
+
+def writeAtomic(filename,data):
+  """ Write bytes to a temp file, then rename it into place """
+
+  tmpfile='%s.tmp.%i.%i' % (filename,os.getpid(),threading.get_ident())
+  with open(tmpfile,'wb') as f:
+    f.write(data)
+  os.replace(tmpfile,filename)
+
+def fileStamp(path):
+  """
+
+    Size and modification time of a file, or the number, total size
+    and latest modification time of a directory's files. Raises
+    OSError if the file is missing.
+
+  """
+
+  if os.path.isdir(path):
+    stats=[os.stat(name) for name in glob.glob(os.path.join(path,'*'))]
+    return [len(stats),sum(stat.st_size for stat in stats),
+      max([stat.st_mtime_ns for stat in stats] or [0])]
+
+  stat=os.stat(path)
+  return [stat.st_size,stat.st_mtime_ns]
@@ -3,10 +3,11 @@
 
 """
 
-from matplotlib.path import Path
 import numpy as np
 import datetime
 
+from modules import instrument
+
 def TimeFilter(start,end):
   """ Create a filter function that takes two datestrings """ 
 
@@ -20,9 +21,111 @@ def TimeFilter(start,end):
   return filter
 
 
+def BatchTimeFilter(start,end):
+  """
+
+    Create a filter function that takes an array of event times in
+    epoch milliseconds and returns a boolean mask. Same bounds as
+    TimeFilter, but compared as integers.
+
+  """
+
+  tStart=int(datetime.datetime.strptime(start,'%Y-%m-%d').timestamp()*1000)
+  tEnd=int(datetime.datetime.strptime(end,'%Y-%m-%d').timestamp()*1000)
+
+  def filter(times):
+    with instrument.stage('filter.time'):
+      times=np.asarray(times,dtype=np.int64)
+      instrument.count('filter.time.checked',len(times))
+      return (tStart<=times) & (times<=tEnd)
+
+  return filter
+
+
 def SpaceFilter(polyfile):
   """ Create a filter function that takes a polygon file or file object """
-  def loadPolyfile(file):
+
+  poly=loadPolyfile(polyfile)
+
+  def filter(loc):
+    # loc should be an array (lon,lat)
+    isIn=poly.contains_point(loc)
+    return isIn
+
+  return filter
+
+
+def BatchSpaceFilter(polyfile):
+  """
+
+    Create a filter function that takes an Nx2 array of (lon,lat)
+    points and returns a boolean mask of the points inside the polygon
+
+  """
+
+  poly=loadPolyfile(polyfile)
+
+  def filter(locs):
+    with instrument.stage('filter.space'):
+      locs=np.asarray(locs,dtype=float).reshape(-1,2)
+      instrument.count('filter.space.checked',len(locs))
+      if not len(locs):
+        return np.zeros(0,dtype=bool)
+      return poly.contains_points(locs)
+
+  return filter
+
+
+class Polygon:
+  """
+
+    A closed polygon of (lon,lat) vertices. Points are tested all at
+    once, after a bounding box check, with the same crossing rule as
+    the matplotlib Path this replaces, so points on an edge are
+    classified the same way too.
+
+  """
+
+  def __init__(self,vertices):
+    self.vertices=np.asarray(vertices,dtype=float).reshape(-1,2)
+    self.bounds=(self.vertices.min(axis=0),self.vertices.max(axis=0))
+
+  def contains_point(self,point):
+    return bool(self.contains_points([point])[0])
+
+  def contains_points(self,points):
+    """ Boolean mask of the Nx2 (lon,lat) points inside the polygon """
+
+    points=np.asarray(points,dtype=float).reshape(-1,2)
+    ((minx,miny),(maxx,maxy))=self.bounds
+    isIn=np.zeros(len(points),dtype=bool)
+    inbox=np.flatnonzero((points[:,0]>=minx) & (points[:,0]<=maxx)
+      & (points[:,1]>=miny) & (points[:,1]<=maxy))
+    if not len(inbox):
+      return isIn
+
+    # Count the edges crossed by a ray from each point towards +x,
+    # including the edge back to the first vertex
+
+    x=points[inbox,0]
+    y=points[inbox,1]
+    inside=np.zeros(len(inbox),dtype=bool)
+    (x0,y0)=self.vertices[-1]
+    above0=y0>=y
+    for (x1,y1) in self.vertices:
+      above1=y1>=y
+      spans=above0!=above1
+      inside^=spans & ((((y1-y)*(x0-x1))>=((x1-x)*(y0-y1)))==above1)
+      (x0,y0,above0)=(x1,y1,above1)
+
+    isIn[inbox]=inside
+    return isIn
+
+
+def loadPolyfile(polyfile):
+  """ Read a polygon file or file object into a Polygon, or exit """
+
+  def readPolyfile(file):
     rawArray=[]
     if isinstance(file,str):
       f=open(file,'r')
@@ -41,18 +144,11 @@ def SpaceFilter(polyfile):
       print('Adding first point as last point')
       rawArray.append([firstPt[0],firstPt[1]])
 
-    return Path(rawArray)
+    return Polygon(rawArray)
 
   try:
-    poly=loadPolyfile(polyfile)
+    return readPolyfile(polyfile)
   except:
     print('Unable to load polyfile',polyfile)
     exit()
 
-  def filter(loc):
-    # loc should be an array (lon,lat)
-    isIn=poly.contains_point(loc)
-    return isIn
-
-  return filter
-
@@ -0,0 +1,52 @@
+"""
+  Geographic helper functions that operate on whole NumPy arrays
+  of coordinates at once
+
+"""
+
+import numpy as np
+
+# Same mean earth radius as geopy.distance.great_circle, so that
+# distances agree with the scalar code paths
+
+EARTH_RADIUS=6371.009  # in kilometers
+
+def haversine(lat1,lon1,lat2,lon2):
+  """
+
+    Great circle distance in kilometers between two sets of points
+    given in degrees. Arguments can be scalars or arrays that
+    broadcast against each other.
+
+  """
+
+  lat1=np.radians(lat1)
+  lat2=np.radians(lat2)
+  dlat=lat2-lat1
+  dlon=np.radians(lon2)-np.radians(lon1)
+
+  a=np.sin(dlat/2)**2+np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
+  return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.minimum(a,1.0)))
+
+
+def greatCircle(lat1,lon1,lat2,lon2):
+  """
+
+    Great circle distance in kilometers, with the same atan2 formula
+    as geopy.distance.great_circle, so that results agree with geopy
+    to the last few bits rather than just to rounding
+
+  """
+
+  lat1=np.radians(lat1)
+  lat2=np.radians(lat2)
+  dlon=np.radians(lon2)-np.radians(lon1)
+
+  (sinlat1,coslat1)=(np.sin(lat1),np.cos(lat1))
+  (sinlat2,coslat2)=(np.sin(lat2),np.cos(lat2))
+  (sindlon,cosdlon)=(np.sin(dlon),np.cos(dlon))
+
+  d=np.arctan2(np.sqrt((coslat2*sindlon)**2
+    +(coslat1*sinlat2-sinlat1*coslat2*cosdlon)**2),
+    sinlat1*sinlat2+coslat1*coslat2*cosdlon)
+  return EARTH_RADIUS*d
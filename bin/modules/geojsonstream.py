@@ -0,0 +1,191 @@
+"""
+  Read and write GeoJSON FeatureCollections one feature at a time,
+  so that large catalogs never have to be held in memory at once.
+
+  The writer produces exactly the same text as
+  json.dump({'type':'FeatureCollection','features':[...]},f,indent=2)
+
+"""
+
+import json
+import itertools
+
+CHUNKSIZE=1<<16  # characters read from the file at a time
+
+class FeatureReader:
+  """
+
+    Iterate over the features of a GeoJSON FeatureCollection in a file
+    or file object. Other top-level members (e.g. 'type' or 'metadata')
+    are collected in self.members as they are read.
+
+  """
+
+  def __init__(self,file):
+    if isinstance(file,str):
+      file=open(file,'r')
+    self.file=file
+    self.members={}
+    self.decoder=json.JSONDecoder()
+    self.buffer=''
+    self.pos=0
+    self.eof=False
+
+  def __iter__(self):
+    self.expect('{')
+    if self.peek()=='}':
+      return
+
+    while True:
+      key=self.value()
+      self.expect(':')
+
+      if key=='features':
+        self.expect('[')
+        if self.peek()==']':
+          self.pos+=1
+        else:
+          while True:
+            yield self.value()
+            if self.expect(',]')==']':
+              break
+      else:
+        self.members[key]=self.value()
+
+      if self.expect(',}')=='}':
+        return
+
+  def fill(self):
+    """ Read more of the file. Returns False at end of file """
+
+    if self.eof:
+      return False
+
+    # Drop what has been parsed already
+    if self.pos:
+      self.buffer=self.buffer[self.pos:]
+      self.pos=0
+
+    chunk=self.file.read(CHUNKSIZE)
+    if not chunk:
+      self.eof=True
+      return False
+
+    self.buffer+=chunk
+    return True
+
+  def peek(self):
+    """ Skip whitespace and return the next character """
+
+    while True:
+      while self.pos<len(self.buffer) and self.buffer[self.pos].isspace():
+        self.pos+=1
+      if self.pos<len(self.buffer):
+        return self.buffer[self.pos]
+      if not self.fill():
+        raise ValueError('Unexpected end of GeoJSON file')
+
+  def expect(self,chars):
+    """ Consume the next character, which must be one of chars """
+
+    c=self.peek()
+    if c not in chars:
+      raise ValueError('Expected %s in GeoJSON file, got %s' % (chars,c))
+    self.pos+=1
+    return c
+
+  def value(self):
+    """ Decode the next complete JSON value """
+
+    self.peek()
+    while True:
+      try:
+        (val,end)=self.decoder.raw_decode(self.buffer,self.pos)
+
+        # A number at the end of the buffer may continue in the file
+        if end<len(self.buffer) or self.eof:
+          self.pos=end
+          return val
+
+      except json.JSONDecodeError:
+        if self.eof:
+          raise
+
+      self.fill()
+
+
+def iterFeatures(file):
+  """ Iterate over the features of a GeoJSON file or file object """
+
+  return iter(FeatureReader(file))
+
+
+def iterChunks(iterable,size):
+  """ Group an iterable into lists of at most size items """
+
+  iterator=iter(iterable)
+  while True:
+    chunk=list(itertools.islice(iterator,size))
+    if not chunk:
+      return
+    yield chunk
+
+
+class FeatureWriter:
+  """
+
+    Write a GeoJSON FeatureCollection one feature at a time. Use as a
+    context manager, or call close() to finish the file.
+
+  """
+
+  def __init__(self,file,indent=2):
+    if isinstance(file,str):
+      file=open(file,'w')
+      self.owned=True
+    else:
+      self.owned=False
+
+    self.file=file
+    self.indent=indent
+    self.count=0
+
+    if indent is None:
+      file.write('{"type": "FeatureCollection", "features": [')
+    else:
+      pad=' '*indent
+      file.write('{\n%s"type": "FeatureCollection",\n%s"features": [' % (pad,pad))
+
+  def write(self,feature):
+    if self.count:
+      self.file.write(',')
+
+    if self.indent is None:
+      if self.count:
+        self.file.write(' ')
+      self.file.write(json.dumps(feature))
+    else:
+      pad='\n'+' '*(2*self.indent)
+      self.file.write(pad+json.dumps(feature,indent=self.indent).replace('\n',pad))
+
+    self.count+=1
+
+  def close(self):
+    if self.indent is None:
+      self.file.write(']}')
+    elif not self.count:
+      self.file.write(']\n}')
+    else:
+      self.file.write('\n%s]\n}' % (' '*self.indent))
+
+    if self.owned:
+      self.file.close()
+    else:
+      self.file.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exctype,exc,tb):
+    self.close()
+
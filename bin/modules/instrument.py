@@ -0,0 +1,256 @@
+"""
+  Lightweight run instrumentation shared by the pipeline scripts:
+  stage timers, counters, histograms (e.g. request latency) and
+  per-event durations, written out as a JSON run report.
+
+    from modules import instrument
+
+    with instrument.stage('collate'):
+      ...
+
+    @instrument.timed('read')
+    def read(...):
+      ...
+
+    instrument.count('http.requests')
+    instrument.observe('http.latency_ms',elapsed)
+
+  All functions are cheap no-op-like calls when nothing reads the
+  report, and safe to call from several threads. Work done in worker
+  processes is sent back with take() and added with merge().
+
+  With profiling on (enableProfile), each outermost stage of a thread
+  also runs under cProfile. Statistics of all calls of a stage, in
+  any thread or worker process, are added up and saved by
+  writeProfiles as <stage>.prof, for pstats or snakeviz.
+
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import pstats
+import cProfile
+import datetime
+import functools
+import threading
+import contextlib
+
+# Upper bounds of the histogram buckets; the last bucket is open
+
+BUCKETS=(1,2,5,10,25,50,100,250,500,1000,2500,5000,10000)
+
+
+class Histogram:
+  def __init__(self):
+    self.n=0
+    self.total=0.0
+    self.min=None
+    self.max=None
+    self.counts=[0]*(len(BUCKETS)+1)
+
+  def add(self,value):
+    self.n+=1
+    self.total+=value
+    self.min=value if self.min is None else min(self.min,value)
+    self.max=value if self.max is None else max(self.max,value)
+    self.counts[bisect.bisect_left(BUCKETS,value)]+=1
+
+  def merge(self,other):
+    self.n+=other['n']
+    self.total+=other['total']
+    for bound in ('min','max'):
+      if other[bound] is not None:
+        mine=getattr(self,bound)
+        setattr(self,bound,other[bound] if mine is None
+          else (min if bound=='min' else max)(mine,other[bound]))
+    for k,n in enumerate(other['counts']):
+      self.counts[k]+=n
+
+  def toDict(self):
+    return {
+      'n':self.n,
+      'total':self.total,
+      'mean':self.total/self.n if self.n else None,
+      'min':self.min,
+      'max':self.max,
+      'buckets':['<=%g' % bound for bound in BUCKETS]+['>%g' % BUCKETS[-1]],
+      'counts':self.counts,
+    }
+
+
+class RunReport:
+  """ Everything measured during one run of a script """
+
+  def __init__(self):
+    self.lock=threading.Lock()
+    self.profiledir=None
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.local=threading.local()
+      self.started=time.time()
+      self.stages={}
+      self.counters={}
+      self.histograms={}
+      self.events={}
+      self.profiles={}
+
+  def addStage(self,name,seconds):
+    with self.lock:
+      stage=self.stages.setdefault(name,{'calls':0,'seconds':0.0})
+      stage['calls']+=1
+      stage['seconds']+=seconds
+
+  def addProfile(self,name,stats):
+    with self.lock:
+      if name in self.profiles:
+        self.profiles[name].add(stats)
+      else:
+        self.profiles[name]=stats
+
+  def count(self,name,n=1):
+    with self.lock:
+      self.counters[name]=self.counters.get(name,0)+n
+
+  def observe(self,name,value):
+    with self.lock:
+      if name not in self.histograms:
+        self.histograms[name]=Histogram()
+      self.histograms[name].add(value)
+
+  def event(self,evid,seconds):
+    with self.lock:
+      self.events[evid]=seconds
+
+  def take(self):
+    """ Counters, histograms and stage times so far, and reset them """
+
+    with self.lock:
+      data={
+        'stages':self.stages,
+        'counters':self.counters,
+        'histograms':{name:hist.toDict() for name,hist in self.histograms.items()},
+        'profiles':{name:stats.stats for name,stats in self.profiles.items()},
+      }
+      self.stages={}
+      self.counters={}
+      self.histograms={}
+      self.profiles={}
+    return data
+
+  def merge(self,data):
+    """ Add what another process took """
+
+    with self.lock:
+      for name,stage in data['stages'].items():
+        mine=self.stages.setdefault(name,{'calls':0,'seconds':0.0})
+        mine['calls']+=stage['calls']
+        mine['seconds']+=stage['seconds']
+      for name,n in data['counters'].items():
+        self.counters[name]=self.counters.get(name,0)+n
+      for name,hist in data['histograms'].items():
+        if name not in self.histograms:
+          self.histograms[name]=Histogram()
+        self.histograms[name].merge(hist)
+
+    for name,data in data['profiles'].items():
+      stats=pstats.Stats()
+      stats.stats=data
+      stats.get_top_level_stats()
+      self.addProfile(name,stats)
+
+  def toDict(self,args=None):
+    with self.lock:
+      return {
+        'script':os.path.basename(sys.argv[0]),
+        'args':vars(args) if args is not None else sys.argv[1:],
+        'started':datetime.datetime.fromtimestamp(self.started,
+          tz=datetime.timezone.utc).isoformat(),
+        'seconds':time.time()-self.started,
+        'stages':dict(self.stages),
+        'counters':dict(self.counters),
+        'histograms':{name:hist.toDict() for name,hist in self.histograms.items()},
+        'events':dict(self.events),
+        'profiles':[os.path.join(self.profiledir,'%s.prof' % name)
+          for name in sorted(self.profiles)],
+      }
+
+
+report=RunReport()
+
+def count(name,n=1):
+  report.count(name,n)
+
+def observe(name,value):
+  report.observe(name,value)
+
+def event(evid,seconds):
+  report.event(evid,seconds)
+
+def enableProfile(profiledir):
+  """ Profile each outermost stage with cProfile, for writeProfiles """
+
+  os.makedirs(profiledir,exist_ok=True)
+  report.profiledir=profiledir
+
+@contextlib.contextmanager
+def stage(name):
+  """ Time a block of code as a named stage """
+
+  # Profilers cannot nest, so only the outermost stage of each thread
+  # is profiled; it includes the time of the stages inside it
+
+  profile=None
+  if report.profiledir and not getattr(report.local,'profiling',False):
+    profile=cProfile.Profile()
+    try:
+      profile.enable()
+      report.local.profiling=True
+    except ValueError:
+      # Another profiler is already running
+      profile=None
+
+  start=time.perf_counter()
+  try:
+    yield
+  finally:
+    seconds=time.perf_counter()-start
+    if profile:
+      profile.disable()
+      report.local.profiling=False
+      report.addProfile(name,pstats.Stats(profile))
+    report.addStage(name,seconds)
+
+def timed(name):
+  """ Decorator timing every call of a function as a stage """
+
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args,**kwargs):
+      with stage(name):
+        return function(*args,**kwargs)
+    return wrapper
+
+  return decorate
+
+def writeProfiles():
+  """ Save the profile of each stage as <profiledir>/<stage>.prof """
+
+  with report.lock:
+    profiles=dict(report.profiles)
+  for name,stats in profiles.items():
+    profilefile=os.path.join(report.profiledir,'%s.prof' % name)
+    stats.dump_stats(profilefile)
+    print('Wrote profile',profilefile)
+
+def writeReport(filename,args=None):
+  """ Write the run report as JSON """
+
+  with open(filename,'w') as f:
+    json.dump(report.toDict(args),f,indent=2,default=str)
+  print('Wrote run report',filename)
+
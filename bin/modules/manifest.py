@@ -0,0 +1,146 @@
+"""
+  A journal of the per-event products written by makeAggregated.py,
+  so that an interrupted run can be resumed exactly where it stopped.
+
+  Each product of each event gets a record with its status ('done',
+  'empty' if there were no cells to write, or 'failed'), output file,
+  size, SHA-256 checksum and the 'updated' time of the source it was
+  made from. Records are appended to the journal (one JSON object per
+  line) as soon as an event finishes; the last record of an item wins.
+  close() compacts the journal to one line per item and renames it
+  into place.
+
+    manifest=Manifest('aggregated.manifest.jsonl')
+    manifest.record(evid,product,'done',outfile,size,sha256,updated)
+    ...
+    manifest.close()
+
+"""
+
+import os
+import json
+import time
+import hashlib
+
+from modules.fileio import writeAtomic
+
+
+def checksum(data):
+  return hashlib.sha256(data).hexdigest()
+
+
+class Manifest:
+  """
+
+    Status of each (event, product) item, read from the journal file
+    (which does not need to exist yet) and appended to as items are
+    recorded
+
+  """
+
+  def __init__(self,filename):
+    self.filename=filename
+    self.items={}
+    self.journal=None
+
+    # A line cut short by a crash is ignored; its event is redone
+
+    try:
+      with open(filename,'r') as f:
+        for line in f:
+          try:
+            item=json.loads(line)
+            self.items[(item['evid'],item['product'])]=item
+          except (ValueError,KeyError,TypeError):
+            continue
+    except OSError:
+      pass
+
+  def __len__(self):
+    return len(self.items)
+
+  def get(self,evid,product):
+    return self.items.get((evid,product))
+
+  def record(self,evid,product,status,outfile=None,size=None,sha256=None,updated=None):
+    """ Add or replace the record of one item, and journal it right away """
+
+    item={
+      'evid':evid,
+      'product':product,
+      'status':status,
+      'file':outfile,
+      'size':size,
+      'sha256':sha256,
+      'updated':updated,
+      'time':int(time.time()*1000)
+    }
+    self.items[(evid,product)]=item
+
+    if self.journal is None:
+      os.makedirs(os.path.dirname(self.filename) or '.',exist_ok=True)
+      self.journal=open(self.filename,'a')
+      if self.journal.tell() and not self.endsWithNewline():
+        self.journal.write('\n')
+    self.journal.write(json.dumps(item)+'\n')
+    self.journal.flush()
+    return item
+
+  def endsWithNewline(self):
+    with open(self.filename,'rb') as f:
+      f.seek(-1,os.SEEK_END)
+      return f.read(1)==b'\n'
+
+  def isDone(self,evid,product,updated,stores=None):
+    """
+
+      Check that an item was done from a source with this 'updated'
+      time and that its output is still there. Files must have the
+      recorded size and checksum; archive members (with stores, a
+      dict of ArchiveStore by product) the recorded size.
+
+    """
+
+    item=self.get(evid,product)
+    if not item or item['status'] not in ('done','empty') or item['updated']!=updated:
+      return False
+    if item['status']=='empty':
+      return True
+
+    name=os.path.basename(item['file'])
+    if stores:
+      member=stores[product].index().get(name)
+      return bool(member) and member[1]==item['size']
+
+    try:
+      if os.path.getsize(item['file'])!=item['size']:
+        return False
+      with open(item['file'],'rb') as f:
+        return checksum(f.read())==item['sha256']
+    except OSError:
+      return False
+
+  def counts(self):
+    """ Number of items of each status """
+
+    counts={}
+    for item in self.items.values():
+      counts[item['status']]=counts.get(item['status'],0)+1
+    return counts
+
+  def close(self):
+    """ Rewrite the journal with only the last record of each item """
+
+    if self.journal is None:
+      return
+    self.journal.close()
+    self.journal=None
+
+    lines=[json.dumps(self.items[key])+'\n' for key in sorted(self.items)]
+    writeAtomic(self.filename,''.join(lines).encode('utf8'))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*args):
+    self.close()
@@ -0,0 +1,37 @@
+"""
+  Names and locations of the aggregated dyfi_geo product files of
+  each cell size, as written by makeAggregated.py and read by
+  makeSummary.py
+
+"""
+
+import re
+
+DEFAULT_DIR_TEMPLATE='../aggregated_%ikm'
+ARCHIVE_TEMPLATE='%s/aggregated_%ikm.geojson.tgz'
+ENTRYFILE_TEMPLATE='%s/raw.%s.json'
+
+def productName(cellsize):
+  """ Product file name for a cell size in km, e.g. dyfi_geo_1km.geojson """
+
+  return 'dyfi_geo_%ikm.geojson' % cellsize
+
+def productCellsize(whichproduct):
+  """ Cell size in km of a product, from its name """
+
+  return int(re.match(r'dyfi_geo_(\d+)km',whichproduct).group(1))
+
+def productFile(outdir,evid,cellsize):
+  """ Per-event product file in the output directory of its cell size """
+
+  return '%s/%s.%s' % (outdir,evid,productName(cellsize))
+
+def archiveFile(outdir,cellsize):
+  """ Archive of all events' product files of one cell size """
+
+  return ARCHIVE_TEMPLATE % (outdir,cellsize)
+
+def entryFile(entrydir,evid):
+  """ Raw entry file of an event """
+
+  return ENTRYFILE_TEMPLATE % (entrydir,evid)
@@ -0,0 +1,176 @@
+"""
+  A grid index over point locations (aggregated cell centers or raw
+  entry locations) for bounding box, radius and polygon queries.
+
+  Points are bucketed into a regular latitude/longitude grid and
+  sorted by bucket, row by row, so the points of one grid row inside
+  a longitude range are a contiguous run found by binary search. A
+  query only looks at the rows it overlaps and then checks the exact
+  condition on those candidates. The index is saved next to the data
+  it was built from and rebuilt when that changes.
+
+"""
+
+import os
+import glob
+import json
+import numpy as np
+
+from modules.geo import haversine,EARTH_RADIUS
+from modules.fileio import fileStamp
+
+DEFAULT_BINSIZE=0.1  # grid spacing in degrees, about 11 km
+KM_PER_DEGREE=np.pi*EARTH_RADIUS/180
+
+
+class GridIndex:
+  """
+
+    Index of points by grid bucket. self.keys holds the sorted bucket
+    number of each point and self.order the matching point indices.
+
+  """
+
+  def __init__(self,binsize,keys,order):
+    self.binsize=binsize
+    self.ncols=int(np.ceil(360/binsize))
+    self.keys=keys
+    self.order=order
+
+  def bucket(self,lat,lon):
+    row=np.floor((np.asarray(lat,dtype=float)+90)/self.binsize).astype(np.int64)
+    col=np.floor((np.asarray(lon,dtype=float)+180)/self.binsize).astype(np.int64)
+    return row*self.ncols+np.clip(col,0,self.ncols-1)
+
+  @classmethod
+  def build(cls,lat,lon,binsize=DEFAULT_BINSIZE):
+    index=cls(binsize,None,None)
+    keys=index.bucket(lat,lon)
+    order=np.argsort(keys,kind='stable')
+    index.keys=keys[order]
+    index.order=order
+    return index
+
+  @classmethod
+  def cached(cls,filename,stamp,lat,lon,binsize=DEFAULT_BINSIZE):
+    """
+
+      Load the index from filename if it was built from data with the
+      same stamp, otherwise build it and save it there
+
+    """
+
+    try:
+      with np.load(filename,allow_pickle=False) as saved:
+        if (json.loads(str(saved['stamp']))==stamp
+          and float(saved['binsize'])==binsize):
+          return cls(binsize,saved['keys'],saved['order'])
+    except (OSError,ValueError,KeyError):
+      pass
+
+    index=cls.build(lat,lon,binsize)
+    try:
+      with open(filename,'wb') as f:
+        np.savez(f,stamp=json.dumps(stamp),binsize=binsize,
+          keys=index.keys,order=index.order)
+    except OSError:
+      print('Could not save index',filename)
+    return index
+
+  def candidates(self,minlat,minlon,maxlat,maxlon):
+    """ Indices of the points in the grid buckets overlapping a box """
+
+    (first,last)=self.bucket([minlat,maxlat],[minlon,maxlon])
+    (row0,col0)=divmod(int(first),self.ncols)
+    (row1,col1)=divmod(int(last),self.ncols)
+
+    rows=np.arange(row0,row1+1)
+    if not len(rows) or col1<col0:
+      return np.zeros(0,dtype=np.int64)
+
+    starts=np.searchsorted(self.keys,rows*self.ncols+col0,'left')
+    stops=np.searchsorted(self.keys,rows*self.ncols+col1,'right')
+    return np.concatenate([self.order[start:stop] for start,stop in zip(starts,stops)])
+
+  def bbox(self,lat,lon,minlon,minlat,maxlon,maxlat):
+    """ Sorted indices of the points inside a box """
+
+    found=self.candidates(minlat,minlon,maxlat,maxlon)
+    keep=((lat[found]>=minlat) & (lat[found]<=maxlat)
+      & (lon[found]>=minlon) & (lon[found]<=maxlon))
+    return np.sort(found[keep])
+
+  def radius(self,lat,lon,clat,clon,km):
+    """ Sorted indices of the points within km of (clat,clon) """
+
+    dlat=km/KM_PER_DEGREE
+    coslat=max(np.cos(np.radians(min(abs(clat)+dlat,90.0))),1e-6)
+    dlon=min(dlat/coslat,180.0)
+
+    found=self.candidates(clat-dlat,clon-dlon,clat+dlat,clon+dlon)
+    keep=haversine(lat[found],lon[found],clat,clon)<=km
+    return np.sort(found[keep])
+
+  def polygon(self,lat,lon,poly):
+    """ Sorted indices of the points inside a filter.Polygon """
+
+    ((minlon,minlat),(maxlon,maxlat))=poly.bounds
+    found=self.bbox(lat,lon,minlon,minlat,maxlon,maxlat)
+    if not len(found):
+      return found
+    return found[poly.contains_points(np.column_stack((lon[found],lat[found])))]
+
+
+def loadEntryPoints(entrydir,cachefile):
+  """
+
+    Locations of the raw entries in entrydir (raw.<evid>.json files),
+    as a dict of columns evid, lat, lon and user_cdi. Suspect and
+    unlocated entries are left out. The columns are saved in
+    cachefile and reused until the directory changes.
+
+  """
+
+  stamp=fileStamp(entrydir)
+  try:
+    with np.load(cachefile,allow_pickle=False) as saved:
+      if json.loads(str(saved['stamp']))==stamp:
+        return {name:saved[name] for name in ('evid','lat','lon','user_cdi')}
+  except (OSError,ValueError,KeyError):
+    pass
+
+  def number(val):
+    try:
+      return float(val)
+    except (TypeError,ValueError):
+      return np.nan
+
+  rows=[]
+  for filename in sorted(glob.glob(os.path.join(entrydir,'raw.*.json'))):
+    evid=os.path.basename(filename)[4:-5]
+    try:
+      with open(filename,'r') as f:
+        entries=json.load(f)
+    except (OSError,ValueError):
+      print('Could not read entry file',filename,'(skipping)')
+      continue
+
+    for entry in entries:
+      if number(entry.get('suspect'))>0:
+        continue
+      (lat,lon)=(number(entry.get('latitude')),number(entry.get('longitude')))
+      if not (np.isnan(lat) or np.isnan(lon)):
+        rows.append((evid,lat,lon,number(entry.get('user_cdi'))))
+
+  points={
+    'evid':np.array([row[0] for row in rows],dtype=str),
+    'lat':np.array([row[1] for row in rows],dtype=float),
+    'lon':np.array([row[2] for row in rows],dtype=float),
+    'user_cdi':np.array([row[3] for row in rows],dtype=float),
+  }
+  try:
+    with open(cachefile,'wb') as f:
+      np.savez(f,stamp=json.dumps(stamp),**points)
+  except OSError:
+    print('Could not save entry locations',cachefile)
+  return points
@@ -0,0 +1,163 @@
+"""
+  A local stand-in for the ComCat web service, for running the
+  download stages offline (e.g. in benchmarks). It serves a given
+  list of events through the same FDSN event query and event detail
+  URLs, and dyfi_geo products aggregated from synthetic entries.
+
+    server=StandinComcat(features)
+    server.start()      # ComCat requests now go to the stand-in
+    ...
+    server.stop()
+
+"""
+
+import json
+import gzip
+import time
+import bisect
+import datetime
+import threading
+import urllib.parse
+import http.server
+
+from modules.comcat import Comcat
+from modules.synthetic import makeEntries
+from modules.aggregate import aggregateEntries
+
+PRODUCT_CELLSIZES={'dyfi_geo_1km.geojson':1000,'dyfi_geo_10km.geojson':10000}
+
+def parseTime(text):
+  """ Epoch milliseconds of an ISO time as used in FDSN queries """
+
+  t=datetime.datetime.fromisoformat(text)
+  if t.tzinfo is None:
+    t=t.replace(tzinfo=datetime.timezone.utc)
+  return int(t.timestamp()*1000)
+
+
+class StandinComcat:
+  """
+
+    Serve the given GeoJSON features on a local port. 'delay' adds
+    that many seconds to each response, to mimic network latency.
+
+  """
+
+  def __init__(self,features,delay=0.0,seed=0):
+    self.features=sorted(features,key=lambda feature:feature['properties']['time'])
+    self.times=[feature['properties']['time'] for feature in self.features]
+    self.byid={feature['id']:feature for feature in self.features}
+    self.delay=delay
+    self.seed=seed
+    self.products={}
+    self.lock=threading.Lock()
+    self.server=None
+    self.urlbase=None
+    self.nrequests=0
+
+  def start(self):
+    standin=self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      protocol_version='HTTP/1.1'
+
+      def log_message(self,format,*args):
+        pass
+
+      def do_GET(self):
+        (status,body)=standin.respond(self.path)
+        data=json.dumps(body).encode('utf8')
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+          data=gzip.compress(data)
+          encoding='Content-Encoding: gzip\r\n'
+        else:
+          encoding=''
+
+        # Headers and body in one write, so the client never waits
+        # on a delayed ACK for the second segment
+        header=('HTTP/1.1 %i %s\r\nContent-Type: application/json\r\n%sContent-Length: %i\r\n\r\n'
+          % (status,'OK' if status==200 else 'Not Found',encoding,len(data)))
+        self.wfile.write(header.encode('ascii')+data)
+
+    self.server=http.server.ThreadingHTTPServer(('127.0.0.1',0),Handler)
+    self.server.daemon_threads=True
+    threading.Thread(target=self.server.serve_forever,daemon=True).start()
+
+    self.host='http://127.0.0.1:%i' % self.server.server_address[1]
+    self.urlbase=Comcat.URLBASE
+    Comcat.URLBASE=self.host+'/fdsnws/event/1/query?'
+    return self
+
+  def stop(self):
+    if self.server:
+      Comcat.URLBASE=self.urlbase
+      self.server.shutdown()
+      self.server.server_close()
+      self.server=None
+
+  def respond(self,path):
+    """ (status,JSON body) for a request path """
+
+    if self.delay:
+      time.sleep(self.delay)
+    with self.lock:
+      self.nrequests+=1
+
+    url=urllib.parse.urlparse(path)
+    query={key:vals[0] for key,vals in urllib.parse.parse_qs(url.query).items()}
+
+    if url.path.startswith('/fdsnws/event/1/query'):
+      if 'eventid' in query:
+        return self.detail(query['eventid'])
+      return (200,self.search(query))
+
+    if url.path.startswith('/product/'):
+      (evid,productname)=url.path.split('/')[2:4]
+      return self.product(evid,productname)
+
+    return (404,{'error':'Unknown path'})
+
+  def search(self,query):
+    """ FeatureCollection of the events in a time window, ends included as in FDSN """
+
+    start=bisect.bisect_left(self.times,parseTime(query['starttime']))
+    end=bisect.bisect_right(self.times,parseTime(query['endtime']))
+    features=self.features[start:end]
+    if 'updatedafter' in query:
+      after=parseTime(query['updatedafter'])
+      features=[feature for feature in features
+        if feature['properties']['updated']>after]
+
+    return {'type':'FeatureCollection','features':features}
+
+  def detail(self,evid):
+    if evid not in self.byid:
+      return (404,{'error':'No event %s' % evid})
+
+    feature=dict(self.byid[evid])
+    properties=dict(feature['properties'])
+    contents={name:{'url':'%s/product/%s/%s' % (self.host,evid,name)}
+      for name in PRODUCT_CELLSIZES}
+    properties['products']={'dyfi':[{'code':evid,
+      'updateTime':properties['updated'],'contents':contents}]}
+    feature['properties']=properties
+    return (200,feature)
+
+  def product(self,evid,productname):
+    """ Aggregated cells of an event, made once from its synthetic entries """
+
+    if evid not in self.byid or productname not in PRODUCT_CELLSIZES:
+      return (404,{'error':'No product %s for %s' % (productname,evid)})
+
+    with self.lock:
+      if evid not in self.products:
+        feature=self.byid[evid]
+        (lon,lat)=feature['geometry']['coordinates'][0:2]
+        self.products[evid]=aggregateEntries(makeEntries(feature,self.seed),lat,lon,
+          sorted(PRODUCT_CELLSIZES.values())) or {}
+
+    data=self.products[evid].get(PRODUCT_CELLSIZES[productname])
+    if data is None:
+      data={'type':'FeatureCollection','features':[]}
+    return (200,data)
+
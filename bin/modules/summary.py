@@ -0,0 +1,96 @@
+"""
+  A per-event summary table of the DYFI Induced Events Database: the
+  origin, response counts, counts of entries within distance bands,
+  the largest and median user CDI, the number of aggregated cells of
+  each size and whether the event was collated.
+
+  The table is a CSV file with one row per event. Each row keeps a
+  stamp of the inputs it was computed from, so that only events whose
+  inputs changed are summarized again.
+
+"""
+
+import csv
+import io
+import numpy as np
+
+from modules.geo import haversine
+from modules.aggregate import toNumber
+from modules.fileio import writeAtomic,fileStamp
+
+DIST_BANDS=(10,20,50,100)     # km from the epicenter
+CELLSIZES=(1,10)              # km
+
+COLUMNS=(['evid','time','mag','lat','lon','felt','cdi','collated',
+  'nentries','nsuspect']
+  +['within_%ikm' % band for band in DIST_BANDS]
+  +['maxcdi','mediancdi']
+  +['ncells_%ikm' % size for size in CELLSIZES]
+  +['stamp'])
+
+
+def textStamp(path):
+  """ fileStamp of a file as text for the table, or '-' if it is missing """
+
+  try:
+    return '.'.join(str(val) for val in fileStamp(path))
+  except OSError:
+    return '-'
+
+
+def entryStats(entries,epilat,epilon):
+  """
+
+    Counts and CDI statistics of one event's raw entries. The
+    distance of each entry is its 'dist' field (as written by
+    makeEntries.py) or, without one, the great circle distance of its
+    location from the epicenter.
+
+  """
+
+  suspect=np.array([toNumber(entry.get('suspect'))>0 for entry in entries],dtype=bool)
+  dists=np.array([toNumber(entry.get('dist')) for entry in entries],dtype=float)
+  lats=np.array([toNumber(entry.get('latitude')) for entry in entries],dtype=float)
+  lons=np.array([toNumber(entry.get('longitude')) for entry in entries],dtype=float)
+  cdis=np.array([toNumber(entry.get('user_cdi')) for entry in entries],dtype=float)
+
+  missing=np.isnan(dists)
+  dists[missing]=haversine(lats[missing],lons[missing],epilat,epilon)
+
+  good=~suspect
+  stats={'nentries':int(good.sum()),'nsuspect':int(suspect.sum())}
+  for band in DIST_BANDS:
+    stats['within_%ikm' % band]=int((good & (dists<=band)).sum())
+
+  cdis=cdis[good & ~np.isnan(cdis)]
+  stats['maxcdi']=float(cdis.max()) if len(cdis) else ''
+  stats['mediancdi']=float(np.median(cdis)) if len(cdis) else ''
+  return stats
+
+
+def readSummary(filename):
+  """ Rows of an existing summary table by event ID, or {} """
+
+  try:
+    with open(filename,'r',newline='') as f:
+      return {row['evid']:row for row in csv.DictReader(f)}
+  except (OSError,KeyError):
+    return {}
+
+
+def writeSummary(filename,rows):
+  """ Write the summary table atomically """
+
+  out=io.StringIO()
+  writer=csv.DictWriter(out,fieldnames=COLUMNS,lineterminator='\n')
+  writer.writeheader()
+  for row in rows:
+    writer.writerow(row)
+  writeAtomic(filename,out.getvalue().encode('utf8'))
+
+
+def column(rows,name):
+  """ One column of summary rows as a float array; empty values are NaN """
+
+  return np.array([toNumber(row[name]) for row in rows],dtype=float)
+
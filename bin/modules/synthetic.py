@@ -0,0 +1,175 @@
+"""
+  Synthetic inputs for benchmarking the pipeline at any size: event
+  catalogs in the ComCat GeoJSON format, collate files in the
+  Moschetti format and raw DYFI entry files. Everything is generated
+  from a seed, so the same arguments always give the same data.
+
+"""
+
+import os
+import json
+import random
+import datetime
+
+from modules.geojsonstream import FeatureWriter
+
+# Oklahoma-Kansas study area, roughly the bounds of the input polygon
+
+REGION=(-100.0,33.5,-94.5,38.0)  # minlon,minlat,maxlon,maxlat
+START='2001-01-01'
+END='2017-01-01'
+
+ENTRY_CDIS=('1.0','2.0','2.5','2.7','3.1','3.4','3.8','4.1','4.4','5.0','5.6','6.2')
+
+def epochMs(date):
+  return int(datetime.datetime.strptime(date,'%Y-%m-%d').replace(
+    tzinfo=datetime.timezone.utc).timestamp()*1000)
+
+
+def makeCatalog(nevents,seed=0,start=START,end=END,region=REGION):
+  """
+
+    List of nevents GeoJSON features in time order, with the
+    properties that makeEvents.py keeps from ComCat. Magnitudes follow
+    a Gutenberg-Richter distribution above M2 and larger events have
+    more DYFI responses.
+
+  """
+
+  rng=random.Random(seed)
+  (t0,t1)=(epochMs(start),epochMs(end))
+  (minlon,minlat,maxlon,maxlat)=region
+
+  features=[]
+  for time in sorted(rng.randrange(t0,t1) for n in range(nevents)):
+    evid='bench%08i' % len(features)
+    mag=round(min(2.0+rng.expovariate(2.3),6.0),2)
+    felt=int(10**(mag-2.2)*rng.random()) if rng.random()<0.8 else 0
+    features.append({
+      'type':'Feature',
+      'properties':{
+        'net':'bench',
+        'title':'M %.1f - Synthetic' % mag,
+        'type':'earthquake',
+        'status':'reviewed',
+        'time':time,
+        'mag':mag,
+        'cdi':round(2.0+mag*0.6*rng.random(),1) if felt else None,
+        'felt':felt if felt else None,
+        'updated':time+rng.randrange(10**9),
+        'detail':''
+      },
+      'geometry':{
+        'type':'Point',
+        'coordinates':[round(rng.uniform(minlon,maxlon),4),
+          round(rng.uniform(minlat,maxlat),4),round(rng.uniform(1,10),2)]
+      },
+      'id':evid
+    })
+
+  return features
+
+
+def writeCatalog(filename,features):
+  with FeatureWriter(filename) as writer:
+    for feature in features:
+      writer.write(feature)
+
+
+def collateLine(mag,lon,lat,depth,stamp):
+  """ One line in the format of the Moschetti relocated event file """
+
+  t=datetime.datetime.fromtimestamp(stamp,tz=datetime.timezone.utc)
+  return '%.2f  %.3f  %.3f %3i %4i %02i %02i %02i %02i %02i.%i 0.250 %.2f 1.180 OGS|md,OGS,%.1fMdOGS\n' % (
+    mag,lon,lat,depth,t.year,t.month,t.day,t.hour,t.minute,t.second,t.microsecond//100000,
+    mag,mag-0.5)
+
+
+def writeCollateFile(filename,features,matched=0.5,extra=1.0,seed=0):
+  """
+
+    Write a collate file with a line near (within the collate
+    tolerances) a fraction 'matched' of the catalog events, plus
+    extra*len(features) unrelated lines, all in time order.
+    Returns the number of lines.
+
+  """
+
+  rng=random.Random(seed)
+  lines=[]
+  for feature in features:
+    if rng.random()>=matched:
+      continue
+    p=feature['properties']
+    (lon,lat,depth)=feature['geometry']['coordinates']
+    stamp=p['time']/1000+rng.uniform(-5,5)
+    lines.append((stamp,collateLine(p['mag']+rng.uniform(-0.2,0.2),
+      lon+rng.uniform(-0.02,0.02),lat+rng.uniform(-0.02,0.02),depth,stamp)))
+
+  (t0,t1)=(epochMs(START)/1000,epochMs(END)/1000)
+  (minlon,minlat,maxlon,maxlat)=REGION
+  for n in range(int(extra*len(features))):
+    stamp=rng.uniform(t0,t1)
+    lines.append((stamp,collateLine(2.0+rng.expovariate(2.3),rng.uniform(minlon,maxlon),
+      rng.uniform(minlat,maxlat),rng.uniform(1,10),stamp)))
+
+  lines.sort()
+  with open(filename,'w') as f:
+    f.writelines(line for (stamp,line) in lines)
+  return len(lines)
+
+
+def makeEntries(feature,seed=0):
+  """
+
+    Raw entries for one event, one per DYFI response, scattered
+    around the epicenter with fewer responses far away
+
+  """
+
+  rng=random.Random('%s.%s' % (seed,feature['id']))
+  (lon,lat)=feature['geometry']['coordinates'][0:2]
+  evid=feature['id']
+
+  entries=[]
+  for subid in range(feature['properties']['felt'] or 0):
+    dist=rng.expovariate(1/25.0)/111.0
+    entries.append({
+      'subid':subid,
+      'exttable':'extended_bench',
+      'eventid':evid,
+      'suspect':1 if rng.random()<0.02 else 0,
+      'region':'cus',
+      'latitude':round(lat+rng.gauss(0,dist),2),
+      'longitude':round(lon+rng.gauss(0,dist),2),
+      'felt':str(rng.randint(0,1)),
+      'other_felt':str(rng.randint(1,5)),
+      'motion':str(rng.randint(0,4)),
+      'reaction':str(rng.randint(0,3)),
+      'stand':str(rng.randint(0,1)),
+      'shelf':str(rng.randint(0,2)),
+      'picture':str(rng.randint(0,1)),
+      'furnitude':str(rng.randint(0,1)),
+      'd_text':rng.choice(('','_none','_none','_crackmin','_crackwallfew')),
+      'user_cdi':rng.choice(ENTRY_CDIS),
+      'confidence':rng.randint(0,5),
+    })
+
+  return entries
+
+
+def writeEntryFiles(entrydir,features,seed=0):
+  """ Write raw.<evid>.json for each felt event. Returns the number of entries """
+
+  os.makedirs(entrydir,exist_ok=True)
+  nentries=0
+  for feature in features:
+    entries=makeEntries(feature,seed)
+    if not entries:
+      continue
+    with open(os.path.join(entrydir,'raw.%s.json' % feature['id']),'w') as f:
+      json.dump(entries,f)
+    nentries+=len(entries)
+
+  return nentries
+
@@ -0,0 +1,114 @@
+"""
+  Vectorized conversion between WGS84 latitude/longitude and UTM
+  coordinates, as used by the DYFI aggregated UTM grids. All
+  functions take and return NumPy arrays (or scalars).
+
+  Uses the standard transverse Mercator series (Snyder, 1987), which
+  is accurate to well under a meter inside a UTM zone.
+
+"""
+
+import numpy as np
+
+A=6378137.0                 # WGS84 semi-major axis, in meters
+F=1/298.257223563           # WGS84 flattening
+K0=0.9996                   # UTM scale factor on the central meridian
+FALSE_EASTING=500000.0
+FALSE_NORTHING=10000000.0   # added in the southern hemisphere
+
+E2=F*(2-F)
+EP2=E2/(1-E2)
+
+BANDS='CDEFGHJKLMNPQRSTUVWXX'
+
+def zoneOf(lon):
+  """ UTM zone number for each longitude """
+
+  return (np.floor((np.asarray(lon,dtype=float)+180)/6).astype(int) % 60)+1
+
+def bandOf(lat):
+  """ UTM latitude band letter for each latitude """
+
+  idx=np.clip(np.floor((np.asarray(lat,dtype=float)+80)/8).astype(int),0,len(BANDS)-1)
+  return np.array(list(BANDS))[idx]
+
+def centralMeridian(zone):
+  return (np.asarray(zone)-1)*6-180+3
+
+def meridianArc(phi):
+  """ Distance along the central meridian from the equator, in meters """
+
+  e4=E2*E2
+  e6=e4*E2
+  return A*((1-E2/4-3*e4/64-5*e6/256)*phi
+    -(3*E2/8+3*e4/32+45*e6/1024)*np.sin(2*phi)
+    +(15*e4/256+45*e6/1024)*np.sin(4*phi)
+    -(35*e6/3072)*np.sin(6*phi))
+
+def fromLatLon(lat,lon,zone=None):
+  """
+
+    Project latitude/longitude (degrees) to UTM. Returns arrays
+    (easting,northing,zone) in meters. If zone is not given, each
+    point uses its own zone.
+
+  """
+
+  lat=np.asarray(lat,dtype=float)
+  lon=np.asarray(lon,dtype=float)
+  if zone is None:
+    zone=zoneOf(lon)
+
+  phi=np.radians(lat)
+  dlam=np.radians(lon-centralMeridian(zone))
+  sinphi=np.sin(phi)
+  cosphi=np.cos(phi)
+  tanphi=np.tan(phi)
+
+  n=A/np.sqrt(1-E2*sinphi**2)
+  t=tanphi**2
+  c=EP2*cosphi**2
+  a=cosphi*dlam
+
+  easting=FALSE_EASTING+K0*n*(a+(1-t+c)*a**3/6
+    +(5-18*t+t**2+72*c-58*EP2)*a**5/120)
+  northing=K0*(meridianArc(phi)+n*tanphi*(a**2/2
+    +(5-t+9*c+4*c**2)*a**4/24
+    +(61-58*t+t**2+600*c-330*EP2)*a**6/720))
+  northing=np.where(lat<0,northing+FALSE_NORTHING,northing)
+
+  return (easting,northing,np.broadcast_to(zone,easting.shape))
+
+def toLatLon(easting,northing,zone,south=False):
+  """ Inverse of fromLatLon. Returns arrays (lat,lon) in degrees """
+
+  x=np.asarray(easting,dtype=float)-FALSE_EASTING
+  y=np.asarray(northing,dtype=float)
+  y=np.where(south,y-FALSE_NORTHING,y)
+
+  e4=E2*E2
+  e6=e4*E2
+  e1=(1-np.sqrt(1-E2))/(1+np.sqrt(1-E2))
+  mu=y/K0/(A*(1-E2/4-3*e4/64-5*e6/256))
+  phi1=(mu+(3*e1/2-27*e1**3/32)*np.sin(2*mu)
+    +(21*e1**2/16-55*e1**4/32)*np.sin(4*mu)
+    +(151*e1**3/96)*np.sin(6*mu)
+    +(1097*e1**4/512)*np.sin(8*mu))
+
+  sinphi=np.sin(phi1)
+  cosphi=np.cos(phi1)
+  tanphi=np.tan(phi1)
+  n1=A/np.sqrt(1-E2*sinphi**2)
+  t1=tanphi**2
+  c1=EP2*cosphi**2
+  r1=A*(1-E2)/(1-E2*sinphi**2)**1.5
+  d=x/(n1*K0)
+
+  phi=phi1-(n1*tanphi/r1)*(d**2/2
+    -(5+3*t1+10*c1-4*c1**2-9*EP2)*d**4/24
+    +(61+90*t1+298*c1+45*t1**2-252*EP2-3*c1**2)*d**6/720)
+  lam=(d-(1+2*t1+c1)*d**3/6
+    +(5-2*c1+28*t1-3*c1**2+8*EP2+24*t1**2)*d**5/120)/cosphi
+
+  return (np.degrees(phi),centralMeridian(zone)+np.degrees(lam))
+
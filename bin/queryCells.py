@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+
+descriptiontext="""
+queryCells.py
+
+Find aggregated intensity cells (or raw entry locations) across all
+events of the DYFI Induced Events Database, by bounding box, distance
+from a point or polygon, optionally limited to events by magnitude
+and date. Cells are read from a cell store made with
+'makeAggregated.py --cellstore'.
+
+A grid index of the locations is built on the first query and saved
+next to the cell store (or entry directory), so later queries only
+read the parts of the grid they need.
+
+Example: 1 km cells within 20 km of Pawnee for M3+ events in 2016
+
+  ./queryCells.py --cellstore cells.npz --radius 36.43,-96.93,20 \\
+    --minmag 3 --start 2016-01-01 --end 2017-01-01
+
+"""
+
+import sys
+import csv
+import time
+import datetime
+import argparse
+import numpy as np
+
+from modules.cellstore import CellStore
+from modules.spatialindex import GridIndex,loadEntryPoints,DEFAULT_BINSIZE
+from modules.filter import BatchTimeFilter,loadPolyfile
+from modules.geojsonstream import iterFeatures
+from modules.catalog import Catalog
+from modules.fileio import fileStamp
+
+DEFAULT_CATALOG='../output/dyfi.inducedevents.geojson'
+GRID_SUFFIX='.grid.npz'
+POINTS_SUFFIX='.points.npz'
+
+def parseArgs():
+  parser=argparse.ArgumentParser(
+    description=descriptiontext,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+  parser.add_argument('--cellstore',type=str,
+    help='Cell store file (.npz) made by makeAggregated.py --cellstore')
+
+  parser.add_argument('--entries',type=str,
+    help='Query the raw entry locations in this directory (raw.<evid>.json files) instead of aggregated cells')
+
+  parser.add_argument('--input',type=str,
+    default=DEFAULT_CATALOG,
+    help='GeoJSON event catalog for the magnitude and date of each event, with --entries. Default '+DEFAULT_CATALOG)
+
+  parser.add_argument('--cellsize',type=int,default=1,
+    help='Cell size in km. Default 1')
+
+  parser.add_argument('--bbox',type=str,
+    help='Bounding box as minlon,minlat,maxlon,maxlat; use --bbox=... for negative values')
+
+  parser.add_argument('--radius',type=str,
+    help='Distance from a point as lat,lon,km; use --radius=... for negative values')
+
+  parser.add_argument('--polyfile',type=str,
+    help='Polygon file (lon lat per line), as used by makeEvents.py')
+
+  parser.add_argument('--minmag',type=float,
+    help='Only events of at least this magnitude')
+
+  parser.add_argument('--maxmag',type=float,
+    help='Only events of at most this magnitude')
+
+  parser.add_argument('--start',type=str,
+    help='Only events on or after this date (YYYY-MM-DD)')
+
+  parser.add_argument('--end',type=str,
+    help='Only events on or before this date (YYYY-MM-DD)')
+
+  parser.add_argument('--binsize',type=float,default=DEFAULT_BINSIZE,
+    help='Grid index spacing in degrees. Default %g' % DEFAULT_BINSIZE)
+
+  parser.add_argument('--output',type=argparse.FileType('w'),
+    default=sys.stdout,
+    help='CSV output file. Default standard output')
+
+  args=parser.parse_args()
+  if not args.cellstore and not args.entries:
+    parser.error('Need --cellstore or --entries')
+
+  def numbers(val,n,name):
+    try:
+      vals=[float(x) for x in val.split(',')]
+    except ValueError:
+      vals=[]
+    if len(vals)!=n:
+      parser.error('%s needs %i comma-separated numbers' % (name,n))
+    return vals
+
+  if args.bbox:
+    args.bbox=numbers(args.bbox,4,'--bbox')
+  if args.radius:
+    args.radius=numbers(args.radius,3,'--radius')
+  return args
+
+
+def eventMask(times,mags,args):
+  """ Boolean mask of the events passing the magnitude and date limits """
+
+  keep=np.ones(len(times),dtype=bool)
+  if args.minmag is not None:
+    keep&=mags>=args.minmag
+  if args.maxmag is not None:
+    keep&=mags<=args.maxmag
+  if args.start or args.end:
+    # BatchTimeFilter stops at midnight at the start of its end date.
+    # To include all of the --end date, filter up to the next midnight
+    # and leave out events at exactly that time.
+
+    end=datetime.datetime(2100,1,1)
+    if args.end:
+      end=datetime.datetime.strptime(args.end,'%Y-%m-%d')+datetime.timedelta(days=1)
+    timeFilter=BatchTimeFilter(args.start or '1900-01-01',end.strftime('%Y-%m-%d'))
+    keep&=timeFilter(times)
+    keep&=np.asarray(times,dtype=np.int64)<int(end.timestamp()*1000)
+  return keep
+
+
+def spatialQuery(index,lat,lon,args):
+  """ Sorted indices of the points inside all the given areas """
+
+  found=None
+  def both(selected):
+    return selected if found is None else np.intersect1d(found,selected)
+
+  if args.bbox:
+    found=both(index.bbox(lat,lon,*args.bbox))
+  if args.radius:
+    found=both(index.radius(lat,lon,*args.radius))
+  if args.polyfile:
+    found=both(index.polygon(lat,lon,loadPolyfile(args.polyfile)))
+
+  if found is None:
+    return np.arange(len(lat))
+  return found
+
+
+def queryCells(args,writer):
+  store=CellStore.load(args.cellstore)
+  cells=store.cells(cellsize=args.cellsize*1000)
+  (lat,lon)=(np.asarray(cells['lat']),np.asarray(cells['lon']))
+
+  gridfile='%s.%ikm%s' % (args.cellstore,args.cellsize,GRID_SUFFIX)
+  index=GridIndex.cached(gridfile,fileStamp(args.cellstore),lat,lon,args.binsize)
+
+  found=spatialQuery(index,lat,lon,args)
+  events=cells['event'][found]
+  found=found[eventMask(store.events['time'],store.events['mag'],args)[events]]
+
+  writer.writerow(['evid','time','mag','cellsize','lat','lon','nresp','cdi','dist'])
+  for i in found:
+    event=cells['event'][i]
+    writer.writerow([store.events['evid'][event],store.events['time'][event],
+      store.events['mag'][event],cells['cellsize'][i],
+      '%.5f' % cells['lat'][i],'%.5f' % cells['lon'][i],
+      cells['nresp'][i],cells['cdi'][i],cells['dist'][i]])
+  return len(found)
+
+
+def queryEntries(args,writer):
+  entrydir=args.entries.rstrip('/')
+  points=loadEntryPoints(entrydir,entrydir+POINTS_SUFFIX)
+  (lat,lon)=(points['lat'],points['lon'])
+
+  index=GridIndex.cached(entrydir+GRID_SUFFIX,fileStamp(entrydir+POINTS_SUFFIX),
+    lat,lon,args.binsize)
+  found=spatialQuery(index,lat,lon,args)
+
+  # Magnitude and date of each event come from the catalog
+
+  catalog=Catalog.fromFeatures(iterFeatures(args.input))
+  rows={evid:i for i,evid in enumerate(catalog['id'])}
+  events=np.array([rows.get(evid,-1) for evid in points['evid'][found]],dtype=np.int64)
+  known=events>=0
+  keep=np.zeros(len(found),dtype=bool)
+  keep[known]=eventMask(catalog['time'],catalog['mag'],args)[events[known]]
+  (found,events)=(found[keep],events[keep])
+
+  writer.writerow(['evid','time','mag','lat','lon','user_cdi'])
+  for i,event in zip(found,events):
+    writer.writerow([points['evid'][i],catalog['time'][event],catalog['mag'][event],
+      lat[i],lon[i],'' if np.isnan(points['user_cdi'][i]) else points['user_cdi'][i]])
+  return len(found)
+
+
+if __name__=='__main__':
+
+  args=parseArgs()
+  start=time.time()
+  writer=csv.writer(args.output)
+
+  if args.entries:
+    nfound=queryEntries(args,writer)
+  else:
+    nfound=queryCells(args,writer)
+
+  args.output.flush()
+  print('Found %i in %.1f ms' % (nfound,(time.time()-start)*1000),file=sys.stderr)
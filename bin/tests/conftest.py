@@ -0,0 +1,39 @@
+"""
+  Shared fixtures. The scripts and modules expect to be run from the
+  bin directory, so it is put on the path and used as the working
+  directory of script runs.
+
+"""
+
+import os
+import sys
+import subprocess
+import pytest
+
+BINDIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,BINDIR)
+
+from modules import synthetic
+
+
+@pytest.fixture
+def run():
+  """ Run a script in bin with arguments; fails the test on a nonzero exit """
+
+  def run(script,*args):
+    result=subprocess.run([sys.executable,script]+[str(arg) for arg in args],
+      cwd=BINDIR,capture_output=True,text=True)
+    assert result.returncode==0,result.stdout+result.stderr
+    return result
+
+  return run
+
+
+@pytest.fixture
+def workspace(tmp_path):
+  """ A small synthetic catalog (catalog.geojson) and its entry files (entries/) """
+
+  features=synthetic.makeCatalog(40,seed=1)
+  synthetic.writeCatalog(str(tmp_path/'catalog.geojson'),features)
+  synthetic.writeEntryFiles(str(tmp_path/'entries'),features,seed=1)
+  return tmp_path
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from modules.aggregate import aggregateEntries
+
+
+def cellCenters(product):
+  """ (lat,lon) of the middle of each cell polygon """
+
+  return [tuple(np.mean(feature['geometry']['coordinates'][0],axis=0)[::-1])
+    for feature in product['features']]
+
+
+@pytest.mark.parametrize('epilat',[0.02,-0.02])
+def test_cells_on_both_sides_of_the_equator(epilat):
+  points=[(0.0042,-78.5),(-0.0042,-78.5),(-0.0042,-78.5),(-0.52,-78.3),(0.31,-78.7)]
+  entries=[{'latitude':lat,'longitude':lon,'felt':1} for lat,lon in points]
+
+  results=aggregateEntries(entries,epilat,-78.5,[1000,10000])
+  cells=results[1000]['features']
+  assert sorted(cell['properties']['nresp'] for cell in cells)==[1,1,1,2]
+
+  # Every entry lies in a cell next to it, whichever side the epicentre is on
+
+  centers=cellCenters(results[1000])
+  for lat,lon in points:
+    assert min(abs(clat-lat)+abs(clon-lon) for clat,clon in centers)<0.02
@@ -0,0 +1,62 @@
+import io
+import tarfile
+
+from modules.archive import ArchiveStore
+
+
+def writeTgz(filename,members):
+  """ A single-stream .tgz, as written by tar """
+
+  with tarfile.open(filename,'w:gz') as tar:
+    for name,data in members.items():
+      info=tarfile.TarInfo(name)
+      info.size=len(data)
+      tar.addfile(info,io.BytesIO(data))
+
+
+def test_single_stream_archive_is_converted(tmp_path):
+  filename=str(tmp_path/'a.tgz')
+  members={'e%02i.json' % i:b'x%i' % i*500 for i in range(20)}
+  writeTgz(filename,members)
+
+  store=ArchiveStore(filename)
+  assert store.read('e05.json')==members['e05.json']
+  assert store.index()['e05.json'][2] is None
+  store.put('e05.json',b'new')
+  store.put('new.json',b'added')
+  store.close()
+
+  store=ArchiveStore(filename)
+  assert all(val[2] is not None for val in store.index().values())
+  assert store.read('e05.json')==b'new'
+  assert store.read('new.json')==b'added'
+  assert store.read('e19.json')==members['e19.json']
+
+  # Still an ordinary .tgz, with replaced members in their place
+  with tarfile.open(filename,'r:gz') as tar:
+    names=tar.getnames()
+  assert names==sorted(members)+['new.json']
+
+
+def test_rewrite_copies_members(tmp_path):
+  filename=str(tmp_path/'a.tgz')
+  with ArchiveStore(filename) as store:
+    for i in range(10):
+      store.put('e%i' % i,b'y%i' % i*100)
+  with ArchiveStore(filename) as store:
+    store.put('e3',b'three')
+  store=ArchiveStore(filename)
+  assert [store.read('e%i' % i) for i in (2,3,9)]==[b'y2'*100,b'three',b'y9'*100]
+  assert dict(store.iterMembers())['e3']==b'three'
+
+
+def test_pending_members_are_written_in_batches(tmp_path):
+  filename=str(tmp_path/'a.tgz')
+  store=ArchiveStore(filename,maxpending=5000)
+  for i in range(20):
+    store.put('e%02i' % i,b'z'*1000)
+    assert store.pendingsize<=5000
+  store.close()
+  store=ArchiveStore(filename)
+  assert len(store)==20
+  assert store.read('e19')==b'z'*1000
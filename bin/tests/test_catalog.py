@@ -0,0 +1,83 @@
+import copy
+import json
+import pytest
+
+from modules.catalog import Catalog
+
+
+def makeFeature(**props):
+  properties={'time':1500000000000,'mag':3.2,'felt':10,'cdi':3.4,
+    'updated':1500000001000,'type':'earthquake'}
+  properties.update(props)
+  return {
+    'type':'Feature',
+    'properties':properties,
+    'geometry':{'type':'Point','coordinates':[-97.5,35.5,5.0]},
+    'id':'test0001'
+  }
+
+
+@pytest.mark.parametrize('props',[
+  {},
+  {'mag':'3.2'},
+  {'time':'1500000000000','mag':'3','felt':'12'},
+  {'mag':True},
+  {'felt':False},
+  {'mag':None,'felt':None,'cdi':None},
+  {'felt':2**70},
+  {'felt':-2**63},
+  {'felt':2.5},
+  {'felt':2.0},
+  {'mag':3},
+  {'mag':2**70+1},
+  {'time':'2017-01-01T00:00:00'},
+  {'cdi':[3.4]},
+])
+def test_roundtrip(props):
+  feature=makeFeature(**props)
+  original=copy.deepcopy(feature)
+  catalog=Catalog.fromFeatures([feature])
+  assert json.dumps(catalog.feature(0))==json.dumps(original)
+
+
+def test_roundtrip_coordinates():
+  for coords in ([-97.5,35.5],[-97.5,35.5,'5'],[-97,35,5]):
+    feature=makeFeature()
+    feature['geometry']['coordinates']=coords
+    original=copy.deepcopy(feature)
+    assert json.dumps(Catalog.fromFeatures([feature]).feature(0))==json.dumps(original)
+
+
+def test_raw_values_are_null_in_columns():
+  catalog=Catalog.fromFeatures([makeFeature(mag='big',felt=2**70),makeFeature()])
+  assert list(catalog.isnull('mag'))==[True,False]
+  assert list(catalog.isnull('felt'))==[True,False]
+  assert catalog.getProperty(0,'mag')=='big'
+  assert catalog.getProperty(0,'felt')==2**70
+
+
+def test_numeric_strings_fill_columns():
+  catalog=Catalog.fromFeatures([makeFeature(time='1500000000000',mag='3.2',felt='2.5')])
+  assert catalog['time'][0]==1500000000000
+  assert catalog['mag'][0]==3.2
+  assert not catalog.isnull('time')[0] and not catalog.isnull('mag')[0]
+  assert catalog.isnull('felt')[0]
+  assert catalog.getProperty(0,'time')=='1500000000000'
+  assert catalog.getProperty(0,'mag')=='3.2'
+
+  catalog.setProperty(0,'mag','2.9')
+  assert catalog['mag'][0]==2.9
+  assert catalog.getProperty(0,'mag')=='2.9'
+  catalog.setProperty(0,'mag',3.0)
+  assert catalog.getProperty(0,'mag')==3.0
+
+
+def test_setProperty_roundtrip():
+  catalog=Catalog.fromFeatures([makeFeature(mag='3.2')])
+  catalog.setProperty(0,'mag',3.5)
+  assert catalog.getProperty(0,'mag')==3.5
+  catalog.setProperty(0,'felt','many')
+  assert catalog.getProperty(0,'felt')=='many'
+  catalog.setProperty(0,'felt',None)
+  assert catalog.getProperty(0,'felt') is None
+  assert catalog.subset([0]).feature(0)['properties']['felt'] is None
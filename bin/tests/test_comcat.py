@@ -0,0 +1,229 @@
+import gzip
+import socket
+import time
+import threading
+import http.client
+import http.server
+import pytest
+
+# Not affected by the sleeps fixture, which patches time.sleep
+from time import sleep as stall
+
+from modules import comcat
+from modules.comcat import HttpClient,HttpError,ResponseCache
+
+
+class Server:
+  """
+
+    Local HTTP server answering each GET with the next of a list of
+    responses: (status, headers, body) tuples, or a number of seconds
+    to stall before answering 200. The last response is repeated.
+
+  """
+
+  def __init__(self):
+    self.responses=[(200,{},b'ok')]
+    self.requests=[]
+    server=self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def log_message(self,format,*args):
+        pass
+
+      def do_GET(self):
+        server.requests.append(dict(self.headers))
+        n=len(server.requests)
+        response=server.responses[min(n,len(server.responses))-1]
+        if not isinstance(response,tuple):
+          stall(response)
+          response=(200,{},b'late')
+        (status,headers,body)=response
+        self.send_response(status)
+        for key,val in headers.items():
+          self.send_header(key,val)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    self.httpd=http.server.ThreadingHTTPServer(('127.0.0.1',0),Handler)
+    self.httpd.daemon_threads=True
+    threading.Thread(target=self.httpd.serve_forever,daemon=True).start()
+    self.url='http://127.0.0.1:%i/query' % self.httpd.server_address[1]
+
+
+@pytest.fixture
+def server():
+  server=Server()
+  yield server
+  server.httpd.shutdown()
+  server.httpd.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+  """ Backoff waits of the client, without actually waiting """
+
+  waits=[]
+  monkeypatch.setattr(comcat.time,'sleep',waits.append)
+  return waits
+
+
+def test_retries_with_backoff(server,sleeps):
+  server.responses=[(503,{},b''),(503,{},b''),(200,{},b'done')]
+  client=HttpClient(retries=3,backoff=0.5)
+  assert client.get(server.url)==b'done'
+  assert len(server.requests)==3
+  assert sleeps==[0.5,1.0]
+
+
+def test_gives_up_after_retries(server,sleeps):
+  server.responses=[(500,{},b'')]
+  client=HttpClient(retries=2,backoff=1)
+  with pytest.raises(HttpError,match='HTTP 500'):
+    client.get(server.url)
+  assert len(server.requests)==3
+  assert sleeps==[1,2]
+
+
+def test_does_not_retry_client_errors(server,sleeps):
+  server.responses=[(404,{},b'')]
+  with pytest.raises(HttpError,match='HTTP 404'):
+    HttpClient(retries=3).get(server.url)
+  assert len(server.requests)==1
+  assert sleeps==[]
+
+
+def test_timeout_is_retried(server,sleeps):
+  server.responses=[1.0,(200,{},b'done')]
+  client=HttpClient(timeout=0.2,retries=1,backoff=0.1)
+  assert client.get(server.url)==b'done'
+  assert len(server.requests)==2
+  assert sleeps==[0.1]
+
+
+def test_timeout_gives_up(server,sleeps):
+  server.responses=[1.0]
+  client=HttpClient(timeout=0.2,retries=1,backoff=0.1)
+  with pytest.raises(HttpError,match='timed out'):
+    client.get(server.url)
+
+
+def test_gzip_body_is_decoded(server):
+  server.responses=[(200,{'Content-Encoding':'gzip'},gzip.compress(b'x'*1000))]
+  assert HttpClient().get(server.url)==b'x'*1000
+  assert 'gzip' in server.requests[0]['Accept-Encoding']
+
+
+def test_cache_hit_skips_network(server,tmp_path):
+  server.responses=[(200,{},b'cached')]
+  cache=ResponseCache(str(tmp_path),ttl=3600)
+  client=HttpClient(cache=cache)
+  assert client.get(server.url)==b'cached'
+  assert client.get(server.url)==b'cached'
+  assert len(server.requests)==1
+  assert cache.stats=={'hits':1,'misses':1,'revalidated':0}
+
+
+def test_cache_is_fresh_after_update(server,tmp_path):
+  server.responses=[(200,{},b'old'),(200,{},b'new')]
+  cache=ResponseCache(str(tmp_path))
+  client=HttpClient(cache=cache)
+  assert client.get(server.url,updated=0)==b'old'
+  assert client.get(server.url,updated=0)==b'old'
+  assert client.get(server.url,updated=(time.time()+60)*1000)==b'new'
+  assert len(server.requests)==2
+
+
+def test_stale_cache_is_revalidated(server,tmp_path):
+  server.responses=[(200,{'ETag':'"v1"'},b'body'),(304,{},b'')]
+  cache=ResponseCache(str(tmp_path),ttl=0)
+  client=HttpClient(cache=cache)
+  assert client.get(server.url)==b'body'
+  assert client.get(server.url)==b'body'
+  assert server.requests[1]['If-None-Match']=='"v1"'
+  assert cache.stats=={'hits':0,'misses':1,'revalidated':1}
+
+
+def test_events_on_window_boundaries_are_kept_once():
+  from modules import synthetic
+  from modules.standin import StandinComcat,parseTime
+
+  features=synthetic.makeCatalog(20,seed=2)
+  for feature,boundary in zip(features[:2],('2005-01-01T00:00:00','2010-01-01T00:00:00')):
+    feature['properties']['time']=parseTime(boundary)
+
+  server=StandinComcat(features).start()
+  try:
+    events=comcat.Events(synthetic.START,synthetic.END,workers=2)
+  finally:
+    server.stop()
+
+  ids=[event['id'] for event in events.events]
+  assert sorted(ids)==sorted(feature['id'] for feature in features)
+  times=[event['properties']['time'] for event in events.events]
+  assert times==sorted(times)
+
+
+def test_failed_window_is_retried_by_client_only(server,sleeps,monkeypatch):
+  server.responses=[(503,{},b'')]
+  monkeypatch.setattr(comcat.Comcat,'URLBASE',server.url+'?')
+  monkeypatch.setattr(comcat,'client',HttpClient(retries=2,backoff=1))
+
+  events=comcat.Events('2010-01-01','2010-12-31',workers=1)
+  assert len(events.failed)==1
+  assert events.events==[]
+  assert len(server.requests)==3
+  assert sleeps==[1,2]
+
+
+class PooledConnection:
+  """ Stands in for an idle keep-alive connection that raises on use """
+
+  def __init__(self,error):
+    self.error=error
+
+  def request(self,*args,**kwargs):
+    raise self.error
+
+  def close(self):
+    pass
+
+
+def usePool(monkeypatch,client,errors):
+  """ Hand out pooled connections raising these errors, then real ones """
+
+  errors=list(errors)
+  getConnection=client.getConnection
+
+  def get(key):
+    if errors:
+      return (PooledConnection(errors.pop(0)),True)
+    return getConnection(key)
+
+  monkeypatch.setattr(client,'getConnection',get)
+
+
+def test_stale_connection_is_retried_once_right_away(server,sleeps,monkeypatch):
+  client=HttpClient(retries=1,backoff=1)
+  usePool(monkeypatch,client,[http.client.RemoteDisconnected('closed')])
+  assert client.get(server.url)==b'ok'
+  assert sleeps==[]
+
+
+def test_stale_connection_errors_count_after_the_first(server,sleeps,monkeypatch):
+  client=HttpClient(retries=1,backoff=1)
+  usePool(monkeypatch,client,[BrokenPipeError(),BrokenPipeError(),BrokenPipeError()])
+  with pytest.raises(HttpError):
+    client.get(server.url)
+  assert sleeps==[1]
+  assert len(server.requests)==0
+
+
+def test_timeout_on_pooled_connection_counts(server,sleeps,monkeypatch):
+  client=HttpClient(retries=2,backoff=1)
+  usePool(monkeypatch,client,[socket.timeout('timed out')]*3)
+  with pytest.raises(HttpError,match='timed out'):
+    client.get(server.url)
+  assert sleeps==[1,2]
+  assert len(server.requests)==0
@@ -0,0 +1,144 @@
+import os
+import json
+
+
+def test_cellsizes_makes_output_directories(run,workspace):
+  outputdir=workspace/'out'/'aggregated_%ikm'
+  run('makeAggregated.py','--input',workspace/'catalog.geojson',
+    '--entries',workspace/'entries','--outputdir',outputdir,'--cellsizes','1,2,10')
+
+  for size in (1,2,10):
+    files=os.listdir(str(outputdir).replace('%i',str(size)))
+    assert files
+    name=[name for name in files if name.endswith('.geojson')][0]
+    assert name.endswith('.dyfi_geo_%ikm.geojson' % size)
+    with open(os.path.join(str(outputdir).replace('%i',str(size)),name)) as f:
+      assert json.load(f)['features']
+
+
+def test_failing_event_does_not_end_run(run,workspace):
+  entries=sorted(os.listdir(workspace/'entries'))
+  bad=entries[0][len('raw.'):-len('.json')]
+  with open(workspace/'entries'/entries[0],'w') as f:
+    json.dump([1,2,3],f)
+
+  outputdir=workspace/'out'/'aggregated_%ikm'
+  result=run('makeAggregated.py','--input',workspace/'catalog.geojson',
+    '--entries',workspace/'entries','--outputdir',outputdir,'--jobs',2)
+  assert 'ERROR: Event' in result.stdout
+
+  written=os.listdir(str(outputdir).replace('%i','1'))
+  assert len(written)==len(entries)-1
+  with open(workspace/'out'/'aggregated.manifest.jsonl') as f:
+    items=[json.loads(line) for line in f]
+  assert set(item['status'] for item in items if item['evid']==bad)=={'failed'}
+
+
+def readManifest(path):
+  with open(path) as f:
+    return {(item['evid'],item['product']):item for item in map(json.loads,f)}
+
+
+def test_resume_skips_empty_events(run,workspace):
+  entries=sorted(os.listdir(workspace/'entries'))
+  empty=entries[0][len('raw.'):-len('.json')]
+  with open(workspace/'entries'/entries[0],'w') as f:
+    json.dump([{'latitude':None,'longitude':None,'suspect':0}],f)
+
+  args=('makeAggregated.py','--input',workspace/'catalog.geojson',
+    '--entries',workspace/'entries','--outputdir',workspace/'out'/'aggregated_%ikm')
+  result=run(*args)
+  assert 'No located entries for' in result.stdout
+  manifest=readManifest(workspace/'out'/'aggregated.manifest.jsonl')
+  assert manifest[(empty,'dyfi_geo_1km.geojson')]['status']=='empty'
+
+  result=run(*args,'--resume')
+  assert 'No located entries' not in result.stdout
+  assert 'processed 0 events' in result.stdout
+
+
+def test_resume_redoes_single_product(run,workspace):
+  args=('makeAggregated.py','--input',workspace/'catalog.geojson',
+    '--entries',workspace/'entries','--outputdir',workspace/'out'/'aggregated_%ikm')
+  run(*args)
+
+  evid=sorted(os.listdir(workspace/'entries'))[0][len('raw.'):-len('.json')]
+  os.remove(workspace/'out'/'aggregated_10km'/('%s.dyfi_geo_10km.geojson' % evid))
+
+  result=run(*args,'--resume')
+  written=[line for line in result.stdout.splitlines() if line.startswith('Writing to')]
+  assert written==['Writing to %s' % (workspace/'out'/'aggregated_10km'/('%s.dyfi_geo_10km.geojson' % evid))]
+  assert os.path.isfile(workspace/'out'/'aggregated_10km'/('%s.dyfi_geo_10km.geojson' % evid))
+
+
+def test_compare_archives_reads_in_one_pass(run,workspace,monkeypatch,capsys):
+  import makeAggregated
+  from modules.archive import ArchiveStore
+
+  outputdir=workspace/'out'/'aggregated_%ikm'
+  run('makeAggregated.py','--input',workspace/'catalog.geojson',
+    '--entries',workspace/'entries','--outputdir',outputdir,'--archive')
+
+  monkeypatch.setattr('sys.argv',['makeAggregated.py','--input',str(workspace/'catalog.geojson'),
+    '--outputdir',str(outputdir),'--archive'])
+  args=makeAggregated.parseArgs()
+  stores=makeAggregated.openArchives(args)
+  shipped={product:store.filename for product,store in stores.items()}
+  monkeypatch.setattr(makeAggregated,'PRODUCT_ARCHIVES',shipped)
+
+  def read(self,name):
+    raise AssertionError('read() called for '+name)
+  monkeypatch.setattr(ArchiveStore,'read',read)
+
+  evids=[name.split('.')[0] for name in stores['dyfi_geo_1km.geojson'].names()]
+  makeAggregated.compareArchives(evids,args,stores)
+  out=capsys.readouterr().out
+  assert 'Compared %i events with %s' % (len(evids),shipped['dyfi_geo_1km.geojson']) in out
+
+
+def runInProcess(monkeypatch,capsys,*args):
+  """ Run makeAggregated.py in this process, so it sees a StandinComcat """
+
+  import runpy
+  from conftest import BINDIR
+  monkeypatch.setattr('sys.argv',['makeAggregated.py']+[str(arg) for arg in args])
+  capsys.readouterr()
+  runpy.run_path(os.path.join(BINDIR,'makeAggregated.py'),run_name='__main__')
+  return capsys.readouterr().out
+
+
+def test_jobs_fetch_from_comcat(workspace,monkeypatch,capsys):
+  from modules import synthetic
+  from modules.standin import StandinComcat
+
+  features=synthetic.makeCatalog(40,seed=1)
+  outputdir=workspace/'out'/'aggregated_%ikm'
+  args=('--input',workspace/'catalog.geojson','--outputdir',outputdir,'--jobs',4)
+
+  server=StandinComcat(features,seed=1).start()
+  try:
+    out=runInProcess(monkeypatch,capsys,*args)
+    written={size:sorted(os.listdir(str(outputdir).replace('%i',str(size))))
+      for size in (1,10)}
+    assert written[1] and written[1]==[name.replace('10km','1km') for name in written[10]]
+    for name in written[1]:
+      with open(os.path.join(str(outputdir).replace('%i','1'),name)) as f:
+        assert json.load(f)['features']
+    assert 'skipped 0 already done' in out
+
+    # One event detail and two product requests per event
+    assert server.nrequests==3*len(written[1])
+
+    # Events whose products are already there are not fetched again
+
+    nrequests=server.nrequests
+    mtimes={name:os.stat(os.path.join(str(outputdir).replace('%i','1'),name)).st_mtime_ns
+      for name in written[1]}
+    out=runInProcess(monkeypatch,capsys,*args)
+    assert 'skipped %i already done' % len(written[1]) in out
+    assert 'Writing to' not in out
+    for name,mtime in mtimes.items():
+      assert os.stat(os.path.join(str(outputdir).replace('%i','1'),name)).st_mtime_ns==mtime
+    assert server.nrequests==nrequests
+  finally:
+    server.stop()
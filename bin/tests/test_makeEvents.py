@@ -0,0 +1,72 @@
+import copy
+import numpy as np
+
+from makeEvents import mergeUpdate
+
+
+def event(evid,time,**props):
+  properties={'time':time,'updated':time+1}
+  properties.update(props)
+  return {'type':'Feature','id':evid,'properties':properties,
+    'geometry':{'type':'Point','coordinates':[-97.5,36.5,5.0]}}
+
+
+def existingCatalog():
+  return [event('a',100,collated='line a',line_collated=3),
+    event('b',200),
+    event('c',300,collated='line c',line_collated=7)]
+
+
+def test_changed_events_keep_collate_properties():
+  changed=[event('a',100,mag=3.1),event('c',300,mag=2.2)]
+  merged=mergeUpdate(existingCatalog(),changed,copy.deepcopy(changed),collated=False)
+  props={item['id']:item['properties'] for item in merged}
+  assert props['a']['collated']=='line a' and props['a']['line_collated']==3
+  assert props['a']['mag']==3.1
+  assert props['c']['line_collated']==7
+
+
+def test_recollated_events_are_not_overwritten():
+  changed=[event('a',100)]
+  merged=mergeUpdate(existingCatalog(),changed,copy.deepcopy(changed),collated=True)
+  assert 'collated' not in merged[0]['properties']
+
+
+def test_merged_catalog_is_in_time_order():
+  changed=[event('d',150),event('e',50),event('b',200),event('x',400)]
+  filtered=[item for item in changed if item['id']!='b']
+  merged=mergeUpdate(existingCatalog(),changed,filtered,collated=False)
+  assert [item['id'] for item in merged]==['e','a','d','c','x']
+
+
+def test_filter_keeps_numeric_string_times():
+  from makeEvents import filterCatalog
+  from modules.filter import BatchTimeFilter
+
+  features=[event('a',1500000000000,mag='3.2'),event('b',1500000000000)]
+  features[0]['properties']['time']='1500000000000'
+  catalog=filterCatalog(features,BatchTimeFilter('2017-01-01','2018-01-01'),
+    lambda lonlat:np.ones(len(lonlat),dtype=bool))
+  assert list(catalog['id'])==['a','b']
+  assert catalog.getProperty(0,'time')=='1500000000000'
+
+
+def test_collate_engines_agree_on_string_magnitudes(tmp_path):
+  from modules.catalog import Catalog
+  from modules.collate import collateEvents,collateEventsNumpy,readCollateFile
+  from modules import synthetic
+
+  features=synthetic.makeCatalog(30,seed=3)
+  collatefile=str(tmp_path/'collate.txt')
+  synthetic.writeCollateFile(collatefile,features,seed=3)
+  for feature in features[::2]:
+    feature['properties']['mag']=str(feature['properties']['mag'])
+
+  scalar=copy.deepcopy(features)
+  collateEvents(scalar,readCollateFile(collatefile))
+  catalog=Catalog.fromFeatures(copy.deepcopy(features))
+  collateEventsNumpy(catalog,readCollateFile(collatefile))
+
+  expected=[feature['properties'].get('collated') for feature in scalar]
+  assert any(expected)
+  assert [catalog.getProperty(i,'collated') for i in range(len(catalog))]==expected
@@ -0,0 +1,33 @@
+import os
+import json
+import argparse
+
+from modules.archive import ArchiveStore
+from modules.products import productName,archiveFile
+from modules.summary import CELLSIZES
+from makeSummary import CellCounts
+
+
+def test_archive_stamps_are_per_member(tmp_path):
+  outputdir=str(tmp_path/'aggregated_%ikm')
+  def cells(n):
+    return json.dumps({'features':[{}]*n}).encode('utf8')
+
+  for size in CELLSIZES:
+    os.makedirs(outputdir % size)
+    with ArchiveStore(archiveFile(outputdir % size,size)) as store:
+      for evid in ('ev1','ev2'):
+        store.put('%s.%s' % (evid,productName(size)),cells(2))
+
+  args=argparse.Namespace(outputdir=outputdir,archive=True)
+  before=CellCounts(args)
+  stamps={evid:before.stamp(evid,1) for evid in ('ev1','ev2')}
+  assert before.stamp('ev3',1)=='-'
+
+  with ArchiveStore(archiveFile(outputdir % 1,1)) as store:
+    store.put('ev2.'+productName(1),cells(5))
+
+  after=CellCounts(args)
+  assert after.stamp('ev1',1)==stamps['ev1']
+  assert after.stamp('ev2',1)!=stamps['ev2']
+  assert after.count('ev2',1)==5
@@ -0,0 +1,22 @@
+import datetime
+import argparse
+import numpy as np
+
+from queryCells import eventMask
+
+
+def epochMs(*args):
+  return int(datetime.datetime(*args).timestamp()*1000)
+
+
+def test_end_date_includes_the_whole_day():
+  times=np.array([epochMs(2011,11,5,0,0),epochMs(2011,11,5,23,59),
+    epochMs(2011,11,6,0,0),epochMs(2011,11,7,12,0)])
+  args=argparse.Namespace(minmag=None,maxmag=None,start='2011-11-05',end='2011-11-05')
+  assert eventMask(times,np.zeros(len(times)),args).tolist()==[True,True,False,False]
+
+
+def test_start_date_only():
+  times=np.array([epochMs(2011,11,4,23,59),epochMs(2011,11,5,0,0)])
+  args=argparse.Namespace(minmag=None,maxmag=None,start='2011-11-05',end=None)
+  assert eventMask(times,np.zeros(len(times)),args).tolist()==[False,True]